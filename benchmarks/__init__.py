@@ -0,0 +1,4 @@
+"""
+Benchmarks of the assembly pipeline's Python hot paths on deterministic synthetic inputs.
+Run from the repository root:  python benchmarks/run_benchmarks.py --scales small medium
+"""
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Stand-in for a batch queue, implementing the submit and poll commands of BatchExecutor (lib/Executor.py) on this machine:
+    batch_standin.py submit spec.json    starts the job in the background and prints its id
+    batch_standin.py poll id             prints pending, running or the job's exit code
+A job runs detached from the pipeline, in the spec's cwd with its PATH, after a simulated queue wait of
+BATCH_STANDIN_WAIT seconds (default 0). BATCH_STANDIN_FAIL, a substring of job names, makes matching jobs fail.
+Use with p3x-assembly as
+    --executor batch --batch_submit "python benchmarks/batch_standin.py submit" --batch_poll "python benchmarks/batch_standin.py poll"
+"""
+import sys
+import os
+import os.path
+import json
+import subprocess
+from time import sleep
+
+def writeState(job_id, suffix, text):
+    with open(job_id+suffix+".tmp", 'w') as OUT:
+        OUT.write(text+"\n")
+    os.replace(job_id+suffix+".tmp", job_id+suffix)
+
+def submit(spec_file):
+    """ the id of a job is its spec file without .json; its state is kept in files next to the spec """
+    job_id = os.path.abspath(spec_file)[:-len(".json")]
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "run", os.path.abspath(spec_file)], start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=open(job_id+".stderr", 'w'))
+    print(job_id)
+    return 0
+
+def run(spec_file):
+    job_id = spec_file[:-len(".json")]
+    with open(spec_file) as IN:
+        spec = json.load(IN)
+    sleep(float(os.environ.get('BATCH_STANDIN_WAIT', 0)))
+    writeState(job_id, ".started", str(os.getpid()))
+    if os.environ.get('BATCH_STANDIN_FAIL') and os.environ['BATCH_STANDIN_FAIL'] in spec['name']:
+        return_code = 1
+    else:
+        env = dict(os.environ, PATH=spec['path']) if spec.get('path') else None
+        stdout = open(spec['stdout'], 'w') if spec.get('stdout') else subprocess.DEVNULL
+        return_code = subprocess.call(spec['command'], cwd=spec['cwd'], env=env, stdout=stdout)
+    writeState(job_id, ".rc", str(return_code))
+    return 0
+
+def poll(job_id):
+    if os.path.exists(job_id+".rc"):
+        with open(job_id+".rc") as IN:
+            print(IN.read().strip())
+    elif os.path.exists(job_id+".started"):
+        print("running")
+    elif os.path.exists(job_id+".json"):
+        print("pending")
+    else:
+        sys.stderr.write("unknown job {}\n".format(job_id))
+        return 1
+    return 0
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] not in ("submit", "run", "poll"):
+        sys.stderr.write(__doc__)
+        return 2
+    return {'submit': submit, 'run': run, 'poll': poll}[sys.argv[1]](sys.argv[2])
+
+if __name__ == "__main__":
+    sys.exit(main())
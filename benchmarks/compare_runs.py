@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Compare a baseline and a candidate set of measurements, stage by stage, and fail when something got worse.
+Either side may be run_details.json files (or directories containing them), run_benchmarks.py json or run_pipeline.py json.
+From run_details each pipeline stage gives wall seconds and output bytes (the 'stages' the stage manifest records)
+and peak RSS (telemetry); benchmark json gives seconds and peak RSS per case, pipeline json seconds per scenario and stage.
+Each measurement is compared by the change in its median and a permutation test on the difference of means
+(one-sided for time and memory, which regress only upwards, two-sided for output size).
+A change is a regression when it is beyond its threshold and significant;
+with a single file on either side there is no test and the threshold alone decides.
+Exits with 1 if there is any regression, so it can gate a deployment.
+"""
+import sys
+import os
+import os.path
+import argparse
+import itertools
+import json
+import math
+import random
+from statistics import median
+
+# metric -> (kind of threshold, whether a decrease is also a regression)
+METRICS = {
+    'seconds': ('time', False),
+    'outside_tools_seconds': ('time', False),
+    'peak_rss_mb': ('memory', False),
+    'output_bytes': ('size', True),
+}
+
+def runDetailsMeasurements(details):
+    """ key -> metric -> value, from one run_details.json """
+    measurements = {}
+    for name, stage in details.get('stages', {}).items():
+        if not stage.get('skipped'):
+            measurements["stage/"+name] = {'seconds': stage['seconds'], 'output_bytes': stage['output_bytes']}
+    telemetry_stages = details.get('telemetry', {}).get('stages', {})
+    for name, stage in telemetry_stages.items():
+        measurement = measurements.setdefault("stage/"+name, {})
+        if stage.get('peak_rss_mb'):
+            measurement['peak_rss_mb'] = stage['peak_rss_mb']
+        if 'seconds' not in measurement and not details.get('stages'): # older runs: only the span of the stage's tools
+            measurement['seconds'] = stage['end'] - stage['start']
+    job = details.get('job', {})
+    if job.get('elapsed_seconds'):
+        measurements['job'] = {'seconds': job['elapsed_seconds']}
+        if telemetry_stages:
+            measurements['job']['peak_rss_mb'] = max(stage.get('peak_rss_mb', 0) for stage in telemetry_stages.values())
+    return measurements
+
+def benchmarkMeasurements(results):
+    """ key -> metric -> value, from run_benchmarks.py json """
+    measurements = {}
+    for scale, scale_results in results['scales'].items():
+        for case, result in scale_results['cases'].items():
+            if 'error' not in result:
+                measurements["{}/{}".format(scale, case)] = {'seconds': result['seconds'], 'peak_rss_mb': result['peak_rss_mb']}
+    return measurements
+
+def pipelineMeasurements(results):
+    """ key -> metric -> value, from run_pipeline.py json """
+    measurements = {}
+    for scenario, result in results['scenarios'].items():
+        if result.get('return_code'):
+            continue
+        measurements[scenario] = {'seconds': result['wall_seconds'], 'outside_tools_seconds': result['outside_tools_seconds']}
+        for stage, times in result['stages'].items():
+            measurements["{}/{}".format(scenario, stage)] = {'seconds': times['seconds'], 'outside_tools_seconds': times['outside_tools_seconds']}
+    return measurements
+
+def loadMeasurements(paths):
+    """ key -> metric -> list of values, one per file """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, name) for name in filenames if name.endswith("run_details.json"))
+        else:
+            files.append(path)
+    combined = {}
+    for data_file in sorted(files):
+        with open(data_file) as IN:
+            data = json.load(IN)
+        if 'scales' in data:
+            measurements = benchmarkMeasurements(data)
+        elif 'scenarios' in data:
+            measurements = pipelineMeasurements(data)
+        else:
+            measurements = runDetailsMeasurements(data)
+        for key, metrics in measurements.items():
+            for metric, value in metrics.items():
+                combined.setdefault(key, {}).setdefault(metric, []).append(value)
+    return combined, len(files)
+
+def permutationTest(a, b, rounds, rng, two_sided=False):
+    """
+    p-value for mean(b) exceeding mean(a) (or differing from it, if two_sided) by as much as observed;
+    exact when there are few enough relabelings
+    """
+    pooled = a + b
+    total = sum(pooled)
+    def difference(b_sum):
+        value = b_sum / len(b) - (total - b_sum) / len(a)
+        return abs(value) if two_sided else value
+    observed = difference(sum(b))
+    def extreme(indices):
+        return difference(sum(pooled[i] for i in indices)) >= observed - 1e-12
+    if math.comb(len(pooled), len(b)) <= rounds:
+        relabelings = list(itertools.combinations(range(len(pooled)), len(b)))
+        return sum(1 for indices in relabelings if extreme(indices)) / len(relabelings)
+    hits = sum(1 for i in range(rounds) if extreme(rng.sample(range(len(pooled)), len(b))))
+    return (hits + 1) / (rounds + 1)
+
+def compare(baseline, candidate, args):
+    """ list of comparison rows for measurements present on both sides """
+    thresholds = {'time': args.time_threshold, 'memory': args.memory_threshold, 'size': args.size_threshold}
+    floors = {'time': args.min_seconds, 'memory': args.min_mb, 'size': 0}
+    rng = random.Random(args.seed)
+    rows = []
+    for key in sorted(set(baseline) & set(candidate)):
+        for metric in sorted(set(baseline[key]) & set(candidate[key])):
+            if metric not in METRICS:
+                continue
+            kind, both_ways = METRICS[metric]
+            a = baseline[key][metric]
+            b = candidate[key][metric]
+            base = median(a)
+            new = median(b)
+            if max(base, new) < floors[kind]:
+                continue
+            change = (new - base) / base if base else (math.inf if new else 0.0)
+            tested = len(a) > 1 and len(b) > 1
+            p_value = None
+            if tested:
+                # an improvement is tested the other way round
+                improving = new < base and not both_ways
+                p_value = permutationTest(b, a, args.rounds, rng) if improving else permutationTest(a, b, args.rounds, rng, two_sided=both_ways)
+            significant = p_value <= args.alpha if tested else True
+            beyond = change > thresholds[kind] or (both_ways and change < -thresholds[kind])
+            if beyond and significant:
+                verdict = "REGRESSION" if tested else "REGRESSION (untested)"
+            elif change < -thresholds[kind] and significant:
+                verdict = "improved"
+            else:
+                verdict = "ok"
+            rows.append({'key': key, 'metric': metric, 'baseline': base, 'candidate': new, 'change': change,
+                         'n_baseline': len(a), 'n_candidate': len(b), 'p_value': p_value, 'verdict': verdict})
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--baseline', nargs='+', required=True, help='run_details.json, benchmark json, or directories of run_details.json')
+    parser.add_argument('--candidate', nargs='+', required=True)
+    parser.add_argument('--time_threshold', type=float, default=0.10, help='fractional increase in seconds that counts as a regression')
+    parser.add_argument('--memory_threshold', type=float, default=0.10, help='fractional increase in peak RSS that counts as a regression')
+    parser.add_argument('--size_threshold', type=float, default=0.05, help='fractional change in output bytes that counts as a regression')
+    parser.add_argument('--alpha', type=float, default=0.05, help='significance level of the permutation test')
+    parser.add_argument('--min_seconds', type=float, default=1.0, help='ignore timings shorter than this on both sides')
+    parser.add_argument('--min_mb', type=float, default=50, help='ignore peak RSS smaller than this on both sides')
+    parser.add_argument('--rounds', type=int, default=10000, help='random relabelings when the exact test is too large')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--all', action='store_true', help='list unchanged measurements too')
+    parser.add_argument('--json', help='write the comparison here')
+    args = parser.parse_args()
+
+    baseline, num_baseline = loadMeasurements(args.baseline)
+    candidate, num_candidate = loadMeasurements(args.candidate)
+    rows = compare(baseline, candidate, args)
+    print("{} baseline and {} candidate files, {} measurements compared".format(num_baseline, num_candidate, len(rows)))
+    print("{:<36}{:<24}{:>14}{:>14}{:>10}{:>8}  {}".format("key", "metric", "baseline", "candidate", "change", "p", "verdict"))
+    for row in rows:
+        if row['verdict'] == "ok" and not args.all:
+            continue
+        print("{:<36}{:<24}{:>14.3f}{:>14.3f}{:>9.1f}%{:>8}  {}".format(row['key'], row['metric'], row['baseline'], row['candidate'],
+              100 * row['change'], "-" if row['p_value'] is None else "{:.3f}".format(row['p_value']), row['verdict']))
+    regressions = [row for row in rows if row['verdict'].startswith("REGRESSION")]
+    if args.json:
+        with open(args.json, 'w') as OUT:
+            json.dump({'baseline': args.baseline, 'candidate': args.candidate, 'regressions': len(regressions), 'rows': rows}, OUT, indent=2)
+    print("{} regressions".format(len(regressions)))
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Time the Python hot paths of the assembly pipeline on synthetic inputs (see synthetic.py):
+ReadLibrary.study_reads, ReadLibrary.down_sample_reads (needs seqtk on PATH), and the parsing in
+calcReadDepth (parseReadDepth) and filterContigsByLengthAndCoverage (writeFilteredContigs).
+Each case runs in a forked child so its peak RSS can be measured on its own; the best of --repeat runs is kept.
+Results (seconds, throughput, peak memory) are printed as a table and written as json for run-to-run comparison.
+"""
+import sys
+import os
+import os.path
+import argparse
+import gc
+import importlib.util
+import json
+import multiprocessing
+import platform
+import shutil
+from time import time, strftime, gmtime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, "lib"))
+sys.path.insert(0, REPO_DIR)
+from benchmarks import synthetic
+from ReadLibrary import ReadLibrary
+from RunContext import RunContext
+
+def loadAssemblyScript():
+    """ import scripts/p3x-assembly.py (not importable by name because of the hyphen) """
+    spec = importlib.util.spec_from_file_location("p3x_assembly", os.path.join(REPO_DIR, "scripts", "p3x-assembly.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def quietContext(work_dir):
+    """ run context in work_dir with logging sent to devnull """
+    return RunContext(work_dir, log=open(os.devnull, 'w'))
+
+def memoryStatus():
+    """ (current RSS, peak RSS) of this process in bytes, from /proc/self/status """
+    rss = peak = 0
+    with open("/proc/self/status") as IN:
+        for line in IN:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith("VmHWM:"):
+                peak = int(line.split()[1]) * 1024
+    return rss, peak
+
+def resetPeakRss():
+    """ reset VmHWM to the current RSS (linux 4.0+), so the peak excludes setup; return False if not possible """
+    try:
+        with open("/proc/self/clear_refs", 'w') as OUT:
+            OUT.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+def runCase(setup, case, conn):
+    """ child process: setup() returns state, case(state) returns (records, bytes); send timing and memory back """
+    sys.stdout = open(os.devnull, 'w') # ReadLibrary prints progress
+    state = setup()
+    gc.collect()
+    peak_reset = resetPeakRss()
+    start_rss = memoryStatus()[0]
+    start_time = time()
+    records, num_bytes = case(state)
+    seconds = time() - start_time
+    rss, peak_rss = memoryStatus()
+    conn.send({'seconds': seconds, 'records': records, 'bytes': num_bytes, 'peak_includes_setup': not peak_reset,
+               'peak_rss_mb': round(peak_rss / 1e6, 1), 'rss_increase_mb': round(max(0, peak_rss - start_rss) / 1e6, 1)})
+    conn.close()
+
+def measure(setup, case, repeat):
+    """ run case in a fresh child repeat times; return the fastest run with throughput added """
+    context = multiprocessing.get_context('fork')
+    best = None
+    for i in range(repeat):
+        parent_conn, child_conn = context.Pipe(duplex=False)
+        proc = context.Process(target=runCase, args=(setup, case, child_conn))
+        proc.start()
+        child_conn.close()
+        try:
+            result = parent_conn.recv()
+        except EOFError:
+            proc.join()
+            return {'error': "benchmark process exited with code {}".format(proc.exitcode)}
+        proc.join()
+        if not best or result['seconds'] < best['seconds']:
+            best = result
+    best['records_per_second'] = round(best['records'] / best['seconds'], 1) if best['seconds'] else None
+    best['mb_per_second'] = round(best['bytes'] / 1e6 / best['seconds'], 2) if best['seconds'] else None
+    best['seconds'] = round(best['seconds'], 4)
+    return best
+
+def defineCases(inputs, work_dir, assembly):
+    """ dict of case name -> (setup, case); setup runs outside the timed region """
+    fileBytes = lambda files: sum(os.path.getsize(f) for f in files)
+    cases = {}
+
+    def studyCase(files, read_platform):
+        def setup():
+            return ReadLibrary(files, platform=read_platform, context=quietContext(work_dir))
+        def case(read_set):
+            read_set.study_reads()
+            return read_set.num_reads, fileBytes(files)
+        return setup, case
+    cases['study_reads_illumina'] = studyCase(inputs['illumina'], 'illumina')
+    cases['study_reads_nanopore'] = studyCase([inputs['long_reads']], 'nanopore')
+
+    if shutil.which('seqtk'):
+        def setupSample():
+            sample_dir = os.path.join(work_dir, "down_sample")
+            if os.path.exists(sample_dir):
+                shutil.rmtree(sample_dir)
+            os.mkdir(sample_dir)
+            read_set = ReadLibrary(inputs['illumina'], platform='illumina', context=quietContext(sample_dir))
+            read_set.study_reads()
+            return read_set
+        def sampleCase(read_set):
+            num_reads = read_set.num_reads
+            read_set.down_sample_reads(read_set.num_bases / 4)
+            return num_reads, fileBytes(inputs['illumina'])
+        cases['down_sample_reads'] = (setupSample, sampleCase)
+
+    def setupDepth():
+        with open(inputs['depth']) as IN:
+            return IN.read()
+    def depthCase(depthData):
+        # as in calcReadDepth, from the captured samtools output
+        depthLines = depthData.splitlines()
+        assembly.parseReadDepth(depthLines)
+        return len(depthLines), len(depthData)
+    cases['calcReadDepth_parse'] = (setupDepth, depthCase)
+
+    def setupFilter():
+        with open(inputs['depth']) as IN:
+            average_depth, readDepth = assembly.parseReadDepth(IN.read().splitlines())
+        return readDepth
+    def filterCase(readDepth):
+        counts = assembly.writeFilteredContigs(inputs['genome'], os.path.join(work_dir, "filtered.fasta"),
+                os.path.join(work_dir, "suboptimal.fasta"), readDepth, None, 300, 5, "bench_")
+        return counts[0] + counts[1], os.path.getsize(inputs['genome'])
+    cases['filter_contigs_parse'] = (setupFilter, filterCase)
+    return cases
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--scales', nargs='*', choices=sorted(synthetic.SCALES), default=['small', 'medium'])
+    parser.add_argument('--cases', nargs='*', help='run only these cases (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each case; the fastest is reported')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--work_dir', default='benchmark_work', help='synthetic inputs are kept here and reused')
+    parser.add_argument('--json', default='benchmark_results.json', help='write results here')
+    args = parser.parse_args()
+
+    assembly = loadAssemblyScript()
+    work_dir = os.path.abspath(args.work_dir)
+    results = {'host': platform.node(), 'python': platform.python_version(), 'cpu_count': os.cpu_count(),
+               'date': strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()), 'seed': args.seed, 'repeat': args.repeat, 'scales': {}}
+    print("{:<8}{:<24}{:>10}{:>14}{:>10}{:>12}{:>14}".format("scale", "case", "seconds", "records/s", "MB/s", "peak_mb", "increase_mb"))
+    for scale in args.scales:
+        scale_dir = os.path.join(work_dir, scale)
+        generate_time = time()
+        inputs = synthetic.generate(scale_dir, scale, args.seed)
+        sys.stderr.write("inputs for {} ready in {:.1f} seconds\n".format(scale, time() - generate_time))
+        results['scales'][scale] = {'inputs': {key: inputs[key] for key in ('params', 'genome_length', 'depth_rows')}, 'cases': {}}
+        for name, (setup, case) in defineCases(inputs, scale_dir, assembly).items():
+            if args.cases and name not in args.cases:
+                continue
+            result = measure(setup, case, args.repeat)
+            results['scales'][scale]['cases'][name] = result
+            if 'error' in result:
+                print("{:<8}{:<24}{}".format(scale, name, result['error']))
+                continue
+            print("{:<8}{:<24}{:>10.3f}{:>14.0f}{:>10.1f}{:>12.1f}{:>14.1f}".format(scale, name, result['seconds'],
+                result['records_per_second'] or 0, result['mb_per_second'] or 0, result['peak_rss_mb'], result['rss_increase_mb']))
+    with open(args.json, 'w') as OUT:
+        json.dump(results, OUT, indent=2)
+
+if __name__ == "__main__":
+    main()
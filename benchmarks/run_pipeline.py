@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Run p3x-assembly.py end to end on synthetic reads with the stand-in tools in benchmarks/shims
+(put first on PATH via --path_prefix), and report how much of the wall time is spent outside the tools:
+file moves, version probes, read scanning, SAM/BAM handling and other orchestration in the script itself.
+Tool time is the union of the stand-in invocation intervals (SHIM_LOG), so concurrent tools are not double counted;
+it is broken down per tool, and per pipeline stage using the stage events of the run's event log.
+"""
+import sys
+import os
+import os.path
+import argparse
+import json
+import platform
+import shutil
+import subprocess
+from time import time, strftime, gmtime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from benchmarks import synthetic
+
+SHIM_DIR = os.path.join(REPO_DIR, "benchmarks", "shims")
+ASSEMBLY_SCRIPT = os.path.join(REPO_DIR, "scripts", "p3x-assembly.py")
+
+# scenario name -> (read types passed, p3x-assembly.py options)
+SCENARIOS = {
+    'unicycler': (('illumina', 'nanopore'), ['--recipe', 'unicycler']),
+    'spades_pilon': (('illumina',), ['--recipe', 'spades', '--trim', '--normalize', '--pilon_iterations', '2']),
+    'flye_polish': (('illumina', 'nanopore'), ['--recipe', 'flye', '--racon_iterations', '2', '--pilon_iterations', '2']),
+    'canu_racon': (('nanopore',), ['--recipe', 'canu', '--racon_iterations', '2', '--genome_size', '1m']),
+}
+
+def mergeIntervals(intervals):
+    """ sorted, non-overlapping list of (start, end) covering the given intervals """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def coveredSeconds(merged, start, end):
+    """ seconds of [start, end] covered by merged intervals """
+    return sum(max(0, min(end, interval_end) - max(start, interval_start)) for interval_start, interval_end in merged)
+
+def readJsonLines(path):
+    records = []
+    if os.path.exists(path):
+        with open(path) as IN:
+            for line in IN:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+def stageWindows(events):
+    """ dict of stage name -> (start, end) wall-clock times from stage_start/stage_complete events """
+    starts = {}
+    windows = {}
+    for event in events:
+        if event['event'] == 'stage_start':
+            starts[event['stage']] = event['time']
+        elif event['event'] == 'stage_complete' and event['stage'] in starts:
+            windows[event['stage']] = (starts[event['stage']], event['time'])
+    return windows
+
+def analyzeRun(invocations, events, start, end):
+    """ wall, tool and outside-tool seconds for the run, per tool and per stage """
+    merged = mergeIntervals([(inv['start'], inv['end']) for inv in invocations])
+    wall = end - start
+    tool_seconds = coveredSeconds(merged, start, end)
+    result = {'wall_seconds': round(wall, 3), 'tool_seconds': round(tool_seconds, 3),
+              'outside_tools_seconds': round(wall - tool_seconds, 3),
+              'outside_tools_fraction': round((wall - tool_seconds) / wall, 3) if wall > 0 else None,
+              'invocations': len(invocations),
+              'version_probes': sum(1 for inv in invocations if '--version' in inv['argv'] or '-v' in inv['argv'][1:2] or len(inv['argv']) == 1),
+              'tools': {}, 'stages': {}}
+    for inv in invocations:
+        tool = result['tools'].setdefault(inv['tool'], {'calls': 0, 'seconds': 0})
+        tool['calls'] += 1
+        tool['seconds'] += inv['end'] - inv['start']
+    for tool in result['tools'].values():
+        tool['seconds'] = round(tool['seconds'], 3)
+    for stage, (stage_start, stage_end) in stageWindows(events).items():
+        stage_tools = coveredSeconds(merged, stage_start, stage_end)
+        result['stages'][stage] = {'seconds': round(stage_end - stage_start, 3), 'tool_seconds': round(stage_tools, 3),
+                                   'outside_tools_seconds': round(stage_end - stage_start - stage_tools, 3)}
+    return result
+
+def shimEnvironment(args, shim_log):
+    env = dict(os.environ)
+    env['SHIM_LOG'] = shim_log
+    env['SHIM_DELAY'] = str(args.delay)
+    env['SHIM_GENOME_SIZE'] = str(args.genome_size)
+    env['SHIM_NUM_CONTIGS'] = str(args.num_contigs)
+    env['SHIM_SEED'] = str(args.seed)
+    for tool_delay in args.tool_delay or []:
+        tool, seconds = tool_delay.split('=')
+        env["SHIM_DELAY_" + tool.replace('.', '_').replace('-', '_').upper()] = seconds
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.join(REPO_DIR, "lib"), env.get('PYTHONPATH')]))
+    return env
+
+def runScenario(name, inputs, run_dir, args):
+    """ run one pipeline in run_dir; return its analysis (or error) """
+    read_types, options = SCENARIOS[name]
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    shim_log = os.path.join(run_dir, "shim_log.jsonl")
+    event_log = os.path.join(run_dir, "events.jsonl")
+    pilon_jar = os.path.join(run_dir, "pilon.jar") # any existing file will do, the java stand-in ignores it
+    open(pilon_jar, 'w').close()
+    command = [sys.executable, ASSEMBLY_SCRIPT, '-d', os.path.join(run_dir, "p3_assembly_work"), '--prefix', name+"_",
+               '-t', str(args.threads), '-m', str(args.memory), '--pilon_jar', pilon_jar, '--event_log', event_log,
+               '--path_prefix', SHIM_DIR] + options + args.extra
+    if 'illumina' in read_types:
+        command += ['--illumina', ":".join(inputs['illumina'])]
+    if 'nanopore' in read_types:
+        command += ['--nanopore', inputs['long_reads']]
+    with open(os.path.join(run_dir, "assembly.log"), 'w') as LOG:
+        start = time()
+        return_code = subprocess.call(command, cwd=run_dir, env=shimEnvironment(args, shim_log), stdout=LOG, stderr=subprocess.STDOUT)
+        end = time()
+    result = analyzeRun(readJsonLines(shim_log), readJsonLines(event_log), start, end)
+    result['return_code'] = return_code
+    result['command'] = command
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--scenarios', nargs='*', choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    parser.add_argument('--scale', choices=sorted(synthetic.SCALES), default='small', help='size of the synthetic reads')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--delay', type=float, default=0, help='seconds each stand-in tool sleeps')
+    parser.add_argument('--tool_delay', nargs='*', metavar='TOOL=SECONDS', help='per-tool delay, e.g. spades.py=5')
+    parser.add_argument('--genome_size', type=int, default=200000, help='bases in the stand-in assemblies')
+    parser.add_argument('--num_contigs', type=int, default=10, help='contigs in the stand-in assemblies')
+    parser.add_argument('-t', '--threads', type=int, default=4)
+    parser.add_argument('-m', '--memory', type=int, default=8)
+    parser.add_argument('--extra', nargs=argparse.REMAINDER, default=[], help='further options for p3x-assembly.py (must come last)')
+    parser.add_argument('--work_dir', default='pipeline_benchmark_work', help='synthetic inputs are kept here and reused')
+    parser.add_argument('--json', default='pipeline_benchmark_results.json', help='write results here')
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    inputs = synthetic.generate(os.path.join(work_dir, "inputs_"+args.scale), args.scale, args.seed)
+    results = {'host': platform.node(), 'python': platform.python_version(), 'cpu_count': os.cpu_count(),
+               'date': strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()), 'scale': args.scale, 'seed': args.seed,
+               'delay': args.delay, 'tool_delay': args.tool_delay, 'genome_size': args.genome_size, 'scenarios': {}}
+    print("{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}{:>8}{:>8}".format("scenario", "status", "wall", "tools", "outside", "fraction", "calls", "probes"))
+    for name in args.scenarios:
+        result = runScenario(name, inputs, os.path.join(work_dir, name), args)
+        results['scenarios'][name] = result
+        print("{:<16}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.3f}{:>8}{:>8}".format(name, "ok" if result['return_code'] == 0 else "rc="+str(result['return_code']),
+              result['wall_seconds'], result['tool_seconds'], result['outside_tools_seconds'], result['outside_tools_fraction'] or 0,
+              result['invocations'], result['version_probes']))
+        for stage, times in sorted(result['stages'].items(), key=lambda item: -item[1]['outside_tools_seconds'])[:5]:
+            print("    {:<20}{:>10.2f}{:>10.2f}{:>10.2f}".format(stage, times['seconds'], times['tool_seconds'], times['outside_tools_seconds']))
+    with open(args.json, 'w') as OUT:
+        json.dump(results, OUT, indent=2)
+
+if __name__ == "__main__":
+    main()
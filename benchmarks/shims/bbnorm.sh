@@ -0,0 +1 @@
+stand_in_tool.py
\ No newline at end of file
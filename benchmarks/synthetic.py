@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Deterministic synthetic inputs for the benchmarks: a multi-contig genome (multi-line FASTA),
+Illumina-style read pairs and nanopore-style long reads sampled from it, and a samtools depth table over it.
+The same seed and scale always give byte-identical files, so timings can be compared from run to run.
+"""
+import sys
+import os
+import os.path
+import random
+import argparse
+import json
+
+# sizes at each scale; reads and depth rows grow about 10x per step
+SCALES = {
+    'small': {'contigs': 50, 'contig_length': 20000, 'read_pairs': 20000, 'long_reads': 200, 'long_read_length': 8000, 'depth_bams': 1},
+    'medium': {'contigs': 200, 'contig_length': 25000, 'read_pairs': 200000, 'long_reads': 2000, 'long_read_length': 8000, 'depth_bams': 2},
+    'large': {'contigs': 500, 'contig_length': 40000, 'read_pairs': 2000000, 'long_reads': 20000, 'long_read_length': 8000, 'depth_bams': 2},
+}
+
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+def randomSequence(rng, length):
+    return "".join(rng.choices("ACGT", k=length))
+
+def writeGenome(path, rng, num_contigs, contig_length):
+    """ Write contigs of varied length (mean contig_length) as 60-column FASTA; return list of (id, sequence). """
+    contigs = []
+    with open(path, 'w') as OUT:
+        for i in range(num_contigs):
+            length = max(200, int(rng.expovariate(1.0 / contig_length)))
+            seq = randomSequence(rng, length)
+            contig_id = "contig_{}".format(i+1)
+            header = ">{} length={} depth=1.00x".format(contig_id, length)
+            if i % 10 == 0:
+                header += " circular=true"
+            OUT.write(header+"\n")
+            for j in range(0, length, 60):
+                OUT.write(seq[j:j+60]+"\n")
+            contigs.append((contig_id, seq))
+    return contigs
+
+def qualityStrings(rng, length, count, low, high):
+    """ a pool of quality strings to draw from, as generating one per read dominates run time """
+    return ["".join(chr(33 + rng.randint(low, high)) for i in range(length)) for j in range(count)]
+
+def writeIlluminaPairs(prefix, rng, contigs, num_pairs, read_length=150, insert_size=400):
+    """ Write <prefix>_R1.fastq and <prefix>_R2.fastq with Casava 1.8 style ids; return the two paths. """
+    genome = "".join(seq for contig_id, seq in contigs)
+    qualities = qualityStrings(rng, read_length, 64, 20, 40)
+    files = [prefix+"_R1.fastq", prefix+"_R2.fastq"]
+    with open(files[0], 'w') as R1, open(files[1], 'w') as R2:
+        for i in range(num_pairs):
+            start = rng.randint(0, len(genome) - insert_size - 1)
+            fragment = genome[start:start+insert_size]
+            read_id = "@SYN01:1:FC0001:1:{}:{}:{}".format(1101 + i // 100000, rng.randint(1000, 20000), rng.randint(1000, 20000))
+            R1.write("{} 1:N:0:ACGTACGT\n{}\n+\n{}\n".format(read_id, fragment[:read_length], rng.choice(qualities)))
+            R2.write("{} 2:N:0:ACGTACGT\n{}\n+\n{}\n".format(read_id, fragment[-read_length:].translate(COMPLEMENT)[::-1], rng.choice(qualities)))
+    return files
+
+def writeLongReads(path, rng, contigs, num_reads, mean_length):
+    """ Write nanopore-style reads (uuid ids with runid=, low qualities, varied lengths); return path. """
+    genome = "".join(seq for contig_id, seq in contigs)
+    qualities = qualityStrings(rng, 1000, 16, 5, 25)
+    with open(path, 'w') as OUT:
+        for i in range(num_reads):
+            length = min(len(genome) - 1, max(1000, int(rng.gauss(mean_length, mean_length / 3))))
+            start = rng.randint(0, len(genome) - length)
+            seq = genome[start:start+length]
+            quality = (rng.choice(qualities) * (length // 1000 + 1))[:length]
+            read_id = "@{:08x}-{:04x}-{:04x}-{:04x}-{:012x} runid=0f1e2d3c read={} ch={} start_time=2020-01-01T00:00:00Z".format(
+                rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(48), i, rng.randint(1, 512))
+            OUT.write("{}\n{}\n+\n{}\n".format(read_id, seq, quality))
+    return path
+
+def writeDepthTable(path, rng, contigs, num_bams, mean_depth=30):
+    """ Write samtools depth style rows (contig, 1-based position, depth per bam); return number of rows. """
+    rows = 0
+    with open(path, 'w') as OUT:
+        for contig_id, seq in contigs:
+            contig_depth = max(1, rng.gauss(mean_depth, mean_depth / 4))
+            depth = [contig_depth] * num_bams
+            for position in range(1, len(seq)+1):
+                if position % 100 == 1:
+                    depth = [max(0, int(rng.gauss(contig_depth, 3))) for i in range(num_bams)]
+                OUT.write(contig_id+"\t"+str(position)+"\t"+"\t".join(str(d) for d in depth)+"\n")
+                rows += 1
+    return rows
+
+def generate(out_dir, scale='small', seed=1):
+    """ Write all inputs for scale into out_dir (reusing them if already there for this seed); return dict of paths and sizes. """
+    params = SCALES[scale]
+    manifest_file = os.path.join(out_dir, "inputs.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as IN:
+            inputs = json.load(IN)
+        if inputs.get('seed') == seed and inputs.get('scale') == scale and all(os.path.exists(inputs[key]) for key in ('genome', 'long_reads', 'depth')):
+            return inputs
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    rng = random.Random("{}:{}".format(seed, scale))
+    contigs = writeGenome(os.path.join(out_dir, "genome.fasta"), rng, params['contigs'], params['contig_length'])
+    inputs = {'scale': scale, 'seed': seed, 'params': params,
+              'genome': os.path.join(out_dir, "genome.fasta"),
+              'genome_length': sum(len(seq) for contig_id, seq in contigs),
+              'illumina': writeIlluminaPairs(os.path.join(out_dir, "illumina"), rng, contigs, params['read_pairs']),
+              'long_reads': writeLongReads(os.path.join(out_dir, "nanopore.fastq"), rng, contigs, params['long_reads'], params['long_read_length']),
+              'depth': os.path.join(out_dir, "depth.tsv")}
+    inputs['depth_rows'] = writeDepthTable(inputs['depth'], rng, contigs, params['depth_bams'])
+    with open(manifest_file, 'w') as OUT:
+        json.dump(inputs, OUT, indent=2)
+    return inputs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--outputDirectory', '-d', default='synthetic_inputs')
+    args = parser.parse_args()
+    inputs = generate(args.outputDirectory, args.scale, args.seed)
+    json.dump(inputs, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Content-addressed store of stage outputs (trimmed or normalized reads, assembler contigs and graph) shared between jobs.
+An entry is keyed by a hash of the stage name, its parameters, the tool version and the content of its input files,
+so a resubmission of the same reads can reuse the outputs whatever the files are called.
+Entries are published atomically (built in a temporary directory, then renamed into place),
+and the least recently used are evicted when the store grows beyond its size limit.
+"""
+import sys
+import os
+import os.path
+import json
+import hashlib
+import shutil
+import uuid
+from time import time
+
+class ArtifactCache:
+    LOG = sys.stderr
+    HASH_CHUNK = 4 * 1024 * 1024
+    digests = {} # (realpath, size, mtime_ns) -> content digest, so each input is hashed once per process
+
+    def __init__(self, cache_dir, max_gb=100, log=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.log = log or ArtifactCache.LOG
+        self.max_bytes = max_gb * 1e9
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def fileDigest(self, path):
+        """ sha1 of file content, remembered for all caches of this process """
+        st = os.stat(path)
+        memo_key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+        if memo_key not in ArtifactCache.digests:
+            start_time = time()
+            digest = hashlib.sha1()
+            with open(path, 'rb') as IN:
+                for chunk in iter(lambda: IN.read(ArtifactCache.HASH_CHUNK), b''):
+                    digest.update(chunk)
+            ArtifactCache.digests[memo_key] = digest.hexdigest()
+            self.log.write("hashed {} ({} bytes) in {:.1f} seconds\n".format(path, st.st_size, time() - start_time))
+        return ArtifactCache.digests[memo_key]
+
+    def key(self, stage, params, input_files, tool_version):
+        """ Cache key for running stage with params and tool_version on the content of input_files (order matters). """
+        text = json.dumps([stage, params, tool_version, [self.fileDigest(path) for path in input_files]], sort_keys=True, default=str)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def entryDir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def lookup(self, key):
+        """ Return the entry's metadata (a dict with 'files' and 'meta') on a hit, or None. A hit marks the entry as recently used. """
+        entry = self.entryDir(key)
+        meta_file = os.path.join(entry, "meta.json")
+        if not os.path.exists(meta_file):
+            return None
+        with open(meta_file) as IN:
+            meta = json.load(IN)
+        os.utime(entry)
+        self.log.write("artifact cache hit {} for {}\n".format(key, meta.get('stage')))
+        return meta
+
+    def restore(self, key, name, dest):
+        """ Put a copy of the entry's file name at dest (hard link when possible, as entries are never modified). """
+        source = os.path.join(self.entryDir(key), name)
+        dest_dir = os.path.dirname(dest)
+        if dest_dir and not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(source, dest)
+        except OSError:
+            shutil.copy(source, dest)
+        return dest
+
+    def publish(self, key, stage, files, meta=None):
+        """
+        Store files (dict of name -> path) under key with meta, then evict old entries if over the size limit.
+        Return True if this call created the entry.
+        """
+        entry = self.entryDir(key)
+        if os.path.exists(entry):
+            return False
+        temp_dir = os.path.join(self.cache_dir, ".tmp-" + uuid.uuid4().hex)
+        os.makedirs(temp_dir)
+        try:
+            size = 0
+            for name, path in files.items():
+                shutil.copy(path, os.path.join(temp_dir, name))
+                size += os.path.getsize(path)
+            with open(os.path.join(temp_dir, "meta.json"), 'w') as OUT:
+                json.dump({'stage': stage, 'files': sorted(files), 'bytes': size, 'created': time(), 'meta': meta or {}}, OUT, indent=2, default=str)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            os.rename(temp_dir, entry)
+        except OSError as e:
+            # another job published the same key first, or the store is full
+            self.log.write("artifact cache: could not publish {}: {}\n".format(key, e))
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return False
+        self.log.write("artifact cache published {} for {} ({} bytes)\n".format(key, stage, size))
+        self.evict()
+        return True
+
+    def evict(self):
+        """ Remove least recently used entries until the store fits within max_bytes. """
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if prefix.startswith(".") or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue # evicted by another job meanwhile
+                total += size
+        entries.sort()
+        while total > self.max_bytes and len(entries) > 1:
+            last_used, size, entry = entries.pop(0)
+            self.log.write("artifact cache evicting {} ({} bytes)\n".format(entry, size))
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
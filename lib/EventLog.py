@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Structured event stream for an assembly job, written as JSON lines next to the human-readable log.
+Each event has a monotonic timestamp (seconds since the log was opened), wall-clock time, the pipeline stage,
+an event type, and any fields the caller adds; counters() adds throughput (records and MB per second).
+An EventLog opened without a file is disabled and costs one attribute test per event.
+"""
+import sys
+import json
+import threading
+from time import time, monotonic
+
+class EventLog:
+    LOG = sys.stderr
+
+    def __init__(self, path=None, append=False, log=None):
+        self.path = path
+        self.log = log or EventLog.LOG
+        self.OUT = None
+        self.start = monotonic()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        if path:
+            self.OUT = open(path, 'a' if append else 'w')
+            self.log.write("writing events to {}\n".format(path))
+
+    def setStage(self, name):
+        """ stage attributed to events emitted from the calling thread """
+        self.local.stage = name
+
+    def emit(self, event, stage=None, **fields):
+        """ Write one event; stage defaults to the calling thread's current stage. """
+        if not self.OUT:
+            return
+        record = {'t': round(monotonic() - self.start, 3), 'time': round(time(), 3),
+                'stage': stage or getattr(self.local, 'stage', 'main'), 'event': event}
+        record.update(fields)
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.OUT.write(line+"\n")
+            self.OUT.flush()
+
+    def counters(self, event, seconds, records=None, bytes_in=None, bytes_out=None, stage=None, **fields):
+        """ Emit an event for work that took seconds, with its record and byte counts and the rates they imply. """
+        if not self.OUT:
+            return
+        fields['duration'] = round(seconds, 3)
+        if records is not None:
+            fields['records'] = records
+            fields['records_per_second'] = round(records / seconds, 1) if seconds > 0 else None
+        if bytes_in is not None:
+            fields['bytes_in'] = bytes_in
+            fields['mb_in_per_second'] = round(bytes_in / 1e6 / seconds, 2) if seconds > 0 else None
+        if bytes_out is not None:
+            fields['bytes_out'] = bytes_out
+        self.emit(event, stage, **fields)
+
+    def close(self):
+        if self.OUT:
+            self.OUT.close()
+            self.OUT = None
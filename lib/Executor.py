@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Where the external commands of parallel stages (pilon shards, racon partitions) run.
+A job is a dict declaring its name, command, threads, memory_gb and optionally stdout (a file),
+inputs and outputs (files it reads and must write) and time_limit (seconds); the executor starts it, reports when it has finished
+and stops it when it runs too long,
+so stage code never handles processes or queues itself.
+LocalExecutor runs jobs as child processes on this node, within the job's own threads and memory;
+wait() returns as soon as one of them exits, while the batch queue can only be polled every poll_interval seconds.
+BatchExecutor hands each job to a batch queue through two site-provided commands:
+    submit_command spec.json   prints an id for the job on the first line of its stdout
+    poll_command id            prints pending, running, or the exit code of the finished job
+where spec.json is the job as json, with the directory to run in (cwd) and the PATH to run with.
+Jobs on a queue must see the work directory at the same path (a shared filesystem).
+benchmarks/batch_standin.py implements the submit and poll commands on the local machine, for testing.
+"""
+import sys
+import os
+import signal
+import os.path
+import json
+import subprocess
+import threading
+import uuid
+from time import sleep
+from ToolRunner import terminateProcessGroup, signalGroup
+
+def missingFiles(paths):
+    return [path for path in paths or [] if not os.path.exists(path)]
+
+class LocalExecutor:
+    LOG = sys.stderr
+    shares_budget = True # jobs use the threads and memory of this node
+
+    def __init__(self, cwd, log=None):
+        self.cwd = cwd
+        self.log = log or LocalExecutor.LOG
+        self.active = set()
+        self.exited = threading.Condition()
+
+    def submit(self, job):
+        """ start job; return a handle for poll() """
+        stdout = open(job["stdout"], 'w') if job.get("stdout") else subprocess.DEVNULL
+        proc = subprocess.Popen(job["command"], shell=False, stdout=stdout, stderr=subprocess.DEVNULL, cwd=self.cwd, start_new_session=True)
+        if job.get("stdout"):
+            stdout.close()
+        self.active.add(proc)
+        threading.Thread(target=self.reap, args=(proc,), daemon=True).start()
+        return proc
+
+    def reap(self, proc):
+        proc.wait()
+        with self.exited:
+            self.exited.notify_all()
+
+    def wait(self, handles, timeout=None):
+        """ block until one of handles has exited, or for timeout seconds """
+        with self.exited:
+            self.exited.wait_for(lambda: any(handle.returncode is not None for handle in handles), timeout)
+
+    def poll(self, handle):
+        """ exit code of the job, or None while it runs """
+        return_code = handle.poll()
+        if return_code is not None:
+            self.active.discard(handle)
+        return return_code
+
+    def cancel(self, handle):
+        """ terminate the job's process tree; return its exit code """
+        terminateProcessGroup(handle)
+        self.active.discard(handle)
+        return handle.returncode
+
+    def killAll(self):
+        """ kill the process groups of all running jobs (when this process is being stopped) """
+        for proc in list(self.active):
+            signalGroup(proc.pid, signal.SIGKILL)
+
+class BatchExecutor:
+    LOG = sys.stderr
+    shares_budget = False # the queue finds threads and memory for each job
+    MAX_POLL_FAILURES = 5 # consecutive failures of the poll command before a job is given up as failed
+
+    def __init__(self, submit_command, poll_command, spec_dir, cwd, log=None, poll_interval=5):
+        """ submit_command and poll_command are lists (command and leading arguments); job specs are written to spec_dir """
+        self.submit_command = submit_command
+        self.poll_command = poll_command
+        self.spec_dir = spec_dir
+        self.cwd = cwd
+        self.log = log or BatchExecutor.LOG
+        self.poll_interval = poll_interval
+        self.poll_failures = {}
+        if not os.path.exists(spec_dir):
+            os.makedirs(spec_dir)
+
+    def submit(self, job):
+        """ submit job to the queue; return its id """
+        spec = {'name': job["name"], 'command': job["command"], 'threads': job.get("threads", 1), 'memory_gb': job["memory_gb"],
+                'stdout': job.get("stdout"), 'inputs': job.get("inputs", []), 'outputs': job.get("outputs", []), 'time_limit': job.get("time_limit"),
+                'cwd': self.cwd, 'path': os.environ.get("PATH", "")}
+        spec_file = os.path.join(self.spec_dir, "{}.{}.json".format(os.path.basename(job["name"]), uuid.uuid4().hex[:8]))
+        with open(spec_file, 'w') as OUT:
+            json.dump(spec, OUT, indent=2)
+        proc = subprocess.run(self.submit_command + [spec_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=self.cwd)
+        if proc.returncode != 0 or not proc.stdout.strip():
+            raise Exception("cannot submit {}: {} returned {}: {}".format(job["name"], " ".join(self.submit_command), proc.returncode, proc.stderr.strip()))
+        job_id = proc.stdout.strip().splitlines()[0].strip()
+        self.log.write("submitted {} as batch job {}\n".format(job["name"], job_id))
+        return job_id
+
+    def poll(self, handle):
+        """ exit code of the job, or None while it is pending or running """
+        proc = subprocess.run(self.poll_command + [handle], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, cwd=self.cwd)
+        state = proc.stdout.strip().split()[0] if proc.stdout.strip() else ""
+        if proc.returncode == 0 and state in ("pending", "running"):
+            self.poll_failures.pop(handle, None)
+            return None
+        if proc.returncode == 0 and state.lstrip("-").isdigit():
+            self.poll_failures.pop(handle, None)
+            return int(state)
+        failures = self.poll_failures.get(handle, 0) + 1
+        self.poll_failures[handle] = failures
+        self.log.write("polling batch job {} failed ({} of {}): {}\n".format(handle, failures, BatchExecutor.MAX_POLL_FAILURES, (proc.stdout + proc.stderr).strip()))
+        if failures >= BatchExecutor.MAX_POLL_FAILURES:
+            return 1
+        return None
+
+    def wait(self, handles, timeout=None):
+        """ the queue cannot say when a job ends, so wait until it is time to poll again """
+        sleep(min(self.poll_interval, timeout) if timeout is not None else self.poll_interval)
+
+    def cancel(self, handle):
+        """ stop waiting for the job; the queue enforces the spec's time_limit itself, so it is not killed from here """
+        self.log.write("giving up on batch job {}\n".format(handle))
+        return 1
+
+    def killAll(self):
+        """ jobs on the queue are not children of this process; they are left to finish or to the queue's limits """
+        pass
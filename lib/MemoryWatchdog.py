@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Watch the memory of one tool run against the memory it was leased, and tell memory failures from other failures.
+While the tool runs (ToolRunner.runAsync(watchdog=...)), the RSS of its whole process tree is sampled from /proc;
+a tree that grows past the limit is stopped, so the tool fails cleanly instead of the kernel OOM killer choosing a victim,
+which may be this pipeline or another job sharing the node.
+After the run, classify() reports 'memory' if the watchdog stopped it, the cgroup recorded an OOM kill while it ran,
+it was killed by SIGKILL, or the end of its output or log says it ran out of memory; otherwise 'failed'.
+"""
+import sys
+import os
+import re
+import asyncio
+from Telemetry import processTable
+
+SAMPLE_SECONDS = 2
+NEAR_LIMIT = 0.9 # a failure with the peak above this fraction of the limit is taken as a memory failure
+# failure text only: assemblers log their memory limit on every run (SPAdes "Memory limit set to 250 Gb", unicycler --mem_limit)
+MEMORY_MESSAGES = re.compile(r"bad_alloc|cannot allocate memory|out of memory|not enough memory|memoryerror|killed by oom|oom[-_ ]kill|mmap\b.*\bfailed", re.IGNORECASE)
+LOG_TAIL_BYTES = 20000 # end of a tool's log file searched for MEMORY_MESSAGES
+
+def treeRss(pid, table=None):
+    """ bytes of RSS of pid and all its descendants """
+    table = table or processTable()
+    children = {}
+    for child, (ppid, state, cpu_seconds, rss) in table.items():
+        children.setdefault(ppid, []).append(child)
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        if current in table:
+            total += table[current][3]
+        pending.extend(children.get(current, []))
+    return total
+
+def cgroupOomKills():
+    """ count of OOM kills in this process's cgroup (v2 memory.events, or v1 memory.oom_control), or None """
+    for path in ("/sys/fs/cgroup/memory.events", "/sys/fs/cgroup/memory/memory.oom_control"):
+        try:
+            with open(path) as IN:
+                for line in IN:
+                    if line.startswith("oom_kill "):
+                        return int(line.split()[1])
+        except (IOError, OSError, ValueError):
+            pass
+    return None
+
+def logTail(path):
+    try:
+        with open(path, 'rb') as IN:
+            IN.seek(max(0, os.path.getsize(path) - LOG_TAIL_BYTES))
+            return IN.read().decode(errors='replace')
+    except (IOError, OSError):
+        return ""
+
+class MemoryWatchdog:
+    LOG = sys.stderr
+
+    def __init__(self, limit_gb, log=None, interval=SAMPLE_SECONDS):
+        self.limit_gb = limit_gb
+        self.log = log or MemoryWatchdog.LOG
+        self.interval = interval
+        self.peak_gb = 0
+        self.exceeded = False
+        self.oom_kills = None
+
+    async def watch(self, proc, runner):
+        """ sample the tree of proc until it exits; stop it through runner if it exceeds the limit """
+        self.oom_kills = cgroupOomKills()
+        while proc.returncode is None:
+            await asyncio.sleep(self.interval)
+            rss_gb = treeRss(proc.pid) / 1024**3
+            self.peak_gb = max(self.peak_gb, rss_gb)
+            if self.limit_gb and rss_gb > self.limit_gb and proc.returncode is None:
+                self.exceeded = True
+                self.log.write("process tree of pid {} uses {:.1f} GB, over its {:.1f} GB, stopping it\n".format(proc.pid, rss_gb, self.limit_gb))
+                await runner.terminate(proc)
+                return
+
+    def classify(self, result, log_files=()):
+        """ 'memory' if result (a RunResult of the watched run) failed for lack of memory, else 'failed' """
+        if self.exceeded:
+            return 'memory'
+        if result.timed_out: # its SIGKILL came from the time limit
+            return 'failed'
+        oom_kills = cgroupOomKills()
+        if self.oom_kills is not None and oom_kills is not None and oom_kills > self.oom_kills:
+            return 'memory'
+        if result.returncode in (-9, 137):
+            return 'memory'
+        if self.limit_gb and self.peak_gb > NEAR_LIMIT * self.limit_gb:
+            return 'memory'
+        text = "\n".join(result.stderr_tail) + "".join(logTail(path) for path in log_files)
+        if MEMORY_MESSAGES.search(text):
+            return 'memory'
+        return 'failed'
+
+    def report(self):
+        return {'memory_limit_gb': round(self.limit_gb, 2) if self.limit_gb else None, 'peak_rss_gb': round(self.peak_gb, 2), 'stopped': self.exceeded}
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Majority-consensus polishing of contigs from short-read alignments, reading samtools mpileup output.
+A low-memory alternative to pilon for small genomes: no JVM, and memory bounded by the window size.
+"""
+import sys
+import subprocess
+import argparse
+import os
+import os.path
+import re
+from collections import Counter
+from time import time
+try:
+    import numpy
+except ImportError:
+    numpy = None # fall back to pure python counting
+
+BASE_INDEX = {'A': 0, 'C': 1, 'G': 2, 'T': 3, '*': 4, '#': 4}
+BASE_CHARS = "ACGT*"
+
+def parsePileupBases(ref_base, bases):
+    """
+    Count one sample's mpileup read-base column.
+    Return ([A, C, G, T, deleted], {inserted_sequence: count}); inserted sequences follow this position.
+    """
+    counts = [0, 0, 0, 0, 0]
+    insertions = Counter()
+    ref_index = BASE_INDEX.get(ref_base, -1)
+    i = 0
+    n = len(bases)
+    while i < n:
+        c = bases[i]
+        if c == '^':
+            i += 2 # skip read-start marker and its mapping quality
+            continue
+        if c in '+-':
+            m = re.match(r"\d+", bases[i+1:])
+            length = int(m.group(0))
+            start = i + 1 + len(m.group(0))
+            if c == '+':
+                insertions[bases[start:start+length].upper()] += 1
+            # deleted bases are reported again as '*' on the following positions
+            i = start + length
+            continue
+        if c in '.,':
+            if ref_index >= 0:
+                counts[ref_index] += 1
+        else:
+            index = BASE_INDEX.get(c.upper(), -1)
+            if index >= 0:
+                counts[index] += 1
+        i += 1
+    return counts, insertions
+
+def readFasta(fastaFile):
+    """ Return list of (id, sequence) in file order. """
+    contigs = []
+    with open(fastaFile) as IN:
+        seq_id = None
+        seq = []
+        for line in IN:
+            if line.startswith(">"):
+                if seq_id:
+                    contigs.append((seq_id, "".join(seq)))
+                seq_id = line[1:].split()[0]
+                seq = []
+            else:
+                seq.append(line.strip())
+        if seq_id:
+            contigs.append((seq_id, "".join(seq)))
+    return contigs
+
+class PileupPolisher:
+    """
+    Stream samtools mpileup over sorted bams and call a majority consensus at each covered position.
+    A base, deletion or insertion replaces the contig sequence when it has at least MIN_DEPTH reads
+    and more than MIN_FRACTION of the depth at that position.
+    """
+    LOG = sys.stderr
+    MIN_DEPTH = 5
+    MIN_FRACTION = 0.5
+    WINDOW = 10000 # positions counted together before consensus is called
+    program_version = "pileup-consensus 1.0"
+
+    def __init__(self, contigFile, bamFiles, min_depth=None, min_fraction=None, log=None):
+        self.contigFile = contigFile
+        self.log = log or PileupPolisher.LOG
+        self.bamFiles = list(bamFiles)
+        self.min_depth = min_depth or PileupPolisher.MIN_DEPTH
+        self.min_fraction = min_fraction or PileupPolisher.MIN_FRACTION
+        self.changes = {} # contig id -> list of (position, kind, old, new); position is 1-based
+        self.positions_examined = 0
+        self.seconds = 0
+
+    def callWindow(self, contig, positions, ref_bases, counts, insertions):
+        """ Record consensus changes for one window of pileup rows. """
+        changes = self.changes.setdefault(contig, [])
+        if numpy is not None:
+            table = numpy.array(counts, dtype=numpy.int32)
+            depth = table.sum(axis=1)
+            best = table.argmax(axis=1)
+            best_count = table.max(axis=1)
+            ref_index = numpy.array([BASE_INDEX.get(b, -1) for b in ref_bases])
+            called = (depth >= self.min_depth) & (best_count > self.min_fraction * depth) & (best != ref_index)
+            changed_rows = numpy.nonzero(called)[0].tolist()
+            best = best.tolist()
+        else:
+            changed_rows = []
+            best = []
+            for row, row_counts in enumerate(counts):
+                depth = sum(row_counts)
+                best_count = max(row_counts)
+                best_index = row_counts.index(best_count)
+                best.append(best_index)
+                if depth >= self.min_depth and best_count > self.min_fraction * depth and best_index != BASE_INDEX.get(ref_bases[row], -1):
+                    changed_rows.append(row)
+        called_rows = set(changed_rows)
+        for row in sorted(called_rows.union(insertions)):
+            if row in called_rows:
+                new_base = BASE_CHARS[best[row]]
+                if new_base == '*':
+                    changes.append((positions[row], 'deletion', ref_bases[row], ''))
+                else:
+                    changes.append((positions[row], 'substitution', ref_bases[row], new_base))
+            if row in insertions:
+                depth = sum(counts[row])
+                sequence, count = insertions[row].most_common(1)[0]
+                if depth >= self.min_depth and count > self.min_fraction * depth:
+                    changes.append((positions[row], 'insertion', '', sequence))
+
+    def runPileup(self):
+        """ Run samtools mpileup over all bams and collect changes window by window. Return samtools return code. """
+        command = ["samtools", "mpileup", "-B", "-A", "-d", "0", "-f", self.contigFile] + self.bamFiles
+        self.log.write(" ".join(command)+"\n")
+        start_time = time()
+        proc = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        contig = None
+        positions, ref_bases, counts, insertions = [], [], [], {}
+        for line in proc.stdout:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] != contig or len(positions) >= PileupPolisher.WINDOW:
+                if positions:
+                    self.callWindow(contig, positions, ref_bases, counts, insertions)
+                contig = fields[0]
+                positions, ref_bases, counts, insertions = [], [], [], {}
+            ref_base = fields[2].upper()
+            row_counts = [0, 0, 0, 0, 0]
+            row_insertions = Counter()
+            for sample in range(3, len(fields) - 2, 3): # depth, bases, qualities per bam
+                sample_counts, sample_insertions = parsePileupBases(ref_base, fields[sample+1])
+                for i in range(5):
+                    row_counts[i] += sample_counts[i]
+                row_insertions.update(sample_insertions)
+            if row_insertions:
+                insertions[len(positions)] = row_insertions
+            positions.append(int(fields[1]))
+            ref_bases.append(ref_base)
+            counts.append(row_counts)
+            self.positions_examined += 1
+        if positions:
+            self.callWindow(contig, positions, ref_bases, counts, insertions)
+        return_code = proc.wait()
+        self.seconds = time() - start_time
+        return return_code
+
+    def polish(self, outPrefix):
+        """
+        Write polished contigs to outPrefix.fasta (ids get a _pilon suffix, as pilon does) and
+        the changes to outPrefix.changes in pilon's format. Return number of changes, or None on failure.
+        """
+        return_code = self.runPileup()
+        if return_code != 0:
+            self.log.write("samtools mpileup returned {}\n".format(return_code))
+            return None
+        num_changes = 0
+        with open(outPrefix+".fasta", 'w') as OUT, open(outPrefix+".changes", 'w') as CHANGES:
+            for contig, sequence in readFasta(self.contigFile):
+                new_contig = contig+"_pilon"
+                pieces = []
+                last = 0 # 0-based end of sequence copied so far
+                offset = 0 # new position minus old position
+                contig_changes = self.mergeDeletions(self.changes.get(contig, []))
+                for position, kind, old, new in contig_changes:
+                    if kind == 'insertion':
+                        pieces.append(sequence[last:position])
+                        pieces.append(new)
+                        last = position
+                        CHANGES.write("{}:{} {}:{}-{} . {}\n".format(contig, position+1, new_contig, position+1+offset, position+offset+len(new), new))
+                        offset += len(new)
+                    elif kind == 'deletion':
+                        pieces.append(sequence[last:position-1])
+                        last = position - 1 + len(old)
+                        CHANGES.write("{}:{}-{} {}:{} {} .\n".format(contig, position, position+len(old)-1, new_contig, position+offset, old))
+                        offset -= len(old)
+                    else:
+                        pieces.append(sequence[last:position-1])
+                        pieces.append(new)
+                        last = position
+                        CHANGES.write("{}:{} {}:{} {} {}\n".format(contig, position, new_contig, position+offset, old, new))
+                    num_changes += 1
+                pieces.append(sequence[last:])
+                new_sequence = "".join(pieces)
+                OUT.write(">{}\n".format(new_contig))
+                for i in range(0, len(new_sequence), 60):
+                    OUT.write(new_sequence[i:i+60]+"\n")
+        self.log.write("pileup polish: {} positions examined, {} changes, {:.1f} seconds\n".format(self.positions_examined, num_changes, self.seconds))
+        return num_changes
+
+    @staticmethod
+    def mergeDeletions(changes):
+        """ Join deletions of consecutive bases into one change. """
+        merged = []
+        for change in changes:
+            if merged and change[1] == 'deletion' and merged[-1][1] == 'deletion' and merged[-1][0] + len(merged[-1][2]) == change[0]:
+                previous = merged.pop()
+                change = (previous[0], 'deletion', previous[2]+change[2], '')
+            merged.append(change)
+        return merged
+
+def main():
+    parser = argparse.ArgumentParser(description="Polish contigs by majority consensus of short-read pileup", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--genome', required=True, help='contigs fasta the bams were aligned to')
+    parser.add_argument('--bam', nargs='+', required=True, help='sorted, indexed bam files')
+    parser.add_argument('--output', required=True, help='prefix for .fasta and .changes output')
+    parser.add_argument('--min_depth', type=int, default=PileupPolisher.MIN_DEPTH)
+    parser.add_argument('--min_fraction', type=float, default=PileupPolisher.MIN_FRACTION)
+    args = parser.parse_args()
+    polisher = PileupPolisher(args.genome, args.bam, min_depth=args.min_depth, min_fraction=args.min_fraction)
+    num_changes = polisher.polish(args.output)
+    if num_changes is None:
+        sys.exit(1)
+    print("{} changes".format(num_changes))
+
+if __name__ == "__main__":
+    main()
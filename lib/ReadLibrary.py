@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 import sys
-import subprocess
 import argparse
 import gzip
 import bz2
@@ -11,6 +10,7 @@ import glob
 import shutil
 import copy
 from time import time, localtime, strftime, sleep
+from RunContext import RunContext
 
 def inferPlatform(read_id, maxReadLength, avgReadQuality):
     """ 
@@ -83,19 +83,22 @@ def findSingleDifference(s1, s2):
 
 class ReadLibrary:
     # representation of read set, with specific versions included within (e.g., trimmed version)
-    MEMORY = '5gb'
     MAX_SHORT_READ_LENGTH = 999
-    NUM_THREADS = 4
     MAX_BASES=1e9
-    LOG = sys.stderr
     bytes_to_sample = 20000
-    program_version = {} # keep track of what software we run and the version
 
-    def __init__(self, file_names, platform=None, work_dir=None, interleaved=False):
+    def lease(self, tool):
+        """ threads and memory for tool, from the job's ResourceManager """
+        return self.context.resources.lease(tool)
+
+    def __init__(self, file_names, platform=None, work_dir=None, interleaved=False, context=None):
         """
         create a read_set object
+        files are symlinked into work_dir if given; processed versions are written to the context's work directory
+        (the current directory, without a context); all file names are kept as absolute paths
         """
-        ReadLibrary.LOG.write("ReadLibrary( %s, platform=%s, interleaved=%s\n"%(file_names, str(platform), str(interleaved)))
+        self.context = context or RunContext(work_dir or os.getcwd())
+        self.context.log.write("ReadLibrary( %s, platform=%s, interleaved=%s\n"%(file_names, str(platform), str(interleaved)))
 
         self.num_reads = 0
         self.problem = []
@@ -115,13 +118,13 @@ class ReadLibrary:
         self.versions = []
         self.files = []
         input_files = []
-        ReadLibrary.LOG.write("read files passed to constructor: {}, type={}\n".format(file_names, type(file_names)))
+        self.context.log.write("read files passed to constructor: {}, type={}\n".format(file_names, type(file_names)))
         if type(file_names) is str:
             input_files.append(file_names)
-            ReadLibrary.LOG.write("single-end\n")
+            self.context.log.write("single-end\n")
         else: # an array of strings
             input_files.extend(file_names)
-            ReadLibrary.LOG.write("paired-end\n")
+            self.context.log.write("paired-end\n")
         self.files = [0]*len(input_files)
         self.file_size = [0]*len(input_files)
         for i, read_file in enumerate(input_files):
@@ -129,20 +132,46 @@ class ReadLibrary:
                 self.file_size[i] = os.path.getsize(read_file)
                 if work_dir: # symlink files to where work will be performed
                     dir_name, file_base = os.path.split(read_file)
-                    self.files[i] = file_base
-                    ReadLibrary.LOG.write("symlinking %s to %s\n"%(os.path.abspath(read_file), os.path.join(work_dir, file_base)))
+                    work_dir = os.path.abspath(work_dir)
+                    self.files[i] = os.path.join(work_dir, file_base)
+                    self.context.log.write("symlinking %s to %s\n"%(os.path.abspath(read_file), os.path.join(work_dir, file_base)))
                     if os.path.exists(os.path.join(work_dir,file_base)):
-                        ReadLibrary.LOG.write("first deleting file {}\n".format(os.path.join(work_dir,file_base)))
+                        self.context.log.write("first deleting file {}\n".format(os.path.join(work_dir,file_base)))
                         os.remove(os.path.join(work_dir,file_base))
                     os.symlink(os.path.abspath(read_file), os.path.join(work_dir,file_base))
+                else:
+                    self.files[i] = os.path.abspath(read_file)
             else:
                 comment = "file does not exist: %s\n"%read_file
-                ReadLibrary.LOG.write(comment)
+                self.context.log.write(comment)
                 comment = "self.files = {}\n".format(self.files)
-                ReadLibrary.LOG.write(comment)
+                self.context.log.write(comment)
                 self.problem.append(comment)
                 raise Exception(comment)
 
+    def to_dict(self):
+        """ json-serializable state, including earlier versions, for from_dict() """
+        state = {key: value for key, value in vars(self).items() if key not in ('versions', 'context')}
+        state['versions'] = [version.to_dict() for version in self.versions]
+        return state
+
+    @classmethod
+    def from_dict(cls, state, context=None):
+        """ rebuild a read set saved by to_dict() without re-reading its files """
+        read_set = cls.__new__(cls)
+        read_set.__dict__.update(state)
+        read_set.context = context or RunContext(os.getcwd())
+        read_set.versions = [cls.from_dict(version, read_set.context) for version in state.get('versions', [])]
+        return read_set
+
+    def __deepcopy__(self, memo):
+        """ copies share the context (its log, locks and budget belong to the job) """
+        copied = self.__class__.__new__(self.__class__)
+        memo[id(self)] = copied
+        for key, value in vars(self).items():
+            setattr(copied, key, value if key == 'context' else copy.deepcopy(value, memo))
+        return copied
+
     def store_current_version(self):
         print("store_current_version: self={}, s.v={}".format(self, self.versions))
         current_version = copy.deepcopy(self)
@@ -150,59 +179,55 @@ class ReadLibrary:
         print("cv={}, s.v={}".format(current_version, self.versions))
 
     def bunzip_reads(self):
-        ReadLibrary.LOG.write("bunzip_reads()\n")
+        self.context.log.write("bunzip_reads()\n")
         self.store_current_version()
         self.transformation="bunzip2"
         startTime = time()
         for i, read_file in enumerate(self.files):
             if read_file.endswith('.bz2'):
                 uncompressed_file = read_file[:-4] # trim off '.bz2''
-                uncompressed_file = os.path.basename(uncompressed_file) # will write to current working directory
+                uncompressed_file = self.context.path(os.path.basename(uncompressed_file))
                 self.files[i] = uncompressed_file
                 with open(os.path.join(uncompressed_file), 'wb') as OUT:
                     with open(os.path.join(read_file), 'rb') as IN:
                         OUT.write(bz2.decompress(IN.read()))
                 comment = "decompressing bz2 file %s to %s"%(read_file, uncompressed_file)
-                ReadLibrary.LOG.write(comment+"\n")
+                self.context.log.write(comment+"\n")
                 self.file_size[i] = os.path.getsize(uncompressed_file)
             else:
                 comment = "file {} does not end in '.bz2', not decompressing."
-                ReadLibrary.LOG.write(comment)
+                self.context.log.write(comment)
                 self.transformation = comment
 
         self.command = "python bz2.decompress()"
         self.processing_time = time() - startTime
-        ReadLibrary.LOG.write("bunzip_reads duration: {}\n".format(self.processing_time))
+        self.context.log.write("bunzip_reads duration: {}\n".format(self.processing_time))
         return
 
     def trim_short_reads(self):
         startTime = time()
-        ReadLibrary.LOG.write("trim_short_reads()\n")
+        self.context.log.write("trim_short_reads()\n")
 
-        command = ["trim_galore", "--version"]
-        proc = subprocess.run(command, shell=False, capture_output=True, text=True)
-        version_text = proc.stdout.strip()
-        m = re.search(r"(version\s+\S+)", version_text)
-        if m:
-            trim_galore_version = "trim_galore " + m.group(1)
-            ReadLibrary.program_version['trim_galore'] = trim_galore_version
+        trim_galore_version = self.context.tools.version("trim_galore")
+        if trim_galore_version:
+            self.context.versions['trim_galore'] = "trim_galore " + trim_galore_version
 
         self.problem = []
-        read_file_base = re.sub("(.*?)\..*", "\\1", self.files[0])
-        read_file_base = re.sub("(.*)_R[12].*", "\\1", read_file_base)
+        read_file_base = re.sub("(.*?)\..*", "\\1", os.path.basename(self.files[0]))
+        read_file_base = self.context.path(re.sub("(.*)_R[12].*", "\\1", read_file_base))
         trim_directory = read_file_base + "_trim_dir"
-        command = ['trim_galore', '-j', str(ReadLibrary.NUM_THREADS), '-o', trim_directory]
+        lease = self.lease('trim_galore')
+        command = ['trim_galore'] + lease.flags() + ['-o', trim_directory]
         if len(self.files) > 1:
             command.extend(["--paired", self.files[0], self.files[1]])
         else:
             command.append(self.files[0])
 
-        ReadLibrary.LOG.write("command: "+" ".join(command)+"\n")
+        self.context.log.write("command: "+" ".join(command)+"\n")
         self.command = command
-        proc = subprocess.Popen(command, shell=False, stderr=subprocess.PIPE, text=True)
-        trimGaloreStderr = proc.stderr.read()
-        return_code = proc.wait()
-        ReadLibrary.LOG.write("return code = %d\n"%return_code)
+        return_code = self.context.runner.call(command)
+        lease.release()
+        self.context.log.write("return code = %d\n"%return_code)
         trimReads = glob.glob(trim_directory + "/*val_?.fq")
         if not trimReads:
             trimReads = glob.glob(trim_directory + "/*fq")
@@ -212,7 +237,7 @@ class ReadLibrary:
             print("trimmed reads = "+str(trimReads))
             self.store_current_version()
             for i, read_file in enumerate(trimReads):
-                new_read_file = os.path.basename(read_file)
+                new_read_file = self.context.path(os.path.basename(read_file))
                 shutil.move(read_file, new_read_file)
                 self.file_size[i] = os.path.getsize(new_read_file)
                 self.files[i] = new_read_file
@@ -230,12 +255,12 @@ class ReadLibrary:
                 self.trim_report = new_report_file
         else:
             comment = "trim_galore did not generate trimmed reads"
-            ReadLibrary.LOG.write(comment+"\n")
+            self.context.log.write(comment+"\n")
             self.problem.append(comment)
 
 
         self.processing_time = time() - startTime
-        ReadLibrary.LOG.write("trim_short_reads duration: {}\n".format(self.processing_time))
+        self.context.log.write("trim_short_reads duration: {}\n".format(self.processing_time))
         return
 
     def saveTrimReport(self, save_dir):
@@ -251,7 +276,7 @@ class ReadLibrary:
         If paired, read both files.  
         """
         startTime = time()
-        ReadLibrary.LOG.write("\nstart study_reads()\n")
+        self.context.log.write("\nstart study_reads()\n")
         # see if we need to handle bz2 compression - some programs cannot handle it
         if self.files[0].endswith(".bz2"):
             self.bunzip_reads()
@@ -262,14 +287,14 @@ class ReadLibrary:
         self.num_reads = 0
         self.num_bases = 0
         self.problem = []
-        ReadLibrary.LOG.write("file(s): "+':'.join(self.files)+"\n")
+        self.context.log.write("file(s): "+':'.join(self.files)+"\n")
 
         file1 = self.files[0]
         file2 = None
         if not os.path.exists(file1):
             print("file {} does not exist".format(file1))
-            print("cur dir = {}".format(os.getcwd()))
-            print("dir listing: {}".format(os.listdir('.')))
+            print("work dir = {}".format(self.context.work_dir))
+            print("dir listing: {}".format(os.listdir(self.context.work_dir)))
             raise Exception("file {} does not exist".format(file1))
         self.file_size[0] = os.path.getsize(file1)
         if len(self.files) > 1:
@@ -292,7 +317,7 @@ class ReadLibrary:
                 F2 = open(file2, 'rt')
 
         line = str(F1.readline().rstrip())
-        ReadLibrary.LOG.write("in study_reads, first line of {} is {}\n".format(file1, line))
+        self.context.log.write("in study_reads, first line of {} is {}\n".format(file1, line))
         sample_read_id = line.split(' ')[0]
         F1.seek(0)
 
@@ -308,7 +333,7 @@ class ReadLibrary:
         seqLen = 0
 
         if sample_read_id.startswith('>'):
-            ReadLibrary.LOG.write("read ID starts with >: "+sample_read_id)
+            self.context.log.write("read ID starts with >: "+sample_read_id)
             self.format = 'fasta'
 
             for line in F1:
@@ -327,7 +352,7 @@ class ReadLibrary:
                     line2 = F2.readline()
                     if not line2:
                         comment = "Number of reads differs between {} and {} after {}".format(file1, file2, readNumber)
-                        ReadLibrary.LOG.write(comment+"\n")
+                        self.context.log.write(comment+"\n")
                         self.problem.append(comment)
                         break
                     if False and i % 4 == 0 and read_ids_paired:
@@ -355,8 +380,8 @@ class ReadLibrary:
                         sumQuality += ord(qual) - 33
                         numQualityPositionsSampled += 1
                 if False and readNumber % 100000 == 0:
-                    ReadLibrary.LOG.write("number of reads and bases studied so far: \t{}\t{}\n".format(readNumber, totalReadLength))
-                    ReadLibrary.LOG.flush()
+                    self.context.log.write("number of reads and bases studied so far: \t{}\t{}\n".format(readNumber, totalReadLength))
+                    self.context.log.flush()
 
         F1.close()
         if file2:
@@ -370,7 +395,9 @@ class ReadLibrary:
         avgReadQuality = 0
         if numQualityPositionsSampled:
             avgReadQuality = sumQuality / float(numQualityPositionsSampled)
-        ReadLibrary.LOG.write("avgReadLength={}, avgReadQuality={}, maxLength={}, numReads={}, numBases={}\n".format(avgReadLength, avgReadQuality, maxReadLength, readNumber, totalReadLength))
+        self.context.log.write("avgReadLength={}, avgReadQuality={}, maxLength={}, numReads={}, numBases={}\n".format(avgReadLength, avgReadQuality, maxReadLength, readNumber, totalReadLength))
+        self.context.events.counters('study_reads', time() - startTime, records=readNumber, bytes_in=sum(self.file_size[:len(self.files)]),
+                bases=totalReadLength, format=self.format, files=self.files)
         self.avg_length = avgReadLength
         self.max_read_len = maxReadLength
         self.num_reads = readNumber
@@ -379,18 +406,18 @@ class ReadLibrary:
         self.avg_quality = avgReadQuality 
 
         if not self.platform in ('illumina', 'iontorrent', 'nanopore', 'pacbio'):
-            ReadLibrary.LOG.write("platform = {}, need to inferPlatform\n".format(self.platform))
+            self.context.log.write("platform = {}, need to inferPlatform\n".format(self.platform))
             platform = inferPlatform(sample_read_id, maxReadLength, avgReadQuality)
             self.platform = platform
-            ReadLibrary.LOG.write("platform inferred to be {}\n".format(platform))
+            self.context.log.write("platform inferred to be {}\n".format(platform))
 
         self.length_class = ["short", "long"][maxReadLength >= ReadLibrary.MAX_SHORT_READ_LENGTH]
         if file2 and maxReadLength >= ReadLibrary.MAX_SHORT_READ_LENGTH:
             comment = "paired reads appear to be long, expected short: {}".format(",".join(self.files))
-            ReadLibrary.LOG.write(comment+"\n")
+            self.context.log.write(comment+"\n")
             self.problem.append(comment)
-        ReadLibrary.LOG.write("analysis of {} shows read_number = {} and total_bases = {}\n".format(":".join(self.files), readNumber, totalReadLength))
-        ReadLibrary.LOG.write("duration of study_reads was %d seconds\n"%(time() - startTime))
+        self.context.log.write("analysis of {} shows read_number = {} and total_bases = {}\n".format(":".join(self.files), readNumber, totalReadLength))
+        self.context.log.write("duration of study_reads was %d seconds\n"%(time() - startTime))
 
         return
 
@@ -398,28 +425,28 @@ class ReadLibrary:
         #use BBNorm
         startTime = time()
         comment = "normalize read depth using BBNorm"
-        ReadLibrary.LOG.write(comment+"\n")
+        self.context.log.write(comment+"\n")
 
         file1 = self.files[0]
-        out_file1 = os.path.basename(file1) # will write to current working directory
+        out_file1 = self.context.path(os.path.basename(file1)) # will write to the work directory
         file2 = None
         if len(self.files) > 1:
             file2 = self.files[1]
-            out_file2 = os.path.basename(file2) # will write to current working directory
+            out_file2 = self.context.path(os.path.basename(file2))
         suffix = "_normalized.fastq"
 
-        if file1.endswith("gz"):
-            out_file1 = file1[:-3]
-            if file2 and file2.endswith("gz"):
-                out_file2 = file2[:-3]
-        if file1.endswith(".fq"):
-            out_file1 = file1[:-3]
-            if file2 and file2.endswith(".fq"):
-                out_file2 = file2[:-3]
-        if file1.endswith(".fastq"):
-            out_file1 = file1[:-6]
-            if file2 and file2.endswith(".fastq"):
-                out_file2 = file2[:-6]
+        if out_file1.endswith("gz"):
+            out_file1 = out_file1[:-3]
+            if file2 and out_file2.endswith("gz"):
+                out_file2 = out_file2[:-3]
+        if out_file1.endswith(".fq"):
+            out_file1 = out_file1[:-3]
+            if file2 and out_file2.endswith(".fq"):
+                out_file2 = out_file2[:-3]
+        if out_file1.endswith(".fastq"):
+            out_file1 = out_file1[:-6]
+            if file2 and out_file2.endswith(".fastq"):
+                out_file2 = out_file2[:-6]
         bbnorm_stdout = out_file1 + "_bbnorm_stats.txt"
         out_file1 = out_file1 + suffix
         if file2:
@@ -429,12 +456,13 @@ class ReadLibrary:
         command = ['bbnorm.sh', 'in='+file1, 'out='+out_file1]
         if file2:
             command.extend(('in2='+file2, 'out2='+out_file2))
-        command.extend(['threads={}'.format(ReadLibrary.NUM_THREADS), '-Xmx{:.0f}g'.format(ReadLibrary.MEMORY * 0.85)])
+        lease = self.lease('bbnorm')
+        command.extend(lease.flags())
 
-        ReadLibrary.LOG.write("normalize, command line = "+" ".join(command)+"\n")
+        self.context.log.write("normalize, command line = "+" ".join(command)+"\n")
         self.command = " ".join(command)
-        proc = subprocess.Popen(command, shell=False, stderr=bbnorm_fh)
-        proc.wait()
+        self.context.runner.call(command, stderr=bbnorm_fh)
+        lease.release()
         bbnorm_fh.close()
 
         if os.path.exists(out_file1) and os.path.getsize(out_file1) > 0:
@@ -448,20 +476,16 @@ class ReadLibrary:
             self.transformation=comment
             self.process_time = time() - startTime
 
-            proc = subprocess.run("bbnorm.sh", capture_output=True, text=True)
-            for line in proc.stdout.split("\n"):
-                m = re.match("Last modified\s*(\S.*\S)", line)
-                if m:
-                    bbnorm_version = m.group(1)
-                    ReadLibrary.program_version['bbnorm'] = bbnorm_version
-                    break
+            bbnorm_version = self.context.tools.version("bbnorm.sh")
+            if bbnorm_version:
+                self.context.versions['bbnorm'] = bbnorm_version
 
         else:
             # keep current, unnormalized, version
-            ReadLibrary.LOG.write("bbnorm failed to normalize\n")
+            self.context.log.write("bbnorm failed to normalize\n")
             
 
-        ReadLibrary.LOG.write("normalize process time: {}\n".format(time() - startTime))
+        self.context.log.write("normalize process time: {}\n".format(time() - startTime))
         return
 
     def down_sample_reads(self, max_bases=0):
@@ -469,24 +493,25 @@ class ReadLibrary:
         read file over size limit, down-sample using seqtk
         """
         startTime = time()
-        ReadLibrary.LOG.write("down_sample_reads()\n")
+        self.context.log.write("down_sample_reads()\n")
         self.store_current_version()
 
         if not max_bases:
-            max_bases = MAX_BASES
+            max_bases = ReadLibrary.MAX_BASES
         prop_to_sample = float(max_bases) / self.num_bases
         if prop_to_sample > 1:
-            ReadLibrary.LOG.write("down_sample_reads calculated prop_to_sample to be over 1 ({})".format(prop_to_sample))
+            self.context.log.write("down_sample_reads calculated prop_to_sample to be over 1 ({})".format(prop_to_sample))
             return
         comment = "down-sample by {:.3f}X to approximately {} bases".format(prop_to_sample, max_bases)
         self.transformation = comment
         self.command = ''
-        ReadLibrary.LOG.write(comment+"\n")
-        ReadLibrary.LOG.write("files = "+", ".join(self.files)+"\n")
+        self.context.log.write(comment+"\n")
+        self.context.log.write("files = "+", ".join(self.files)+"\n")
         
         suffix = "_sampled.fq"
+        bytes_in = 0
         for i, read_file in enumerate(self.files):
-            out_file = os.path.basename(read_file) # will write to current working directory
+            out_file = self.context.path(os.path.basename(read_file)) # will write to the work directory
             if out_file.endswith("gz"):
                 out_file = out_file[:-3]
             if out_file.endswith(".fq"):
@@ -497,27 +522,25 @@ class ReadLibrary:
 
             self.files[i] = out_file
             
+            bytes_in += os.path.getsize(read_file)
             out_fh = open(out_file, 'w')
             command = ['seqtk', 'sample', read_file, '{:.3f}'.format(prop_to_sample)] 
-            ReadLibrary.LOG.write("downsample, command line = "+" ".join(command)+"\n")
+            self.context.log.write("downsample, command line = "+" ".join(command)+"\n")
             self.command = " ".join(command)+"\n"
-            proc = subprocess.Popen(command, shell=False, stdout=out_fh)
-            proc.wait()
+            self.context.runner.call(command, stdout=out_fh)
             out_fh.close()
             self.file_size[i] = os.path.getsize(out_file)
 
-        proc = subprocess.run("seqtk", capture_output=True, text=True)
-        for line in proc.stderr.split("\n"):
-            m = re.match("Version:\s*(\S.*\S)", line)
-            if m:
-                seqtk_version = m.group(1)
-                ReadLibrary.program_version['seqtk'] = seqtk_version
-                break
+        seqtk_version = self.context.tools.version("seqtk")
+        if seqtk_version:
+            self.context.versions['seqtk'] = seqtk_version
 
-        ReadLibrary.LOG.write("after: files = "+", ".join(self.files)+"\n")
+        self.context.log.write("after: files = "+", ".join(self.files)+"\n")
         self.process_time = time() - startTime
         self.study_reads()    
-        ReadLibrary.LOG.write("duration of down_sample_reads and study_reads: %d seconds\n"%(time() - startTime))
+        self.context.events.counters('down_sample_reads', self.process_time, records=self.num_reads, bytes_in=bytes_in,
+                bytes_out=sum(self.file_size[:len(self.files)]), fraction=prop_to_sample)
+        self.context.log.write("duration of down_sample_reads and study_reads: %d seconds\n"%(time() - startTime))
         return
     
     def writeHtmlSection(self, HTML):
@@ -538,7 +561,7 @@ class ReadLibrary:
             print("html for {}".format(read_version))
             HTML.write("<tr><td>{}</td>".format(i))
             HTML.write("<td>{}</td>".format(read_version.transformation))
-            HTML.write("<td>{}</td>".format(" ".join(read_version.files)))
+            HTML.write("<td>{}</td>".format(" ".join(os.path.basename(read_file) for read_file in read_version.files)))
             HTML.write("<td>{}</td>".format(read_version.num_reads))
             HTML.write("<td>{:.2f}</td>".format(read_version.num_bases / 1e6))
             HTML.write("<td>{:.1f}</td>".format(read_version.avg_length))
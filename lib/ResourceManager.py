@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+CPU and memory budget for the external tools of an assembly job.
+The budget is the smallest of what the job was asked to use, the P3_ALLOCATED_CPU / P3_ALLOCATED_MEMORY
+environment (set by the scheduler), the cgroup limits and the machine itself.
+Tools take leases of threads and memory from it, so concurrent stages never oversubscribe,
+and each lease is written out in the flag conventions of the tool it is for.
+A ResourceBroker shares one budget between the jobs of a batch, which lease through a RemoteResourceManager.
+"""
+import sys
+import os
+import os.path
+import re
+import threading
+import json
+import socket
+from time import time
+
+def parseMemory(text):
+    """ bytes in a memory size such as '128G', '500m' or '1073741824' (P3_ALLOCATED_MEMORY convention: k, m, g, t are powers of 1024) """
+    m = re.match(r"^\s*([\d.]+)\s*([kmgt]?)b?\s*$", str(text), re.IGNORECASE)
+    if not m:
+        return None
+    factor = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}[m.group(2).lower()]
+    return float(m.group(1)) * factor
+
+def readFirstLine(path):
+    try:
+        with open(path) as IN:
+            return IN.readline().strip()
+    except (IOError, OSError):
+        return None
+
+def cgroupCpuLimit():
+    """ cpus allowed by the cgroup quota (v2 cpu.max or v1 cfs quota), or None if unlimited """
+    line = readFirstLine("/sys/fs/cgroup/cpu.max")
+    if line:
+        quota, period = (line.split() + ['100000'])[:2]
+        if quota != 'max':
+            return float(quota) / float(period)
+        return None
+    quota = readFirstLine("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = readFirstLine("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return float(quota) / float(period)
+    return None
+
+def cgroupMemoryLimit():
+    """ bytes allowed by the cgroup (v2 memory.max or v1 limit_in_bytes), or None if unlimited """
+    line = readFirstLine("/sys/fs/cgroup/memory.max")
+    if line and line != 'max':
+        return float(line)
+    line = readFirstLine("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    if line and float(line) < 2**60: # v1 reports a huge number when unlimited
+        return float(line)
+    return None
+
+def machineMemory():
+    """ bytes of MemTotal from /proc/meminfo """
+    try:
+        with open("/proc/meminfo") as IN:
+            for line in IN:
+                if line.startswith("MemTotal:"):
+                    return float(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+def samtoolsSortMemory(threads, memory_gb):
+    """ samtools sort -m is per thread """
+    return ["-@", str(threads), "-m", "{}M".format(max(100, int(memory_gb * 1024 / threads)))]
+
+# how each tool is told its threads and memory (in GB)
+TOOL_FLAGS = {
+    'spades': lambda threads, memory_gb: ["--threads", str(threads), "-m", str(max(1, int(memory_gb)))],
+    'unicycler': lambda threads, memory_gb: ["-t", str(threads)],
+    'canu': lambda threads, memory_gb: ["maxThreads={}".format(threads), "maxMemory={}".format(max(1, int(memory_gb)))],
+    'flye': lambda threads, memory_gb: ["--threads", str(threads)],
+    'minimap2': lambda threads, memory_gb: ["-t", str(threads)],
+    'racon': lambda threads, memory_gb: ["-t", str(threads)],
+    'bowtie2': lambda threads, memory_gb: ["-p", str(threads)],
+    'bowtie2-build': lambda threads, memory_gb: ["--threads", str(threads)],
+    'samtools': lambda threads, memory_gb: ["-@", str(threads)],
+    'samtools sort': samtoolsSortMemory,
+    'java': lambda threads, memory_gb: ["-Xmx{}G".format(max(1, int(memory_gb)))],
+    'pilon': lambda threads, memory_gb: ["--threads", str(threads)],
+    'bbnorm': lambda threads, memory_gb: ["threads={}".format(threads), "-Xmx{}g".format(max(1, int(memory_gb)))],
+    'trim_galore': lambda threads, memory_gb: ["-j", str(threads)],
+    'quast': lambda threads, memory_gb: ["-t", str(threads)],
+}
+
+class Lease:
+    """ Threads and memory held by one tool run; release() (or leaving a with block) returns them. """
+
+    def __init__(self, manager, name, threads, memory_gb):
+        self.manager = manager
+        self.name = name
+        self.threads = threads
+        self.memory_gb = memory_gb
+        self.start = time()
+        self.end = None
+
+    def flags(self, tool=None):
+        """ command-line flags giving this lease to tool (default: the lease name) """
+        return TOOL_FLAGS[tool or self.name](self.threads, self.memory_gb)
+
+    def release(self):
+        self.manager.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+class ResourceManager:
+    LOG = sys.stderr
+    MEMORY_FRACTION = 0.85 # of the allocation, handed out to tools; the rest covers this process and the page cache
+
+    def __init__(self, threads=None, memory_gb=None, log=None):
+        """ threads and memory_gb are what the job asks for; the allocation found on the system can lower them """
+        self.log = log or ResourceManager.LOG
+        limits = {}
+        if threads:
+            limits['requested'] = threads
+        if os.environ.get('P3_ALLOCATED_CPU'):
+            limits['P3_ALLOCATED_CPU'] = int(os.environ['P3_ALLOCATED_CPU'])
+        cgroup_cpus = cgroupCpuLimit()
+        if cgroup_cpus:
+            limits['cgroup'] = max(1, int(cgroup_cpus))
+        if hasattr(os, 'sched_getaffinity'):
+            limits['affinity'] = len(os.sched_getaffinity(0))
+        else:
+            limits['cpu_count'] = os.cpu_count() or 1
+        self.cpu_source = min(limits, key=limits.get)
+        self.threads = limits[self.cpu_source]
+
+        limits = {}
+        if memory_gb:
+            limits['requested'] = memory_gb * 1024**3
+        if os.environ.get('P3_ALLOCATED_MEMORY') and parseMemory(os.environ['P3_ALLOCATED_MEMORY']):
+            limits['P3_ALLOCATED_MEMORY'] = parseMemory(os.environ['P3_ALLOCATED_MEMORY'])
+        if cgroupMemoryLimit():
+            limits['cgroup'] = cgroupMemoryLimit()
+        if machineMemory():
+            limits['machine'] = machineMemory()
+        self.memory_source = min(limits, key=limits.get) if limits else 'default'
+        allocated = limits[self.memory_source] if limits else 8 * 1024**3
+        self.allocated_memory_gb = allocated / 1024**3
+        self.memory_gb = self.allocated_memory_gb * ResourceManager.MEMORY_FRACTION
+        self.log.write("resources: {} threads (from {}), {:.1f} GB memory of {:.1f} allocated (from {})\n".format(
+            self.threads, self.cpu_source, self.memory_gb, self.allocated_memory_gb, self.memory_source))
+
+        self.free_threads = self.threads
+        self.free_memory_gb = self.memory_gb
+        self.condition = threading.Condition()
+        self.leases = []
+
+    def lease(self, name, threads=None, memory_gb=None):
+        """
+        Take threads and memory_gb for a tool run, waiting until they are free.
+        threads=None means all threads; memory_gb=None means the threads' share of memory.
+        Requests are capped to the budget, so a single lease can always be satisfied.
+        """
+        threads = min(threads or self.threads, self.threads)
+        if memory_gb is None:
+            memory_gb = self.memory_gb * threads / self.threads
+        memory_gb = min(memory_gb, self.memory_gb)
+        with self.condition:
+            waited = False
+            while threads > self.free_threads or memory_gb > self.free_memory_gb + 1e-6:
+                if not waited:
+                    self.log.write("lease {} waiting for {} threads, {:.1f} GB (free: {}, {:.1f} GB)\n".format(
+                        name, threads, memory_gb, self.free_threads, self.free_memory_gb))
+                    waited = True
+                self.condition.wait()
+            self.free_threads -= threads
+            self.free_memory_gb -= memory_gb
+            lease = Lease(self, name, threads, memory_gb)
+            self.leases.append(lease)
+        return lease
+
+    def release(self, lease):
+        with self.condition:
+            if lease.end is None:
+                lease.end = time()
+                self.free_threads += lease.threads
+                self.free_memory_gb += lease.memory_gb
+                self.condition.notify_all()
+
+    def report(self, origin=0):
+        """ budget and lease history for run_details, lease times in seconds since origin """
+        return {'threads': self.threads, 'threads_from': self.cpu_source,
+                'memory_gb': round(self.memory_gb, 2), 'allocated_memory_gb': round(self.allocated_memory_gb, 2), 'memory_from': self.memory_source,
+                'leases': [{'name': lease.name, 'threads': lease.threads, 'memory_gb': round(lease.memory_gb, 2),
+                    'start': round(lease.start - origin, 1), 'end': round(lease.end - origin, 1) if lease.end else None} for lease in self.leases]}
+
+class ResourceBroker:
+    """
+    Serves leases from one ResourceManager to other processes over a unix socket, so several jobs on a node
+    (the samples of a batch) share one budget. Each lease is held by one connection: the client sends
+    a json request line, gets a json reply once the lease is granted, and closing the connection releases it,
+    so the lease of a job that dies is returned too.
+    """
+    LOG = sys.stderr
+
+    def __init__(self, manager, address):
+        self.manager = manager
+        self.address = address
+        if os.path.exists(address):
+            os.remove(address)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(address)
+        self.server.listen(64)
+        self.thread = threading.Thread(target=self.serve, name="resource-broker", daemon=True)
+        self.thread.start()
+        ResourceBroker.LOG.write("resource broker serving {} threads, {:.1f} GB at {}\n".format(manager.threads, manager.memory_gb, address))
+
+    def serve(self):
+        while True:
+            try:
+                connection, client = self.server.accept()
+            except OSError: # closed
+                return
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        with connection, connection.makefile('rw') as STREAM:
+            line = STREAM.readline()
+            if not line:
+                return
+            request = json.loads(line)
+            if request.get('budget'):
+                STREAM.write(json.dumps({'threads': self.manager.threads, 'memory_gb': self.manager.memory_gb,
+                    'allocated_memory_gb': self.manager.allocated_memory_gb})+"\n")
+                STREAM.flush()
+                return
+            lease = self.manager.lease(request['name'], request.get('threads'), request.get('memory_gb'))
+            try:
+                STREAM.write(json.dumps({'threads': lease.threads, 'memory_gb': lease.memory_gb})+"\n")
+                STREAM.flush()
+                STREAM.read() # until the client closes the connection
+            except OSError:
+                pass
+            finally:
+                lease.release()
+
+    def close(self):
+        self.server.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+class RemoteResourceManager(ResourceManager):
+    """ ResourceManager whose leases come from a ResourceBroker shared with other jobs """
+
+    def __init__(self, address, threads=None, memory_gb=None, log=None):
+        """ threads and memory_gb cap what this job takes at once; the broker's budget caps all jobs together """
+        self.log = log or ResourceManager.LOG
+        self.address = address
+        budget = self.request({'budget': True})
+        self.cpu_source = self.memory_source = 'broker'
+        self.threads = min(threads or budget['threads'], budget['threads'])
+        self.allocated_memory_gb = min(memory_gb or budget['allocated_memory_gb'], budget['allocated_memory_gb'])
+        self.memory_gb = min(self.allocated_memory_gb * ResourceManager.MEMORY_FRACTION, budget['memory_gb'])
+        self.log.write("resources: up to {} threads, {:.1f} GB memory of {} threads, {:.1f} GB shared through broker {}\n".format(
+            self.threads, self.memory_gb, budget['threads'], budget['memory_gb'], address))
+        self.free_threads = self.threads
+        self.free_memory_gb = self.memory_gb
+        self.condition = threading.Condition()
+        self.leases = []
+
+    def request(self, message):
+        """ send message on a new connection; return (reply, connection) for leases, the reply otherwise """
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.address)
+        connection.sendall((json.dumps(message)+"\n").encode())
+        STREAM = connection.makefile('r')
+        reply = json.loads(STREAM.readline())
+        STREAM.close()
+        if message.get('budget'):
+            connection.close()
+            return reply
+        return reply, connection
+
+    def lease(self, name, threads=None, memory_gb=None):
+        """ as ResourceManager.lease: first within this job's own threads and memory, then waiting for the broker to grant it """
+        lease = ResourceManager.lease(self, name, threads, memory_gb)
+        start_time = time()
+        try:
+            reply, lease.connection = self.request({'name': name, 'threads': lease.threads, 'memory_gb': lease.memory_gb})
+        except:
+            ResourceManager.release(self, lease)
+            raise
+        if time() - start_time > 1:
+            self.log.write("lease {} granted by broker after {:.0f} seconds\n".format(name, time() - start_time))
+        return lease
+
+    def release(self, lease):
+        if lease.end is None:
+            lease.connection.close()
+        ResourceManager.release(self, lease)
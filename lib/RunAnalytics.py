@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""
+Resource models of assembly jobs fitted to the history of earlier runs, for sizing requests in the preflight.
+Samples come from run_details.json files (their 'job' summary, telemetry and resources) and from the
+scheduler accounting tables written by service-scripts/analyze-assembly-data*.pl
+(id, owner, bases, elapsed H:M:S, maxrss, then the assembler or the time and input sizes).
+For each recipe, log runtime, peak memory, scratch storage and CPU use are fitted by least squares
+as linear functions of log bases, log mean read length, platform and the trim and normalize flags;
+recipes with too few runs fall back to the model fitted to all runs.
+Predictions are taken at an upper quantile of the residuals, so most jobs fit within what is requested.
+"""
+import sys
+import os
+import os.path
+import re
+import json
+import math
+from statistics import NormalDist
+
+TARGETS = ('runtime_seconds', 'peak_memory_gb', 'scratch_gb', 'cpu')
+FEATURES = ('log_bases', 'log_read_length', 'long_reads', 'short_reads', 'trim', 'normalize')
+MIN_SAMPLES = 8 # fewer runs of a recipe than this use the model fitted to all runs
+RIDGE = 1e-3 # keeps the fit defined when a feature does not vary
+LONG_READ_PLATFORMS = ('nanopore', 'pacbio')
+ASSEMBLER_RECIPES = {'spades': 'spades', 'unicycler': 'unicycler', 'canu': 'canu', 'flye': 'flye'}
+# to estimate bases from file sizes, when only those are known (fastq: about 2 bytes per base, gzip about 3.5x smaller)
+BASES_PER_BYTE = {'compressed': 1.7, 'uncompressed': 0.48}
+TYPICAL_READ_LENGTH = {'illumina': 150, 'iontorrent': 200, 'nanopore': 8000, 'pacbio': 10000}
+
+def parseElapsed(text):
+    """ seconds in [D-]H:M:S or M:S """
+    days = 0
+    if '-' in text:
+        days, text = text.split('-', 1)
+    seconds = 0.0
+    for part in text.split(':'):
+        seconds = seconds * 60 + float(part)
+    return int(days) * 86400 + seconds
+
+def parseRss(text):
+    """ GB in a scheduler maxrss value: with a K, M or G suffix, or plain kilobytes as sacct reports them """
+    m = re.match(r"\s*([\d.]+)\s*([KMGT]?)", text, flags=re.IGNORECASE)
+    if not m:
+        return None
+    scale = {'': 1e3, 'K': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12}[m.group(2).upper()]
+    return float(m.group(1)) * scale / 1e9
+
+def peakMemoryGb(details):
+    """ highest total RSS of the tools at any sample time, from telemetry """
+    telemetry = details.get('telemetry')
+    if not telemetry:
+        return None
+    totals = {}
+    for bucket in telemetry.get('timeline', []):
+        totals[bucket['t']] = totals.get(bucket['t'], 0) + bucket['rss_mb']
+    peak = max(totals.values()) if totals else max([process['peak_rss_mb'] for process in telemetry.get('processes', [])] or [0])
+    return peak / 1e3 or None
+
+def sampleFromDetails(details, source=""):
+    """ features and targets of one run, or None if it predates the job summary """
+    job = details.get('job')
+    if not job or not job.get('inputs'):
+        return None
+    bases = sum(read_set['num_bases'] for read_set in job['inputs'])
+    reads = sum(read_set['num_reads'] for read_set in job['inputs'])
+    platforms = set(read_set['platform'] for read_set in job['inputs'])
+    sample = {'source': source, 'recipe': job['recipe'], 'bases': bases, 'read_length': bases / reads if reads else None,
+              'long_reads': bool(platforms & set(LONG_READ_PLATFORMS)), 'short_reads': bool(platforms - set(LONG_READ_PLATFORMS)),
+              'trim': bool(job.get('trim')), 'normalize': bool(job.get('normalize')),
+              'runtime_seconds': job.get('elapsed_seconds'), 'peak_memory_gb': peakMemoryGb(details),
+              'scratch_gb': job['work_dir_bytes'] / 1e9 if job.get('work_dir_bytes') else None, 'cpu': None}
+    telemetry = details.get('telemetry')
+    if telemetry and job.get('elapsed_seconds'):
+        cpu_seconds = sum(process['cpu_seconds'] for process in telemetry.get('processes', []))
+        sample['cpu'] = cpu_seconds / job['elapsed_seconds'] or None
+    return sample
+
+def loadRunDetails(paths, include_problems=False):
+    """ samples from run_details.json files, or directories searched for *run_details.json """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, name) for name in filenames if name.endswith("run_details.json"))
+        else:
+            files.append(path)
+    samples = []
+    for details_file in sorted(files):
+        try:
+            with open(details_file) as IN:
+                details = json.load(IN)
+        except (IOError, ValueError) as e:
+            sys.stderr.write("skipping {}: {}\n".format(details_file, e))
+            continue
+        if details.get('problem') and not include_problems:
+            continue
+        sample = sampleFromDetails(details, details_file)
+        if sample:
+            samples.append(sample)
+    return samples
+
+def loadAccounting(path):
+    """ samples from a tab-separated table of analyze-assembly-data.pl (or -data2.pl, -data3.pl) """
+    samples = []
+    with open(path) as IN:
+        for line in IN:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5 or not fields[2].replace('.', '', 1).isdigit():
+                continue
+            job_id, owner, bases, elapsed, maxrss = fields[:5]
+            recipe = None
+            if len(fields) == 6: # analyze-assembly-data2.pl: the assembler
+                recipe = ASSEMBLER_RECIPES.get(fields[5].lower())
+            samples.append({'source': "{}:{}".format(os.path.basename(path), job_id), 'recipe': recipe, 'bases': float(bases),
+                            'read_length': None, 'long_reads': None, 'short_reads': None, 'trim': None, 'normalize': None,
+                            'runtime_seconds': parseElapsed(elapsed), 'peak_memory_gb': parseRss(maxrss), 'scratch_gb': None, 'cpu': None})
+    return samples
+
+def featureValues(sample):
+    """ FEATURES of sample, None where unknown """
+    return {'log_bases': math.log(sample['bases']) if sample.get('bases') else None,
+            'log_read_length': math.log(sample['read_length']) if sample.get('read_length') else None,
+            'long_reads': None if sample.get('long_reads') is None else float(sample['long_reads']),
+            'short_reads': None if sample.get('short_reads') is None else float(sample['short_reads']),
+            'trim': None if sample.get('trim') is None else float(sample['trim']),
+            'normalize': None if sample.get('normalize') is None else float(sample['normalize'])}
+
+def solve(matrix, vector):
+    """ solution of a small dense linear system by Gaussian elimination with partial pivoting """
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, n + 1):
+                rows[r][c] -= factor * rows[col][c]
+    solution = [0.0] * n
+    for r in reversed(range(n)):
+        solution[r] = (rows[r][n] - sum(rows[r][c] * solution[c] for c in range(r + 1, n))) / rows[r][r]
+    return solution
+
+def fitTarget(samples, target):
+    """ least squares fit of log target on the features; unknown features take the mean of the known values """
+    usable = [sample for sample in samples if sample.get(target) and sample.get('bases')]
+    if len(usable) < 2:
+        return None
+    rows = [featureValues(sample) for sample in usable]
+    means = {}
+    for feature in FEATURES:
+        known = [row[feature] for row in rows if row[feature] is not None]
+        means[feature] = sum(known) / len(known) if known else 0.0
+    X = [[1.0] + [row[feature] if row[feature] is not None else means[feature] for feature in FEATURES] for row in rows]
+    y = [math.log(sample[target]) for sample in usable]
+    n = len(FEATURES) + 1
+    XtX = [[sum(x[i] * x[j] for x in X) + (RIDGE * len(X) if i == j and i else 0) for j in range(n)] for i in range(n)]
+    Xty = [sum(x[i] * yi for x, yi in zip(X, y)) for i in range(n)]
+    coefficients = solve(XtX, Xty)
+    residuals = [yi - sum(c * xi for c, xi in zip(coefficients, x)) for x, yi in zip(X, y)]
+    dof = max(1, len(y) - n)
+    return {'intercept': coefficients[0], 'coefficients': dict(zip(FEATURES, coefficients[1:])), 'means': means,
+            'residual_sd': math.sqrt(sum(r * r for r in residuals) / dof), 'samples': len(y)}
+
+class ResourceModel:
+
+    def __init__(self, models=None):
+        self.models = models or {} # recipe (or 'all') -> target -> fit
+
+    @classmethod
+    def fit(cls, samples):
+        models = {'all': {}}
+        for target in TARGETS:
+            fit = fitTarget(samples, target)
+            if fit:
+                models['all'][target] = fit
+        for recipe in sorted(set(sample['recipe'] for sample in samples if sample['recipe'])):
+            recipe_samples = [sample for sample in samples if sample['recipe'] == recipe]
+            for target in TARGETS:
+                if sum(1 for sample in recipe_samples if sample.get(target)) >= MIN_SAMPLES:
+                    fit = fitTarget(recipe_samples, target)
+                    if fit:
+                        models.setdefault(recipe, {})[target] = fit
+        return cls(models)
+
+    def predict(self, sample, quantile=0.9):
+        """ dict of target -> {'value', 'model', 'samples'} for the targets that can be predicted for sample """
+        z = NormalDist().inv_cdf(quantile)
+        features = featureValues(sample)
+        predictions = {}
+        for target in TARGETS:
+            for model_name in (sample.get('recipe'), 'all'):
+                fit = self.models.get(model_name, {}).get(target)
+                if fit:
+                    log_value = fit['intercept'] + z * fit['residual_sd']
+                    for feature in FEATURES:
+                        value = features[feature] if features[feature] is not None else fit['means'][feature]
+                        log_value += fit['coefficients'][feature] * value
+                    predictions[target] = {'value': math.exp(log_value), 'model': model_name, 'samples': fit['samples']}
+                    break
+        return predictions
+
+    def save(self, path):
+        with open(path, 'w') as OUT:
+            json.dump({'features': FEATURES, 'targets': TARGETS, 'models': self.models}, OUT, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as IN:
+            return cls(json.load(IN)['models'])
+
+    def summary(self):
+        """ one line per recipe and target: samples, residual sd and bases exponent """
+        lines = []
+        for recipe in sorted(self.models):
+            for target, fit in sorted(self.models[recipe].items()):
+                lines.append("{:<12}{:<18}{:>8}{:>12.3f}{:>12.3f}".format(recipe, target, fit['samples'], fit['residual_sd'], fit['coefficients']['log_bases']))
+        return lines
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+What one assembly job shares between its stages: the log, its directories, the resource budget,
+the tool registry, the event stream, how tools are run, where parallel jobs run, its walltime budget and the versions of the read-processing tools it ran.
+Functions of the pipeline and ReadLibrary take a RunContext instead of reading module globals,
+and name files by absolute path instead of relying on the current directory,
+so several jobs can run in one process (or be driven from another program) without interfering.
+"""
+import sys
+import os
+import os.path
+from time import time
+from ResourceManager import ResourceManager
+from ToolRegistry import ToolRegistry
+from EventLog import EventLog
+from Executor import LocalExecutor
+from ToolRunner import ToolRunner
+from WalltimeBudget import WalltimeBudget
+
+class RunContext:
+
+    def __init__(self, work_dir, save_dir=None, details_dir=None, log=None, resources=None, tools=None, events=None, runner=None, executor=None, budget=None, start_time=None):
+        """
+        work_dir holds intermediate files; save_dir (default work_dir/save) the results,
+        details_dir (default save_dir/details) the supporting files.
+        Without resources, tools, events, runner, executor or budget, the context gets a budget of the whole machine,
+        a registry kept in memory, a disabled event stream, and runs tools without time limits on this node, with no deadline.
+        """
+        self.start_time = start_time or time()
+        self.work_dir = os.path.abspath(work_dir)
+        self.save_dir = os.path.abspath(save_dir) if save_dir else os.path.join(self.work_dir, "save")
+        self.details_dir = os.path.abspath(details_dir) if details_dir else os.path.join(self.save_dir, "details")
+        self.log = log or sys.stderr
+        self.resources = resources or ResourceManager(log=self.log)
+        self.tools = tools or ToolRegistry('', log=self.log)
+        self.events = events or EventLog(log=self.log)
+        self.runner = runner or ToolRunner(cwd=self.work_dir, log=self.log)
+        self.executor = executor or LocalExecutor(self.work_dir, log=self.log)
+        self.budget = budget or WalltimeBudget(log=self.log)
+        self.versions = {} # read-processing tool -> version, as ReadLibrary runs them
+
+    def path(self, *names):
+        """ absolute path of names within the work directory """
+        return os.path.join(self.work_dir, *names)
+
+    def makeDirs(self):
+        for directory in (self.work_dir, self.save_dir, self.details_dir):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+    def elapsed(self):
+        """ seconds since the job started """
+        return time() - self.start_time
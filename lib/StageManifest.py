@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Record of completed pipeline stages, so an interrupted assembly job can be resumed.
+Each stage is stored with a fingerprint of its name, parameters, input files and the stage before it,
+along with its outputs, tool versions and whatever state the pipeline needs to carry on from it.
+"""
+import sys
+import os
+import os.path
+import json
+import hashlib
+import threading
+from time import time
+
+class StageManifest:
+    LOG = sys.stderr
+
+    def __init__(self, manifest_file, resume=False, log=None):
+        """
+        With resume, stages recorded in an existing manifest_file may be skipped;
+        otherwise any previous manifest is discarded.
+        """
+        self.manifest_file = manifest_file
+        self.log = log or StageManifest.LOG
+        self.stages = []
+        self.recorded = {}
+        self.skipped = set() # names of stages restored from the manifest rather than run
+        self.resuming = resume
+        self.last_fingerprint = ''
+        if resume and os.path.exists(manifest_file):
+            with open(manifest_file) as IN:
+                for stage in json.load(IN).get('stages', []):
+                    self.recorded[stage['name']] = stage
+            self.log.write("stage manifest {} lists {} completed stages\n".format(manifest_file, len(self.recorded)))
+        self.stage_start = {}
+        self.lock = threading.Lock() # stages may be run from concurrent threads
+        self.telemetry = None # if set, told which stage each thread is running
+        self.events = None # if set, an EventLog that gets stage start, skip and completion events
+        self.profiler = None # if set, a StageProfiler that profiles each stage from skip() to complete()
+
+    @staticmethod
+    def fileStats(files):
+        """ list of [path, size, mtime in ns], following symlinks; missing files have size -1 """
+        stats = []
+        for path in files:
+            if path and os.path.exists(path):
+                st = os.stat(path)
+                stats.append([path, st.st_size, st.st_mtime_ns])
+            else:
+                stats.append([path, -1, 0])
+        return stats
+
+    def fingerprint(self, name, params=None, inputs=(), upstream=None):
+        """ Hash of stage name, params, input file stats and the fingerprint of the preceding stage (or of upstream if given). """
+        if upstream is None:
+            upstream = self.last_fingerprint
+        text = json.dumps([name, params, self.fileStats(inputs), upstream], sort_keys=True, default=str)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def skip(self, name, params=None, inputs=(), upstream=None):
+        """
+        Return the recorded stage if it can be skipped: resuming, same fingerprint, and outputs unchanged since it ran.
+        The first stage that cannot be skipped ends resuming, so every later stage runs again.
+        Stages run concurrently pass the fingerprint they follow from as upstream.
+        """
+        if self.telemetry:
+            self.telemetry.setStage(name)
+        if self.events:
+            self.events.setStage(name)
+        with self.lock:
+            stage = self.skipStage(name, params, inputs, upstream)
+        if self.profiler:
+            if stage:
+                self.profiler.end(name)
+            else:
+                self.profiler.begin(name)
+        return stage
+
+    def skipStage(self, name, params, inputs, upstream):
+        fingerprint = self.fingerprint(name, params, inputs, upstream)
+        self.stage_start[name] = (fingerprint, time())
+        stage = self.recorded.get(name)
+        if self.resuming and stage and stage['fingerprint'] == fingerprint:
+            current = self.fileStats([path for path, size, mtime in stage['outputs']])
+            changed = [stats[0] for stats, recorded in zip(current, stage['outputs']) if stats != recorded]
+            if not changed:
+                self.log.write("resume: skipping completed stage {}\n".format(name))
+                self.stages.append(stage)
+                self.skipped.add(name)
+                self.last_fingerprint = fingerprint
+                if self.events:
+                    self.events.emit('stage_skipped', name)
+                return stage
+            self.log.write("resume: stage {} outputs missing or changed: {}\n".format(name, changed))
+        elif self.resuming:
+            self.log.write("resume: stage {} {}, running it and all later stages\n".format(name, "changed" if stage else "not completed"))
+        self.resuming = False
+        if self.events:
+            self.events.emit('stage_start', name)
+        return None
+
+    def complete(self, name, params=None, inputs=(), outputs=(), versions=None, state=None):
+        """ Record a stage that just ran (skip() must have been called for it first), and rewrite the manifest. """
+        with self.lock:
+            stage = self.completeStage(name, params, inputs, outputs, versions, state)
+        if self.profiler:
+            self.profiler.end(name)
+        return stage
+
+    def completeStage(self, name, params, inputs, outputs, versions, state):
+        fingerprint, start_time = self.stage_start.pop(name)
+        stage = {'name': name,
+                'fingerprint': fingerprint,
+                'params': params,
+                'inputs': self.fileStats(inputs),
+                'outputs': self.fileStats([path for path in outputs if path]),
+                'versions': versions or {},
+                'state': state or {},
+                'start': start_time,
+                'seconds': time() - start_time}
+        self.stages.append(stage)
+        self.last_fingerprint = fingerprint
+        self.write()
+        if self.events:
+            self.events.counters('stage_complete', stage['seconds'], stage=name,
+                    bytes_in=sum(max(size, 0) for path, size, mtime in stage['inputs']),
+                    bytes_out=sum(max(size, 0) for path, size, mtime in stage['outputs']))
+        return stage
+
+    def timings(self):
+        """ seconds and output bytes of each stage completed so far, for run_details; skipped stages are marked """
+        with self.lock:
+            return {stage['name']: {'seconds': round(stage['seconds'], 3), 'skipped': stage['name'] in self.skipped,
+                    'output_bytes': sum(max(size, 0) for path, size, mtime in stage['outputs'])} for stage in self.stages}
+
+    def write(self):
+        """ Write via a temporary file so an interrupted job never leaves a partial manifest. """
+        temp_file = self.manifest_file + ".tmp"
+        with open(temp_file, 'w') as OUT:
+            json.dump({'stages': self.stages}, OUT, indent=2, default=str)
+        os.replace(temp_file, self.manifest_file)
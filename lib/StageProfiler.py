@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+cProfile sections for the pipeline stages of an assembly job (p3x-assembly.py --profile).
+Each stage is profiled from its start to its completion in the thread that runs it; time in the main thread
+outside any stage goes to section 'main'. Stats are saved per section as .prof files (readable with pstats or snakeviz),
+and the report separates time spent waiting (on subprocesses, locks, sleep) from time spent running Python.
+Nothing is installed unless a StageProfiler is created, so runs without --profile pay nothing.
+Python 3.12+ allows only one cProfile profiler at a time, and it sees every thread; there, stages run concurrently
+(between beginConcurrent and endConcurrent) share one section instead of having one each.
+"""
+import sys
+import os
+import os.path
+import cProfile
+import pstats
+import threading
+import html
+
+# built-in functions where the orchestrator blocks rather than computes
+# (binary reads here are mostly of subprocess stdout pipes)
+WAIT_FUNCTIONS = ('waitpid', 'wait4', 'select', 'poll', 'sleep', 'acquire', "'read' of '_io.BufferedReader'")
+SINGLE_PROFILER = sys.version_info >= (3, 12)
+
+def functionLabel(func):
+    """ 'file:line(function)' with the file reduced to its basename """
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return "{}:{}({})".format(os.path.basename(filename), line, name)
+
+def isWait(func):
+    return func[0] == '~' and any(name in func[2] for name in WAIT_FUNCTIONS)
+
+class StageProfiler:
+    LOG = sys.stderr
+    TOP_N = 25
+
+    def __init__(self, log=None):
+        self.log = log or StageProfiler.LOG
+        self.local = threading.local()
+        self.profiles = {} # section name -> list of cProfile.Profile
+        self.lock = threading.Lock()
+        self.main_thread = threading.current_thread()
+        self.shared = None # (name, profile) covering all threads while concurrent stages run on python 3.12+
+        self.main = cProfile.Profile()
+        self.main.enable()
+
+    def enable(self, profile):
+        try:
+            profile.enable()
+            return True
+        except ValueError as e: # another profiler is active (python 3.12+ allows only one at a time)
+            self.log.write("profile: cannot profile this section: {}\n".format(e))
+            return False
+
+    def begin(self, name):
+        """ Start profiling stage name in the calling thread (ending any stage still open there). """
+        current = getattr(self.local, 'current', None)
+        if current:
+            self.end(current[0])
+        if self.shared:
+            return
+        if threading.current_thread() is self.main_thread:
+            self.main.disable()
+        profile = cProfile.Profile()
+        if self.enable(profile):
+            self.local.current = (name, profile)
+
+    def end(self, name):
+        """ Stop profiling stage name, if it is the one open in the calling thread. """
+        current = getattr(self.local, 'current', None)
+        if not current or current[0] != name:
+            return
+        current[1].disable()
+        self.local.current = None
+        with self.lock:
+            self.profiles.setdefault(name, []).append(current[1])
+        if threading.current_thread() is self.main_thread:
+            self.enable(self.main)
+
+    def beginConcurrent(self, name):
+        """ Called from the main thread before stages start in other threads: on python 3.12+, profile them all as section name. """
+        if not SINGLE_PROFILER:
+            return
+        current = getattr(self.local, 'current', None)
+        if current:
+            self.end(current[0])
+        self.main.disable()
+        profile = cProfile.Profile()
+        if self.enable(profile):
+            self.shared = (name, profile)
+        else:
+            self.enable(self.main)
+
+    def endConcurrent(self):
+        """ Called from the main thread once the concurrent stages have finished. """
+        if not self.shared:
+            return
+        name, profile = self.shared
+        profile.disable()
+        self.shared = None
+        with self.lock:
+            self.profiles.setdefault(name, []).append(profile)
+        self.enable(self.main)
+
+    def finish(self, out_dir, prefix=""):
+        """ Stop profiling, save <prefix>profile_<section>.prof files in out_dir, return the summary for run_details. """
+        current = getattr(self.local, 'current', None)
+        if current:
+            self.end(current[0])
+        self.endConcurrent()
+        self.main.disable()
+        with self.lock:
+            self.profiles.setdefault('main', []).append(self.main)
+            sections = dict(self.profiles)
+        report = {'sections': {}, 'top': []}
+        combined = None
+        for name, profiles in sections.items():
+            stats = pstats.Stats(*profiles)
+            profile_file = os.path.join(out_dir, "{}profile_{}.prof".format(prefix, name))
+            stats.dump_stats(profile_file)
+            wait = sum(stat[2] for func, stat in stats.stats.items() if isWait(func))
+            report['sections'][name] = {'seconds': round(stats.total_tt, 3), 'wait_seconds': round(wait, 3),
+                    'python_seconds': round(stats.total_tt - wait, 3), 'calls': stats.total_calls, 'file': os.path.basename(profile_file)}
+            if combined:
+                combined.add(stats)
+            else:
+                combined = stats
+        if combined:
+            top = sorted(combined.stats.items(), key=lambda item: -item[1][2])[:StageProfiler.TOP_N]
+            for func, (primitive_calls, calls, tottime, cumtime, callers) in top:
+                report['top'].append({'function': functionLabel(func), 'calls': calls, 'tottime': round(tottime, 3),
+                        'cumtime': round(cumtime, 3), 'wait': isWait(func)})
+        self.log.write("profile: saved {} sections to {}\n".format(len(sections), out_dir))
+        return report
+
+    @staticmethod
+    def writeHtmlSection(HTML, profile):
+        """ Python time against waiting per section, and the hottest functions over the whole run """
+        HTML.write('<section>\n<h2>Profile</h2>\n')
+        HTML.write("""
+        <table class="med-table kv-table">
+            <thead class="table-header">
+            <tr> <th>Section</th><th>Seconds</th><th>Waiting</th><th>Python</th><th>Calls</th></tr></thead>
+            <tbody>
+            """)
+        for name, section in sorted(profile['sections'].items(), key=lambda item: -item[1]['seconds']):
+            HTML.write("<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n".format(
+                name, section['seconds'], section['wait_seconds'], section['python_seconds'], section['calls']))
+        HTML.write("</tbody></table>\n")
+        HTML.write("""
+        <table class="med-table kv-table">
+            <thead class="table-header">
+            <tr> <th>Function</th><th>Calls</th><th>Own time</th><th>Cumulative</th></tr></thead>
+            <tbody>
+            """)
+        for row in profile['top']:
+            HTML.write("<tr><td>{}{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n".format(
+                html.escape(row['function']), " (waiting)" if row['wait'] else "", row['calls'], row['tottime'], row['cumtime']))
+        HTML.write("</tbody></table>\n")
+        HTML.write("</section>\n")
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+Resource telemetry for the external tools of an assembly job.
+Once installed, every subprocess started through subprocess.Popen (and so call, run, check_call) is registered
+with the pipeline stage current in the thread that started it. A sampler thread reads /proc at a fixed interval
+and sums RSS, CPU time and read/write bytes over each registered process and all its descendants.
+CPU time and I/O include descendants already reaped (cutime/cstime and the kernel's inherited io counters),
+so a tool's totals are correct even when its children come and go between samples.
+"""
+import sys
+import os
+import os.path
+import subprocess
+import threading
+from time import time
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+UNTRACKED_POPEN = subprocess.Popen
+
+def readProcStat(pid):
+    """ (ppid, state, cpu seconds including reaped children, rss bytes) from /proc/pid/stat, or None if gone """
+    try:
+        with open("/proc/{}/stat".format(pid)) as IN:
+            text = IN.read()
+    except (IOError, OSError):
+        return None
+    fields = text[text.rfind(')')+2:].split() # command name may contain spaces and parentheses
+    cpu_ticks = sum(int(value) for value in fields[11:15]) # utime, stime, cutime, cstime
+    return int(fields[1]), fields[0], float(cpu_ticks) / CLOCK_TICKS, int(fields[21]) * PAGE_SIZE
+
+def readProcIO(pid):
+    """ (read_bytes, write_bytes) from /proc/pid/io, (0, 0) if not readable """
+    read_bytes = write_bytes = 0
+    try:
+        with open("/proc/{}/io".format(pid)) as IN:
+            for line in IN:
+                if line.startswith("read_bytes:"):
+                    read_bytes = int(line.split()[1])
+                elif line.startswith("write_bytes:"):
+                    write_bytes = int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return read_bytes, write_bytes
+
+def processTable():
+    """ dict of pid -> (ppid, state, cpu seconds, rss bytes) for every process in /proc """
+    table = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            stat = readProcStat(int(name))
+            if stat:
+                table[int(name)] = stat
+    return table
+
+def toolName(command):
+    """ short name for a command: program basename, or the jar for java -jar """
+    if isinstance(command, (str, bytes)):
+        command = str(command).split()
+    command = [str(word) for word in command]
+    if not command:
+        return ''
+    tool = os.path.basename(command[0])
+    if tool == 'java' and '-jar' in command[:-1]:
+        tool = os.path.basename(command[command.index('-jar')+1])
+    return tool
+
+class TrackedPopen(subprocess.Popen):
+    """ subprocess.Popen that registers each child with the installed Telemetry """
+    telemetry = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if TrackedPopen.telemetry:
+            TrackedPopen.telemetry.register(self.pid, self.args)
+
+class Telemetry:
+    LOG = sys.stderr
+    MAX_TIMELINE_POINTS = 500 # timeline is reduced to about this many time buckets in the report
+
+    def __init__(self, interval=1.0, origin=None, log=None):
+        """ sample every interval seconds; times are reported in seconds since origin (default now) """
+        self.interval = interval
+        self.log = log or Telemetry.LOG
+        self.origin = origin or time()
+        self.processes = [] # record of each process started by the pipeline
+        self.samples = [] # (time, stage, rss bytes, cpu cores, processes)
+        self.stage_peak_rss = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def install(self):
+        """ Track every subprocess started from now on, and start sampling. """
+        TrackedPopen.telemetry = self
+        subprocess.Popen = TrackedPopen
+        self.thread = threading.Thread(target=self.sampleLoop, name="telemetry", daemon=True)
+        self.thread.start()
+        self.log.write("telemetry: sampling child processes every {} seconds\n".format(self.interval))
+
+    def stop(self):
+        """ Stop sampling (after a last sample) and stop tracking new subprocesses. """
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            self.sample()
+        if TrackedPopen.telemetry is self:
+            TrackedPopen.telemetry = None
+            subprocess.Popen = UNTRACKED_POPEN
+
+    def setStage(self, name):
+        """ Attribute subprocesses started from the calling thread to stage name. """
+        self.local.stage = name
+
+    def register(self, pid, command):
+        record = {'pid': pid, 'stage': getattr(self.local, 'stage', 'main'), 'tool': toolName(command),
+                'command': (command if isinstance(command, str) else " ".join(str(word) for word in command))[:200],
+                'start': time(), 'end': None, 'peak_rss': 0, 'cpu_seconds': 0.0, 'read_bytes': 0, 'write_bytes': 0, 'samples': 0}
+        with self.lock:
+            self.processes.append(record)
+
+    def sampleLoop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e: # telemetry must never take the pipeline down
+                self.log.write("telemetry: sampling failed: {}\n".format(e))
+
+    def sample(self):
+        """ Read /proc once and update every running tracked process with the totals of its process tree. """
+        with self.lock:
+            running = [record for record in self.processes if record['end'] is None]
+        if not running:
+            return
+        now = time()
+        table = processTable()
+        children = {}
+        for pid, (ppid, state, cpu_seconds, rss) in table.items():
+            children.setdefault(ppid, []).append(pid)
+        stage_totals = {}
+        for record in running:
+            root = table.get(record['pid'])
+            if not root or root[1] in ('Z', 'X'):
+                record['end'] = now
+                continue
+            rss = 0
+            cpu_seconds = 0.0
+            read_bytes = write_bytes = 0
+            tree = [record['pid']]
+            while tree:
+                pid = tree.pop()
+                ppid, state, pid_cpu, pid_rss = table[pid]
+                rss += pid_rss
+                cpu_seconds += pid_cpu
+                pid_read, pid_write = readProcIO(pid)
+                read_bytes += pid_read
+                write_bytes += pid_write
+                tree.extend(children.get(pid, []))
+            if record['samples']:
+                cpu_rate = max(0.0, cpu_seconds - record['cpu_seconds']) / max(now - record['last_sample'], 1e-3)
+            else:
+                cpu_rate = cpu_seconds / max(now - record['start'], 1e-3)
+            record['peak_rss'] = max(record['peak_rss'], rss)
+            # counters of a tree can drop when a child exits before it is reaped, so keep the highest seen
+            record['cpu_seconds'] = max(record['cpu_seconds'], cpu_seconds)
+            record['read_bytes'] = max(record['read_bytes'], read_bytes)
+            record['write_bytes'] = max(record['write_bytes'], write_bytes)
+            record['samples'] += 1
+            record['last_sample'] = now
+            totals = stage_totals.setdefault(record['stage'], [0, 0.0, 0])
+            totals[0] += rss
+            totals[1] += cpu_rate
+            totals[2] += 1
+        with self.lock:
+            for stage, (rss, cpu_rate, count) in stage_totals.items():
+                self.samples.append((now, stage, rss, cpu_rate, count))
+                self.stage_peak_rss[stage] = max(self.stage_peak_rss.get(stage, 0), rss)
+
+    def timeline(self):
+        """ samples reduced to at most MAX_TIMELINE_POINTS time buckets: peak RSS and mean CPU of each stage per bucket """
+        if not self.samples:
+            return []
+        start = self.samples[0][0]
+        width = max(self.interval, (self.samples[-1][0] - start) / Telemetry.MAX_TIMELINE_POINTS)
+        buckets = {}
+        for t, stage, rss, cpu_rate, count in self.samples:
+            key = (int((t - start) / width), stage)
+            bucket = buckets.setdefault(key, {'t': round(t - self.origin, 1), 'stage': stage, 'rss_mb': 0, 'cpu': 0.0, 'processes': 0, 'n': 0})
+            bucket['rss_mb'] = max(bucket['rss_mb'], round(rss / 1e6, 1))
+            bucket['cpu'] += cpu_rate
+            bucket['processes'] = max(bucket['processes'], count)
+            bucket['n'] += 1
+        timeline = []
+        for key in sorted(buckets):
+            bucket = buckets[key]
+            bucket['cpu'] = round(bucket['cpu'] / bucket.pop('n'), 2)
+            timeline.append(bucket)
+        return timeline
+
+    def report(self):
+        """ per-stage summary, per-process records and timeline, for run_details """
+        with self.lock:
+            processes = list(self.processes)
+            stages = {}
+            for record in processes:
+                end = record['end'] or record.get('last_sample') or record['start']
+                stage = stages.setdefault(record['stage'], {'start': record['start'], 'end': end, 'processes': 0, 'tools': [],
+                        'cpu_seconds': 0.0, 'read_mb': 0.0, 'write_mb': 0.0, 'peak_rss_mb': round(self.stage_peak_rss.get(record['stage'], 0) / 1e6, 1)})
+                stage['start'] = min(stage['start'], record['start'])
+                stage['end'] = max(stage['end'], end)
+                stage['processes'] += 1
+                if record['tool'] not in stage['tools']:
+                    stage['tools'].append(record['tool'])
+                stage['cpu_seconds'] += record['cpu_seconds']
+                stage['read_mb'] += record['read_bytes'] / 1e6
+                stage['write_mb'] += record['write_bytes'] / 1e6
+            for stage in stages.values():
+                seconds = stage['end'] - stage['start']
+                stage['cpu_utilization'] = round(stage['cpu_seconds'] / seconds, 2) if seconds > 0 else 0
+                stage['start'] = round(stage['start'] - self.origin, 1)
+                stage['end'] = round(stage['end'] - self.origin, 1)
+                for key in ('cpu_seconds', 'read_mb', 'write_mb'):
+                    stage[key] = round(stage[key], 1)
+            process_info = [{'stage': record['stage'], 'tool': record['tool'], 'command': record['command'],
+                    'start': round(record['start'] - self.origin, 1), 'end': round(record['end'] - self.origin, 1) if record['end'] else None,
+                    'peak_rss_mb': round(record['peak_rss'] / 1e6, 1), 'cpu_seconds': round(record['cpu_seconds'], 1),
+                    'read_mb': round(record['read_bytes'] / 1e6, 1), 'write_mb': round(record['write_bytes'] / 1e6, 1),
+                    'samples': record['samples']} for record in processes]
+            return {'interval': self.interval, 'stages': stages, 'processes': process_info, 'timeline': self.timeline()}
+
+    @staticmethod
+    def writeHtmlSection(HTML, telemetry):
+        """ Gantt chart of stages (bar shade is CPU utilization) with the peak RSS and CPU time of each """
+        stages = sorted(telemetry['stages'].items(), key=lambda item: item[1]['start'])
+        if not stages:
+            return
+        end = max(stage['end'] for name, stage in stages) or 1
+        row_height = 18
+        label_width = 120
+        chart_width = 600
+        height = row_height * len(stages) + 20
+        HTML.write('<section>\n<h2>Stage Resource Usage</h2>\n')
+        HTML.write('<svg width="{}" height="{}" font-size="11">\n'.format(label_width + chart_width + 220, height))
+        for row, (name, stage) in enumerate(stages):
+            y = row * row_height
+            x = label_width + chart_width * stage['start'] / end
+            width = max(1, chart_width * (stage['end'] - stage['start']) / end)
+            opacity = min(1.0, 0.2 + 0.8 * stage['cpu_utilization'] / max(1, max(s['cpu_utilization'] for n, s in stages)))
+            HTML.write('<text x="0" y="{}">{}</text>\n'.format(y + 13, name))
+            HTML.write('<rect x="{:.1f}" y="{}" width="{:.1f}" height="{}" fill="#196E9C" fill-opacity="{:.2f}"><title>{}: {} s, {} cpu s, {} MB peak</title></rect>\n'.format(
+                x, y + 2, width, row_height - 4, opacity, name, round(stage['end'] - stage['start'], 1), stage['cpu_seconds'], stage['peak_rss_mb']))
+            HTML.write('<text x="{}" y="{}">{} MB, {} cpu s</text>\n'.format(label_width + chart_width + 10, y + 13, stage['peak_rss_mb'], stage['cpu_seconds']))
+        HTML.write('<text x="{}" y="{}">0</text><text x="{}" y="{}" text-anchor="end">{:.0f} s</text>\n'.format(
+            label_width, height - 4, label_width + chart_width, height - 4, end))
+        HTML.write('</svg>\n')
+        HTML.write("""
+        <table class="med-table kv-table">
+            <thead class="table-header">
+            <tr> <th>Stage</th><th>Seconds</th><th>CPU seconds</th><th>CPU utilization</th><th>Peak RSS MB</th><th>Read MB</th><th>Write MB</th><th>Tools</th></tr></thead>
+            <tbody>
+            """)
+        for name, stage in stages:
+            HTML.write("<tr><td>{}</td><td>{:.1f}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n".format(
+                name, stage['end'] - stage['start'], stage['cpu_seconds'], stage['cpu_utilization'], stage['peak_rss_mb'],
+                stage['read_mb'], stage['write_mb'], ", ".join(stage['tools'])))
+        HTML.write("</tbody></table>\n")
+        HTML.write("</section>\n")
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Resolve external tools once and remember what their version commands print, so stages need not re-run them.
+A probe is keyed by the resolved executable (real path, size and mtime) and any extra file it depends on
+(such as the pilon jar run by java). Its output, from which versions and capability flags are parsed, is kept in memory
+for the run and in a json file shared between runs; upgrading or replacing a tool changes its key.
+"""
+import sys
+import os
+import os.path
+import re
+import json
+import shutil
+import subprocess
+import threading
+import uuid
+from time import time
+
+# arguments that make each tool report its version (samtools, bbnorm.sh and seqtk print it in their usage text)
+VERSION_ARGS = {
+    'samtools': [],
+    'bbnorm.sh': [],
+    'seqtk': [],
+}
+DEFAULT_VERSION_ARGS = ['--version']
+
+# regular expression whose group 1 is the version, searched in stdout then stderr; default is the first non-empty line
+VERSION_PATTERNS = {
+    'unicycler': r"(Unicycler\s+\S+)",
+    'samtools': r"^(Version.*\S)",
+    'bowtie2': r"version\s+(\S+)",
+    'trim_galore': r"(version\s+\S+)",
+    'bbnorm.sh': r"Last modified\s*(\S.*\S)",
+    'seqtk': r"Version:\s*(\S.*\S)",
+}
+
+# capability flags: name -> regular expression searched in the version output
+CAPABILITY_PATTERNS = {
+    'samtools': {'old_sort': r"Version:\s*0\.1\.19"}, # sort takes an output prefix instead of -o
+}
+
+def defaultRegistryFile():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "p3x-assembly", "tool_registry.json")
+
+def fileStamp(path):
+    """ (real path, size, mtime_ns) of path, or None if it does not exist """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [os.path.realpath(path), st.st_size, st.st_mtime_ns]
+
+class ToolRegistry:
+    LOG = sys.stderr
+
+    def __init__(self, path=None, log=None):
+        """ path: json file of earlier probes ('' to keep them in memory only) """
+        self.path = defaultRegistryFile() if path is None else path
+        self.log = log or ToolRegistry.LOG
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.probes = 0
+        self.hits = 0
+        self.stored = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as IN:
+                    self.stored = json.load(IN)
+            except (IOError, ValueError) as e:
+                self.log.write("tool registry: ignoring unreadable {}: {}\n".format(self.path, e))
+
+    def resolve(self, name):
+        """ full path of executable name on PATH, or None """
+        return shutil.which(name)
+
+    def probe(self, command, depends_on=None):
+        """
+        Output of running command (a version command): dict of stdout, stderr, text (both, stripped) and returncode,
+        run only if no earlier run of the same command against the same executable (and depends_on file) is known.
+        """
+        executable = self.resolve(command[0])
+        if not executable:
+            return {'stdout': '', 'stderr': '', 'text': '', 'returncode': None}
+        key = json.dumps([command, fileStamp(executable), fileStamp(depends_on) if depends_on else None])
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                return self.entries[key]
+            if key in self.stored:
+                self.hits += 1
+                self.entries[key] = self.stored[key]
+                return self.entries[key]
+        start_time = time()
+        try:
+            proc = subprocess.run([executable] + command[1:], shell=False, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+            entry = {'stdout': proc.stdout, 'stderr': proc.stderr, 'text': (proc.stdout + proc.stderr).strip(), 'returncode': proc.returncode}
+        except OSError as e:
+            self.log.write("tool registry: cannot run {}: {}\n".format(executable, e))
+            return {'stdout': '', 'stderr': '', 'text': '', 'returncode': None}
+        self.log.write("tool registry: probed {} in {:.2f} seconds\n".format(" ".join(command), time() - start_time))
+        with self.lock:
+            self.probes += 1
+            self.entries[key] = entry
+            self.stored[key] = entry
+            self.save()
+        return entry
+
+    def versionOutput(self, name, depends_on=None):
+        """ probe of tool name with its usual version arguments """
+        if name == 'pilon':
+            return self.probe(['java', '-jar', depends_on, '--version'], depends_on=depends_on)
+        return self.probe([name] + VERSION_ARGS.get(name, DEFAULT_VERSION_ARGS))
+
+    def version(self, name, depends_on=None):
+        """ version string of tool name ('' if it cannot be run); for pilon, depends_on is the jar """
+        output = self.versionOutput(name, depends_on)
+        pattern = VERSION_PATTERNS.get(name)
+        for text in (output['stdout'], output['stderr']):
+            if pattern:
+                m = re.search(pattern, text, flags=re.IGNORECASE|re.MULTILINE)
+                if m:
+                    return m.group(1)
+            elif text.strip():
+                return text.strip().splitlines()[0].strip()
+        return ''
+
+    def capabilities(self, name):
+        """ dict of capability flag -> bool for tool name """
+        text = self.versionOutput(name)['text']
+        return {flag: bool(re.search(pattern, text)) for flag, pattern in CAPABILITY_PATTERNS.get(name, {}).items()}
+
+    def save(self):
+        """ write the probes (atomically) for later runs; called with the lock held """
+        if not self.path:
+            return
+        try:
+            registry_dir = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.exists(registry_dir):
+                os.makedirs(registry_dir, exist_ok=True)
+            stored = {}
+            if os.path.exists(self.path): # keep probes made meanwhile by other runs
+                with open(self.path) as IN:
+                    stored = json.load(IN)
+            stored.update(self.stored)
+            temp_file = "{}.{}.tmp".format(self.path, uuid.uuid4().hex)
+            with open(temp_file, 'w') as OUT:
+                json.dump(stored, OUT, indent=1)
+            os.replace(temp_file, self.path)
+        except (IOError, OSError, ValueError) as e:
+            self.log.write("tool registry: cannot save {}: {}\n".format(self.path, e))
+
+    def report(self):
+        return {'file': self.path, 'probes': self.probes, 'cached': self.hits}
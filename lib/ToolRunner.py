@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Run external tools with asyncio, each in its own process group, with an optional wall-clock limit.
+A tool over its limit (or a run that is cancelled) has its whole process tree sent SIGTERM and, after a grace period, SIGKILL,
+so a hung tool gives its threads and memory back instead of holding them until the scheduler kills the job.
+The last lines of each tool's stderr are kept in a bounded ring buffer (and optionally copied to a log as they arrive),
+so a failure can be diagnosed without keeping all of its output.
+run() and call() wait for one tool; runMany() waits for several at once, so independent tools overlap.
+Limits are per tool name: the command without a .py or .sh suffix (quast, spades, Bandage), or a name the caller gives (pilon).
+"""
+import sys
+import os
+import os.path
+import re
+import signal
+import asyncio
+import collections
+import subprocess
+import threading
+from time import time
+
+STDERR_TAIL_LINES = 40 # lines of stderr kept for each run
+STDERR_LINE_CHARS = 500 # longer lines (progress bars) are cut
+TERMINATE_GRACE_SECONDS = 30 # between SIGTERM and SIGKILL
+
+def toolName(command):
+    return re.sub(r"\.(py|sh)$", "", os.path.basename(command[0]))
+
+def signalGroup(pgid, signum):
+    """ send signum to process group pgid, if it still has members """
+    try:
+        os.killpg(pgid, signum)
+        return True
+    except (ProcessLookupError, PermissionError):
+        return False
+
+def terminateProcessGroup(proc, grace=TERMINATE_GRACE_SECONDS):
+    """ SIGTERM the group led by proc (a subprocess.Popen started in a new session), then SIGKILL it after grace seconds """
+    signalGroup(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(grace)
+    except subprocess.TimeoutExpired:
+        pass
+    signalGroup(proc.pid, signal.SIGKILL) # also ends descendants that outlived the tool
+    proc.wait()
+
+class RunResult:
+    """ What happened to one tool run. """
+
+    def __init__(self, name, command):
+        self.name = name
+        self.command = command
+        self.returncode = None
+        self.stdout = None # text, when collected
+        self.stderr_tail = []
+        self.seconds = 0
+        self.timed_out = False
+        self.memory = None # MemoryWatchdog report, when watched
+
+    def to_dict(self):
+        return {'name': self.name, 'command': " ".join(self.command), 'return_code': self.returncode,
+                'seconds': round(self.seconds, 1), 'timed_out': self.timed_out, 'memory': self.memory, 'stderr_tail': self.stderr_tail}
+
+class ToolRunner:
+    LOG = sys.stderr
+
+    def __init__(self, cwd=None, log=None, limits=None, grace=TERMINATE_GRACE_SECONDS):
+        """ limits: tool name -> seconds it may run """
+        self.cwd = cwd
+        self.log = log or ToolRunner.LOG
+        self.limits = limits or {}
+        self.grace = grace
+        self.failures = [] # RunResults of runs that failed or timed out
+        self.active = set() # process group ids of running tools
+        self.lock = threading.Lock()
+
+    async def copyStderr(self, stream, tail, copy_to):
+        """ read stream to its end, keeping the last lines in tail and copying everything to copy_to (a text file) if given """
+        partial = b""
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            if copy_to:
+                copy_to.write(chunk.decode(errors='replace'))
+                copy_to.flush()
+            lines = re.split(b"[\r\n]", partial + chunk)
+            partial = lines.pop()[-STDERR_LINE_CHARS:]
+            tail.extend(line[:STDERR_LINE_CHARS].decode(errors='replace') for line in lines if line.strip())
+        if partial.strip():
+            tail.append(partial.decode(errors='replace'))
+
+    async def terminate(self, proc):
+        signalGroup(proc.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), self.grace)
+        except asyncio.TimeoutError:
+            self.log.write("process group {} still running {} seconds after SIGTERM, killing it\n".format(proc.pid, self.grace))
+        signalGroup(proc.pid, signal.SIGKILL)
+        await proc.wait()
+
+    async def runAsync(self, command, name=None, stdout=None, stderr=None, timeout=None, cwd=None, watchdog=None):
+        """
+        Run command and return its RunResult.
+        stdout: a file, None to discard it, or subprocess.PIPE to collect it as result.stdout.
+        stderr: a text file to copy stderr to as it arrives, or None; its last lines are in result.stderr_tail either way.
+        timeout: seconds (default: the limit for name, which defaults to the tool name of the command).
+        watchdog: a MemoryWatchdog that stops the run if its process tree outgrows its memory.
+        """
+        name = name or toolName(command)
+        if timeout is None:
+            timeout = self.limits.get(name)
+        result = RunResult(name, command)
+        start_time = time()
+        proc = await asyncio.create_subprocess_exec(*command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL if stdout is None else stdout,
+                                                    stderr=subprocess.PIPE, cwd=cwd or self.cwd, start_new_session=True)
+        with self.lock:
+            self.active.add(proc.pid)
+        tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+        readers = [asyncio.ensure_future(self.copyStderr(proc.stderr, tail, stderr))]
+        if stdout is subprocess.PIPE:
+            readers.append(asyncio.ensure_future(proc.stdout.read()))
+        watcher = asyncio.ensure_future(watchdog.watch(proc, self)) if watchdog else None
+        try:
+            await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            result.timed_out = True
+            self.log.write("{} exceeded its time limit of {:.0f} seconds, terminating it\n".format(name, timeout))
+            await self.terminate(proc)
+        except asyncio.CancelledError:
+            await self.terminate(proc)
+            raise
+        finally:
+            with self.lock:
+                self.active.discard(proc.pid)
+            if watcher:
+                watcher.cancel()
+                await asyncio.gather(watcher, return_exceptions=True)
+        # descendants that outlive the tool can hold its pipes open
+        done, pending = await asyncio.wait(readers, timeout=self.grace)
+        for reader in pending:
+            reader.cancel()
+        if stdout is subprocess.PIPE:
+            result.stdout = readers[1].result().decode(errors='replace') if readers[1] in done else ""
+        result.returncode = proc.returncode
+        result.stderr_tail = list(tail)
+        result.seconds = time() - start_time
+        if watchdog:
+            result.memory = watchdog.report()
+        if result.returncode != 0 or result.timed_out:
+            with self.lock:
+                self.failures.append(result)
+            if result.stderr_tail and not stderr:
+                self.log.write("{} returned {}, end of its stderr:\n    {}\n".format(name, result.returncode, "\n    ".join(result.stderr_tail[-10:])))
+        return result
+
+    def run(self, command, **kwargs):
+        """ runAsync, waited for """
+        return asyncio.run(self.runAsync(command, **kwargs))
+
+    def call(self, command, **kwargs):
+        """ like subprocess.call: the return code """
+        return self.run(command, **kwargs).returncode
+
+    def runMany(self, runs):
+        """ runs: list of dicts of runAsync arguments; run them all at once and return their RunResults in order """
+        async def runAll():
+            return await asyncio.gather(*[self.runAsync(**run) for run in runs])
+        return asyncio.run(runAll())
+
+    def killAll(self):
+        """ kill the process groups of all running tools (when this process is being stopped) """
+        with self.lock:
+            for pgid in self.active:
+                signalGroup(pgid, signal.SIGKILL)
+
+    def report(self):
+        return {'limits': self.limits, 'failures': [result.to_dict() for result in self.failures]}
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Fit the optional stages of a job into the walltime it was allocated.
+Only the contigs filter and the report are required once there is an assembly; polishing rounds, Quast and Bandage are optional.
+Before an optional stage starts, its cost is predicted from the size of its input (bases of reads, contig or graph bytes)
+and the threads it gets, or from the last run of the same stage when one has finished.
+If the prediction does not fit in what is left before the deadline, after holding back time for filtering and the report,
+the stage is shortened (Quast without its slower analyses) or dropped, and the decision is recorded.
+A stage that is run is also given a time limit of what it may spend, so an underestimate cannot eat into the reserve;
+the tool's own limit is restored when the stage ends, so required stages running the same tool are not cut short.
+Without a deadline every stage runs, as before.
+"""
+import sys
+from time import time, strftime, localtime
+
+# predicted seconds = fixed + per_gbp * Gbp of reads / threads + per_mb * MB of contigs or graph
+STAGE_COSTS = {
+    'racon': {'fixed': 60, 'per_gbp': 1800}, # minimap2 overlaps and racon consensus, one round
+    'pilon': {'fixed': 120, 'per_gbp': 3600}, # bowtie2 mapping, bam sorting and pilon, one round
+    'filter': {'fixed': 60, 'per_gbp': 1800}, # mapping all reads to the polished contigs for their depth
+    'quast': {'fixed': 30, 'per_mb': 20},
+    'quast_fast': {'fixed': 15, 'per_mb': 5},
+    'Bandage': {'fixed': 10, 'per_mb': 30}, # layout time grows quickly with graph size
+    'report': {'fixed': 60},
+}
+SAFETY_FACTOR = 1.5 # predictions from the model (not from a finished run) are this much above its typical cost
+
+class WalltimeBudget:
+    LOG = sys.stderr
+
+    def __init__(self, deadline=None, log=None):
+        """ deadline: time() by which the job must have written its results, or None for no limit """
+        self.deadline = deadline
+        self.log = log or WalltimeBudget.LOG
+        self.reserve = {} # required stage -> seconds held back for it
+        self.observed = {} # stage -> seconds of its last finished run
+        self.own_limits = {} # tool -> its limit before the budget capped it
+        self.decisions = []
+
+    def remaining(self):
+        return self.deadline - time() if self.deadline else None
+
+    def predict(self, stage, gbp=0, mb=0, threads=1):
+        """ seconds stage is expected to take on gbp billion bases of reads and mb megabytes of contigs or graph """
+        if stage in self.observed:
+            return self.observed[stage]
+        cost = STAGE_COSTS[stage]
+        return SAFETY_FACTOR * (cost.get('fixed', 0) + cost.get('per_gbp', 0) * gbp / max(1, threads) + cost.get('per_mb', 0) * mb)
+
+    def observe(self, stage, seconds):
+        """ later predictions for stage follow its last run """
+        self.observed[stage] = seconds
+
+    def hold(self, stage, seconds):
+        """ keep seconds for a required stage out of what optional stages may spend """
+        self.reserve[stage] = seconds
+
+    def release(self, stage):
+        self.reserve.pop(stage, None)
+
+    def spendable(self):
+        """ seconds optional stages may use now, or None without a deadline """
+        if not self.deadline:
+            return None
+        return self.remaining() - sum(self.reserve.values())
+
+    def fits(self, seconds):
+        spendable = self.spendable()
+        return spendable is None or seconds <= spendable
+
+    def allow(self, stage, seconds, details=None, outcome="skipped"):
+        """ True if seconds of stage fit in the budget; otherwise record that it was skipped (or what became of it) """
+        if self.fits(seconds):
+            return True
+        self.decide("{} {}: predicted {:.1f} minutes, {:.1f} minutes left after holding {:.1f} for {}".format(stage, outcome,
+            seconds / 60, max(0, self.spendable()) / 60, sum(self.reserve.values()) / 60, ", ".join(sorted(self.reserve)) or "nothing"), details)
+        return False
+
+    def decide(self, comment, details=None):
+        comment = "walltime budget: " + comment
+        self.log.write(comment + "\n")
+        self.decisions.append(comment)
+        if details is not None:
+            details['problem'].append(comment)
+
+    def limit(self, limits, tool):
+        """ cap limits[tool] (seconds, as ToolRunner uses them) at what optional stages may spend now, or at the tool's own limit if lower """
+        spendable = self.spendable()
+        if spendable is None:
+            return
+        own_limit = self.own_limits.setdefault(tool, limits.get(tool))
+        limits[tool] = max(1, min(own_limit or spendable, spendable))
+
+    def restore(self, limits, tool):
+        """ put back the limit tool had before limit() capped it, once the optional stage using it is over """
+        if tool not in self.own_limits:
+            return
+        own_limit = self.own_limits.pop(tool)
+        if own_limit is None:
+            limits.pop(tool, None)
+        else:
+            limits[tool] = own_limit
+
+    def report(self):
+        return {'deadline': strftime("%a, %d %b %Y %H:%M:%S", localtime(self.deadline)) if self.deadline else None,
+                'remaining_seconds': round(self.remaining()) if self.deadline else None,
+                'reserve': {stage: round(seconds) for stage, seconds in self.reserve.items()},
+                'observed': {stage: round(seconds, 1) for stage, seconds in self.observed.items()}, 'decisions': self.decisions}
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Compare pilon with the pileup consensus polisher (lib/PileupPolisher.py) on the same contigs and reads.
+Reads are mapped once with bowtie2; each polisher then runs as a child process so its
+wall time and peak RSS can be measured. Prints a table and optionally writes json.
+"""
+import sys
+import subprocess
+import argparse
+import os
+import os.path
+import re
+import shutil
+import json
+from time import time
+import PileupPolisher
+
+def mapReads(contigs, read_files, threads, work_dir):
+    """ bowtie2 map read_files (one file, or a pair) to contigs, return sorted, indexed bam """
+    index = os.path.join(work_dir, "contigs_index")
+    subprocess.check_call(["bowtie2-build", "--threads", str(threads), contigs, index], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    samFile = os.path.join(work_dir, "reads.sam")
+    command = ["bowtie2", "-p", str(threads), "-x", index]
+    if len(read_files) > 1:
+        command.extend(("-1", read_files[0], "-2", read_files[1]))
+    else:
+        command.extend(("-U", read_files[0]))
+    command.extend(("-S", samFile))
+    subprocess.check_call(command, stderr=subprocess.DEVNULL)
+    bamFile = os.path.join(work_dir, "reads.bam")
+    subprocess.check_call(["samtools", "sort", "-@", str(threads), "-o", bamFile, samFile])
+    subprocess.check_call(["samtools", "index", bamFile])
+    os.remove(samFile)
+    return bamFile
+
+def measure(command):
+    """ Run command, return (return_code, wall seconds, peak RSS in MB) """
+    start_time = time()
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    return_code = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is kilobytes on linux
+    return return_code, time() - start_time, rusage.ru_maxrss / 1024.0
+
+def changedPositions(changesFile):
+    """ Return set of (contig, position) from the old-coordinate column of a .changes file """
+    positions = set()
+    if not os.path.exists(changesFile):
+        return positions
+    with open(changesFile) as IN:
+        for line in IN:
+            m = re.match(r"(\S+):(\d+)", line)
+            if m:
+                positions.add((m.group(1), int(m.group(2))))
+    return positions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--contigs', required=True, help='contigs fasta to polish')
+    parser.add_argument('--reads', required=True, help='short-read fastq, or pair joined by ":"')
+    parser.add_argument('--pilon_jar', help='path to pilon jar (omit to benchmark only the pileup polisher)')
+    parser.add_argument('-t', '--threads', metavar='cores', type=int, default=8)
+    parser.add_argument('-m', '--memory', metavar='GB', type=int, default=32, help='heap for pilon')
+    parser.add_argument('--outputDirectory', '-d', default='benchmark_polishers_work')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    if os.path.exists(args.outputDirectory):
+        shutil.rmtree(args.outputDirectory)
+    os.mkdir(args.outputDirectory)
+    contigs = os.path.abspath(args.contigs)
+    read_files = [os.path.abspath(f) for f in args.reads.split(":")]
+    bamFile = mapReads(contigs, read_files, args.threads, args.outputDirectory)
+    bam_option = '--frags' if len(read_files) > 1 else '--unpaired'
+
+    polishers = [("pileup", [sys.executable, PileupPolisher.__file__, '--genome', contigs, '--bam', bamFile,
+                    '--output', os.path.join(args.outputDirectory, "pileup")])]
+    if args.pilon_jar:
+        polishers.append(("pilon", ['java', '-Xmx{}G'.format(args.memory), '-jar', args.pilon_jar, '--genome', contigs,
+                    bam_option, bamFile, '--outdir', args.outputDirectory, '--output', 'pilon', '--changes', '--threads', str(args.threads)]))
+    results = {}
+    for name, command in polishers:
+        return_code, seconds, peak_mb = measure(command)
+        changes = changedPositions(os.path.join(args.outputDirectory, name+".changes"))
+        results[name] = {"return_code": return_code, "seconds": seconds, "peak_rss_mb": peak_mb, "num_changes": len(changes)}
+        results[name]["positions"] = changes
+    if "pilon" in results:
+        shared = results["pileup"]["positions"] & results["pilon"]["positions"]
+        results["shared_changes"] = len(shared)
+    for name, command in polishers:
+        del results[name]["positions"]
+
+    print("{:<8}{:>8}{:>12}{:>14}{:>10}".format("polisher", "rc", "seconds", "peak_rss_mb", "changes"))
+    for name, command in polishers:
+        r = results[name]
+        print("{:<8}{:>8}{:>12.1f}{:>14.1f}{:>10}".format(name, r["return_code"], r["seconds"], r["peak_rss_mb"], r["num_changes"]))
+    if "shared_changes" in results:
+        print("changes found by both: {}".format(results["shared_changes"]))
+    if args.json:
+        with open(args.json, 'w') as OUT:
+            json.dump(results, OUT, indent=2)
+
+if __name__ == "__main__":
+    main()
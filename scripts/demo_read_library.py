@@ -16,6 +16,8 @@ from time import time, localtime, strftime
 import json
 import glob
 from ReadLibrary import ReadLibrary
+from RunContext import RunContext
+from ResourceManager import ResourceManager
 MAX_BASES=1e11
 
 def main():
@@ -37,19 +39,17 @@ def main():
     args = parser.parse_args()
     
     WORK_DIR = args.outputDirectory
-    ReadLibrary.WORK_DIR = WORK_DIR   
     if not os.path.exists(WORK_DIR):
         os.mkdir(WORK_DIR)
-    ReadLibrary.NUM_THREADS = args.threads
-    ReadLibrary.LOG = sys.stderr
+    context = RunContext(WORK_DIR, log=sys.stderr, resources=ResourceManager(threads=args.threads, log=sys.stderr))
     read_list = []
     if args.anonymous_reads:
         for item in args.anonymous_reads:
             if ':' in item:
                 read_pair = item.split(':')
-                readLib = ReadLibrary(read_pair, work_dir=WORK_DIR)
+                readLib = ReadLibrary(read_pair, work_dir=WORK_DIR, context=context)
             else:
-                readLib = ReadLibrary(item, work_dir=WORK_DIR)
+                readLib = ReadLibrary(item, work_dir=WORK_DIR, context=context)
             read_list.append(readLib)
 
     if args.illumina:
@@ -57,23 +57,23 @@ def main():
         for item in args.illumina:
             if ':' in item:
                 read_pair = item.split(':')
-                readLib = ReadLibrary(read_pair, platform=platform, work_dir=WORK_DIR)
+                readLib = ReadLibrary(read_pair, platform=platform, work_dir=WORK_DIR, context=context)
             else:
                 interleaved = args.interleaved and item in args.interleaved
-                readLib = ReadLibrary(item, platform=platform, interleaved=interleaved, work_dir=WORK_DIR)
+                readLib = ReadLibrary(item, platform=platform, interleaved=interleaved, work_dir=WORK_DIR, context=context)
             read_list.append(readLib)
 
     if args.iontorrent:
         platform = 'iontorrent'
         for item in args.iontorrent:
             interleaved = args.interleaved and item in args.interleaved
-            readLib = ReadLibrary(item, platform=platform, interleaved=interleaved, work_dir=WORK_DIR)
+            readLib = ReadLibrary(item, platform=platform, interleaved=interleaved, work_dir=WORK_DIR, context=context)
             read_list.append(readLib)
 
     if args.pacbio:
         platform='pacbio'
         for item in args.pacbio:
-            readLib = ReadLibrary(item, platform=platform, work_dir=WORK_DIR)
+            readLib = ReadLibrary(item, platform=platform, work_dir=WORK_DIR, context=context)
             read_list.append(readLib)
 
     if args.nanopore:
@@ -81,21 +81,18 @@ def main():
         platform='nanopore'
         for item in args.nanopore:
             print(item)
-            readLib = ReadLibrary(item, platform=platform, work_dir=WORK_DIR)
+            readLib = ReadLibrary(item, platform=platform, work_dir=WORK_DIR, context=context)
             read_list.append(readLib)
 
     if args.fasta:
         for item in args.fasta:
             if ':' in item:
                 read_pair = item.split(':')
-                readLib = ReadLibrary(read_pair, work_dir=WORK_DIR)
+                readLib = ReadLibrary(read_pair, work_dir=WORK_DIR, context=context)
             else:
-                readLib = ReadLibrary(item, work_dir=WORK_DIR)
+                readLib = ReadLibrary(item, work_dir=WORK_DIR, context=context)
             read_list.append(readLib)
 
-    # move into working directory so that all files are local
-    os.chdir(WORK_DIR)
-
     if args.trim:
         for read_set in read_list:
             if read_set.length_class == "short" and read_set.format == 'fastq': # TrimGalore only works on short fastq reads
@@ -110,7 +107,7 @@ def main():
             if read_set.num_bases > args.max_bases:
                 read_set.down_sample_reads(args.max_bases)
 
-    htmlFile = os.path.join("demo_read_library.html")
+    htmlFile = context.path("demo_read_library.html")
     HTML = open(htmlFile, 'wt')
     HTML.write("<!DOCTYPE html><html>\n")
 
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Assemble a batch of samples on one node, sharing its threads and memory between them.
+The manifest is json: a list of samples, or {"defaults": {...}, "samples": [...]}, where each sample has a "name"
+and p3x-assembly.py options as keys (e.g. "illumina": ["a_R1.fq:a_R2.fq"], "recipe": "unicycler", "trim": true).
+Each sample runs as its own p3x-assembly.py job in <outputDirectory>/<name>, with its own save directory and report,
+but every tool run of every sample leases threads and memory from one ResourceBroker, so cheap stages of some samples
+fill in around the long assemblies of others instead of each job assuming it has the whole node.
+All samples share one tool registry. A summary of the batch is written to <outputDirectory>/batch_summary.json.
+"""
+import sys
+import os
+import os.path
+import argparse
+import json
+import shutil
+import subprocess
+import concurrent.futures
+from time import time, localtime, strftime
+import ResourceManager as ResourceManagerModule
+from ResourceManager import ResourceManager, ResourceBroker
+
+# options the batch sets for each sample itself
+BATCH_OPTIONS = ('outputDirectory', 'prefix', 'resource_broker', 'tool_registry', 'threads', 'memory')
+READ_OPTIONS = ('illumina', 'iontorrent', 'pacbio', 'nanopore', 'fasta', 'anonymous_reads', 'interleaved')
+
+def readManifest(manifest_file):
+    """ list of sample dicts, each with the defaults filled in """
+    with open(manifest_file) as IN:
+        manifest = json.load(IN)
+    if isinstance(manifest, list):
+        manifest = {'samples': manifest}
+    samples = []
+    names = set()
+    for entry in manifest['samples']:
+        sample = dict(manifest.get('defaults', {}))
+        sample.update(entry)
+        if not sample.get('name'):
+            raise ValueError("sample without a name in {}: {}".format(manifest_file, entry))
+        if sample['name'] in names:
+            raise ValueError("sample name {} used twice in {}".format(sample['name'], manifest_file))
+        names.add(sample['name'])
+        for option in BATCH_OPTIONS:
+            if option in sample:
+                raise ValueError("sample {}: option {} is set by the batch".format(sample['name'], option))
+        samples.append(sample)
+    return samples
+
+def sampleReadFiles(sample):
+    """ read file paths of a sample (pairs joined by ':' or '%' are split), made absolute in place """
+    files = []
+    for option in READ_OPTIONS:
+        if sample.get(option):
+            values = sample[option] if isinstance(sample[option], list) else [sample[option]]
+            absolute = []
+            for value in values:
+                separator = ':' if ':' in value else '%' if '%' in value else None
+                parts = value.split(separator) if separator else [value]
+                parts = [os.path.abspath(part) for part in parts]
+                files.extend(parts)
+                absolute.append(separator.join(parts) if separator else parts[0])
+            sample[option] = absolute
+    return files
+
+def sampleOptions(sample):
+    """ p3x-assembly.py command-line options from the sample's keys """
+    options = []
+    for key, value in sorted(sample.items()):
+        if key == 'name' or value is None or value is False:
+            continue
+        options.append("--"+key)
+        if value is True:
+            continue
+        if isinstance(value, list):
+            options.extend(str(item) for item in value)
+        else:
+            options.append(str(value))
+    return options
+
+def assemblyCommand():
+    """ the deployed p3x-assembly, or p3x-assembly.py next to this script """
+    deployed = shutil.which("p3x-assembly")
+    if deployed:
+        return [deployed]
+    return [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "p3x-assembly.py")]
+
+def runSample(sample, args, broker_address, origin):
+    """ run one sample's job to completion; return its summary """
+    sample_dir = os.path.join(args.outputDirectory, sample['name'])
+    if not os.path.exists(sample_dir):
+        os.makedirs(sample_dir)
+    prefix = sample['name']+"_"
+    command = assemblyCommand() + ['-d', os.path.join(sample_dir, "p3_assembly_work"), '--prefix', prefix,
+            '-t', str(args.sample_threads), '-m', str(args.sample_memory or args.memory),
+            '--resource_broker', broker_address] + sampleOptions(sample) + args.extra
+    if args.tool_registry is not None:
+        command += ['--tool_registry', args.tool_registry]
+    env = dict(os.environ)
+    lib_dir = os.path.dirname(os.path.abspath(ResourceManagerModule.__file__))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [lib_dir, env.get('PYTHONPATH')]))
+    start = time()
+    with open(os.path.join(sample_dir, "p3x-assembly.stdout"), 'w') as OUT, open(os.path.join(sample_dir, "p3x-assembly.stderr"), 'w') as ERR:
+        return_code = subprocess.call(command, cwd=sample_dir, stdout=OUT, stderr=ERR, env=env)
+    end = time()
+    save_dir = os.path.join(sample_dir, "p3_assembly_work", "save")
+    sys.stderr.write("{} sample {} finished, return code {}, {:.0f} seconds\n".format(strftime("%H:%M:%S", localtime(end)), sample['name'], return_code, end - start))
+    return {'name': sample['name'], 'return_code': return_code, 'start': round(start - origin, 1), 'end': round(end - origin, 1),
+            'seconds': round(end - start, 1), 'save_dir': save_dir, 'report': os.path.join(save_dir, prefix+"AssemblyReport.html"),
+            'command': command}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help='json list of samples')
+    parser.add_argument('--outputDirectory', '-d', default='p3_batch_work')
+    parser.add_argument('-t', '--threads', metavar='cores', type=int, default=8, help='threads of the whole batch')
+    parser.add_argument('-m', '--memory', metavar='GB', type=int, default=125, help='RAM limit of the whole batch in Gb')
+    parser.add_argument('--sample_threads', type=int, help='most threads one sample uses at once (default: half the batch threads)')
+    parser.add_argument('--sample_memory', type=int, help='most memory one sample uses at once, in Gb (default: all of the batch memory)')
+    parser.add_argument('--max_concurrent', type=int, help='samples in progress at once (default: enough to keep the threads busy)')
+    parser.add_argument('--tool_registry', help='tool registry shared by the samples (default: that of p3x-assembly.py)')
+    parser.add_argument('extra', nargs=argparse.REMAINDER, help='after --, options for every sample')
+    args = parser.parse_args()
+    if args.extra and args.extra[0] == '--':
+        args.extra = args.extra[1:]
+
+    samples = readManifest(args.manifest)
+    missing = []
+    input_bytes = {}
+    for sample in samples:
+        files = sampleReadFiles(sample)
+        missing.extend(path for path in files if not os.path.exists(path))
+        input_bytes[sample['name']] = sum(os.path.getsize(path) for path in files if os.path.exists(path))
+    if missing:
+        sys.stderr.write("read files not found:\n  "+"\n  ".join(missing)+"\n")
+        return 1
+    args.outputDirectory = os.path.abspath(args.outputDirectory)
+    if not os.path.exists(args.outputDirectory):
+        os.makedirs(args.outputDirectory)
+
+    manager = ResourceManager(threads=args.threads, memory_gb=args.memory)
+    args.sample_threads = min(args.sample_threads or max(1, manager.threads // 2), manager.threads)
+    max_concurrent = args.max_concurrent or max(2, 2 * manager.threads // args.sample_threads)
+    broker = ResourceBroker(manager, os.path.join(args.outputDirectory, "resource_broker.sock"))
+    origin = time()
+    # largest samples first, so the small ones fill in around them at the end
+    samples.sort(key=lambda sample: -input_bytes[sample['name']])
+    sys.stderr.write("running {} samples, up to {} at once, {} threads each, on {} threads\n".format(len(samples), max_concurrent, args.sample_threads, manager.threads))
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = [executor.submit(runSample, sample, args, broker.address, origin) for sample in samples]
+        for future in concurrent.futures.as_completed(futures):
+            results.append(future.result())
+    broker.close()
+
+    makespan = time() - origin
+    report = manager.report(origin)
+    thread_seconds = sum(lease['threads'] * ((lease['end'] or makespan) - lease['start']) for lease in report['leases'])
+    summary = {'samples': sorted(results, key=lambda result: result['start']), 'makespan_seconds': round(makespan, 1),
+               'sum_of_sample_seconds': round(sum(result['seconds'] for result in results), 1),
+               'thread_utilization': round(thread_seconds / (manager.threads * makespan), 3) if makespan else None,
+               'failed': [result['name'] for result in results if result['return_code']], 'resources': report}
+    with open(os.path.join(args.outputDirectory, "batch_summary.json"), 'w') as OUT:
+        json.dump(summary, OUT, indent=2)
+    print("{:<24}{:>8}{:>10}{:>10}{:>10}".format("sample", "status", "start", "end", "seconds"))
+    for result in summary['samples']:
+        print("{:<24}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}".format(result['name'], "ok" if result['return_code'] == 0 else "rc="+str(result['return_code']),
+              result['start'], result['end'], result['seconds']))
+    print("makespan {:.1f} seconds, sum of sample wall times {:.1f} seconds, thread utilization {}".format(
+          makespan, summary['sum_of_sample_seconds'], summary['thread_utilization']))
+    return 1 if summary['failed'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Run p3x-assembly jobs submitted to a spool directory, in one long-lived process on the node.
+A job is a json manifest {"argv": [p3x-assembly options], "cwd": directory, "log": file} written to <spool>/incoming/<job>.json
+(write it under another name and rename it into place). Relative paths in argv are taken relative to cwd,
+and the job logs to log (default <spool>/logs/<job>.log).
+The daemon moves the manifest to <spool>/jobs, runs up to --max_jobs jobs at once, and keeps <spool>/status/<job>.json
+up to date, with state queued, running, done or failed; <spool>/daemon.json has its pid and a heartbeat.
+Because the jobs run in this process, what one job learns stays warm for the next: tool versions (one ToolRegistry),
+file digests of the artifact cache (--cache_dir is the default of every job), and imported code.
+All jobs lease threads and memory from one ResourceBroker, as the samples of p3x-assembly-batch do.
+To try it with the stand-in tools: --path_prefix benchmarks/shims, and jobs with --pilon_jar naming any existing file.
+"""
+import sys
+import os
+import os.path
+import argparse
+import importlib.util
+import json
+import signal
+import threading
+import traceback
+import uuid
+import concurrent.futures
+from time import time, sleep, localtime, strftime
+from ResourceManager import ResourceManager, ResourceBroker
+from ToolRegistry import ToolRegistry
+from ArtifactCache import ArtifactCache
+
+# options of a job naming files or directories, made absolute relative to the job's cwd
+PATH_OPTIONS = ('outputDirectory', 'contigs', 'cache_dir', 'event_log', 'trusted_contigs', 'untrusted_contigs', 'pilon_jar', 'params_json')
+READ_OPTIONS = ('illumina', 'iontorrent', 'pacbio', 'nanopore', 'fasta', 'anonymous_reads', 'interleaved')
+EXECUTABLE_OPTIONS = ('canu_exec', 'spades_for_unicycler') # only when given as a path rather than a name on PATH
+FINISHED = ('done', 'failed')
+
+def loadAssemblyScript():
+    """ import p3x-assembly.py from next to this script (not importable by name because of the hyphen) """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "p3x-assembly.py")
+    spec = importlib.util.spec_from_file_location("p3x_assembly", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def writeJson(path, data):
+    """ replace path atomically, so pollers never read a partial file """
+    temp_file = "{}.{}.tmp".format(path, uuid.uuid4().hex[:8])
+    with open(temp_file, 'w') as OUT:
+        json.dump(data, OUT, indent=2)
+    os.replace(temp_file, path)
+
+def absolutePaths(args, cwd):
+    """ make the file options of parsed args absolute relative to cwd (read pairs joined by ':' or '%' part by part) """
+    def absolute(path):
+        return os.path.join(cwd, path) if path else path
+    for option in PATH_OPTIONS:
+        setattr(args, option, absolute(getattr(args, option)))
+    for option in EXECUTABLE_OPTIONS:
+        value = getattr(args, option)
+        if value and os.sep in value:
+            setattr(args, option, absolute(value))
+    for option in READ_OPTIONS:
+        values = getattr(args, option)
+        if values:
+            absolute_values = []
+            for value in values:
+                separator = ':' if ':' in value else '%' if '%' in value else None
+                parts = value.split(separator) if separator else [value]
+                absolute_values.append((separator or '').join(absolute(part) for part in parts))
+            setattr(args, option, absolute_values)
+
+class AssemblyDaemon:
+    LOG = sys.stderr
+
+    def __init__(self, spool, args):
+        self.spool = os.path.abspath(spool)
+        self.args = args
+        for name in ("incoming", "jobs", "status", "logs"):
+            directory = os.path.join(self.spool, name)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        self.assembly = loadAssemblyScript()
+        self.tools = ToolRegistry(args.tool_registry)
+        self.manager = ResourceManager(threads=args.threads, memory_gb=args.memory)
+        self.broker = ResourceBroker(self.manager, os.path.join(self.spool, "resource_broker.sock"))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.max_jobs)
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.path_lock = threading.Lock()
+        self.stopping = False
+        self.start_time = time()
+        self.jobs_run = 0
+        self.recoverJobs()
+
+    def statusFile(self, job_id):
+        return os.path.join(self.spool, "status", job_id+".json")
+
+    def setStatus(self, job_id, **fields):
+        status_file = self.statusFile(job_id)
+        with self.lock:
+            status = {}
+            if os.path.exists(status_file):
+                with open(status_file) as IN:
+                    status = json.load(IN)
+            status.update(fields)
+            status['updated'] = time()
+            writeJson(status_file, status)
+        return status
+
+    def recoverJobs(self):
+        """ jobs a previous daemon accepted but did not finish cannot be resumed safely; mark them failed """
+        for name in sorted(os.listdir(os.path.join(self.spool, "jobs"))):
+            job_id = name[:-len(".json")]
+            if name.endswith(".json") and os.path.exists(self.statusFile(job_id)):
+                with open(self.statusFile(job_id)) as IN:
+                    state = json.load(IN).get('state')
+                if state not in FINISHED:
+                    self.setStatus(job_id, state='failed', finished=time(), error="daemon stopped while the job was "+state)
+                    AssemblyDaemon.LOG.write("job {} was {} when the previous daemon stopped, marked failed\n".format(job_id, state))
+
+    def heartbeat(self):
+        with self.lock:
+            running = sum(1 for future in self.futures.values() if not future.done())
+        writeJson(os.path.join(self.spool, "daemon.json"), {'pid': os.getpid(), 'started': self.start_time, 'heartbeat': time(),
+            'max_jobs': self.args.max_jobs, 'running': running, 'jobs_run': self.jobs_run, 'stopping': self.stopping,
+            'threads': self.manager.threads, 'memory_gb': round(self.manager.memory_gb, 2),
+            'tools': self.tools.report(), 'cached_digests': len(ArtifactCache.digests)})
+
+    def acceptJobs(self):
+        """ move new manifests from incoming to jobs and queue them, oldest first """
+        incoming = os.path.join(self.spool, "incoming")
+        names = [name for name in os.listdir(incoming) if name.endswith(".json")]
+        names.sort(key=lambda name: os.path.getmtime(os.path.join(incoming, name)))
+        for name in names:
+            job_id = name[:-len(".json")]
+            manifest_file = os.path.join(self.spool, "jobs", name)
+            os.replace(os.path.join(incoming, name), manifest_file)
+            try:
+                with open(manifest_file) as IN:
+                    manifest = json.load(IN)
+                if not isinstance(manifest.get('argv'), list):
+                    raise ValueError("manifest has no argv list")
+            except (IOError, ValueError) as e:
+                self.setStatus(job_id, state='failed', submitted=time(), finished=time(), error="bad manifest: {}".format(e))
+                continue
+            self.setStatus(job_id, state='queued', submitted=time(), manifest=manifest_file)
+            AssemblyDaemon.LOG.write("{} queued job {}\n".format(strftime("%H:%M:%S"), job_id))
+            with self.lock:
+                self.futures[job_id] = self.executor.submit(self.runJob, job_id, manifest)
+
+    def addToPath(self, directories):
+        """ put directories a job asks for on PATH (for all jobs from now on, since PATH is shared by the process) """
+        with self.path_lock:
+            path = os.environ["PATH"].split(":")
+            missing = [directory for directory in directories if directory not in path]
+            if missing:
+                os.environ["PATH"] = ":".join(missing + path)
+                AssemblyDaemon.LOG.write("added {} to PATH\n".format(" ".join(missing)))
+
+    def jobArgs(self, manifest):
+        """ parsed p3x-assembly options of a job, adjusted to run inside the daemon """
+        cwd = os.path.abspath(manifest.get('cwd') or self.spool)
+        args = self.assembly.argumentParser().parse_args(manifest['argv'])
+        absolutePaths(args, cwd)
+        if args.path_prefix:
+            self.addToPath([os.path.join(cwd, directory) for directory in args.path_prefix])
+            args.path_prefix = None
+        if not args.resource_broker:
+            args.resource_broker = self.broker.address
+        if not args.cache_dir and self.args.cache_dir:
+            args.cache_dir = os.path.abspath(self.args.cache_dir)
+        if self.args.max_jobs > 1:
+            args.telemetry_interval = 0 # telemetry tracks every subprocess of the process, so it cannot tell concurrent jobs apart
+        return args
+
+    def runJob(self, job_id, manifest):
+        log_file = os.path.abspath(manifest.get('log') or os.path.join(self.spool, "logs", job_id+".log"))
+        start_time = time()
+        self.setStatus(job_id, state='running', started=start_time, log=log_file)
+        AssemblyDaemon.LOG.write("{} running job {}\n".format(strftime("%H:%M:%S"), job_id))
+        with open(log_file, 'a') as LOG:
+            try:
+                args = self.jobArgs(manifest)
+                self.setStatus(job_id, work_dir=args.outputDirectory, save_dir=os.path.join(args.outputDirectory, "save"))
+                return_code = self.assembly.runAssembly(args, log=LOG, tools=self.tools)
+                if return_code == 0:
+                    status = self.setStatus(job_id, state='done', finished=time(), seconds=round(time() - start_time, 1), return_code=return_code)
+                else:
+                    status = self.setStatus(job_id, state='failed', finished=time(), seconds=round(time() - start_time, 1), return_code=return_code,
+                                            error="assembly returned {}".format(return_code))
+            except (Exception, SystemExit) as e: # argparse exits on bad options
+                LOG.write(traceback.format_exc())
+                status = self.setStatus(job_id, state='failed', finished=time(), seconds=round(time() - start_time, 1),
+                                        error="{}: {}".format(type(e).__name__, e))
+        with self.lock:
+            self.jobs_run += 1
+        AssemblyDaemon.LOG.write("{} job {} {} after {:.0f} seconds\n".format(strftime("%H:%M:%S"), job_id, status['state'], status['seconds']))
+
+    def idle(self):
+        with self.lock:
+            return all(future.done() for future in self.futures.values())
+
+    def stop(self, signum=None, frame=None):
+        if not self.stopping:
+            AssemblyDaemon.LOG.write("stopping: no new jobs will be accepted, waiting for running jobs\n")
+        self.stopping = True
+
+    def serve(self):
+        AssemblyDaemon.LOG.write("{} serving spool {}, up to {} jobs at once\n".format(strftime("%a, %d %b %Y %H:%M:%S", localtime()), self.spool, self.args.max_jobs))
+        while True:
+            if not self.stopping:
+                self.acceptJobs()
+            self.heartbeat()
+            if self.stopping and self.idle():
+                break
+            if self.args.once and self.idle() and not os.listdir(os.path.join(self.spool, "incoming")):
+                break
+            sleep(self.args.poll)
+        self.executor.shutdown()
+        self.broker.close()
+        self.stopping = True
+        self.heartbeat()
+        AssemblyDaemon.LOG.write("ran {} jobs in {:.0f} seconds\n".format(self.jobs_run, time() - self.start_time))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spool', help='spool directory')
+    parser.add_argument('--max_jobs', type=int, default=2, help='jobs run at once')
+    parser.add_argument('-t', '--threads', metavar='cores', type=int, help='threads shared by all jobs (default: the whole allocation)')
+    parser.add_argument('-m', '--memory', metavar='GB', type=int, help='RAM shared by all jobs in Gb (default: the whole allocation)')
+    parser.add_argument('--cache_dir', help='artifact cache for jobs that do not name one')
+    parser.add_argument('--tool_registry', help='tool registry shared by the jobs (default: that of p3x-assembly.py)')
+    parser.add_argument('--path_prefix', '--path-prefix', nargs='*', help='add the given directories to the PATH of all jobs')
+    parser.add_argument('--poll', type=float, default=2.0, help='seconds between looks at the spool')
+    parser.add_argument('--once', action='store_true', help='exit when no job is queued or running')
+    args = parser.parse_args()
+
+    if args.path_prefix:
+        os.environ["PATH"] = ":".join(os.path.abspath(directory) for directory in args.path_prefix) + ":" + os.environ["PATH"]
+    daemon = AssemblyDaemon(args.spool, args)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.serve()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
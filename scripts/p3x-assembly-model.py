@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Fit resource models to earlier assembly runs and predict CPU, memory, walltime and storage for a new job.
+  fit:     from run_details.json files (or directories of them) and analyze-assembly-data*.pl tables, write a model json
+  predict: print the preflight request (cpu, memory, runtime, storage) for a job as json
+  summary: list the fitted models
+See lib/RunAnalytics.py for the model.
+"""
+import sys
+import os
+import argparse
+import json
+import math
+from RunAnalytics import ResourceModel, loadRunDetails, loadAccounting, BASES_PER_BYTE, TYPICAL_READ_LENGTH, LONG_READ_PLATFORMS
+
+def resolveRecipe(recipe, platforms):
+    """ the recipe p3x-assembly.py runs for 'auto' (or none given) """
+    if recipe and recipe != 'auto':
+        return recipe
+    if any(platform not in LONG_READ_PLATFORMS for platform in platforms):
+        return 'unicycler'
+    return 'flye'
+
+def runFit(args):
+    samples = loadRunDetails(args.run_details, include_problems=args.include_problems)
+    for accounting_file in args.accounting:
+        samples.extend(loadAccounting(accounting_file))
+    if not samples:
+        sys.stderr.write("no usable runs found\n")
+        return 1
+    model = ResourceModel.fit(samples)
+    model.save(args.model)
+    sys.stderr.write("fitted {} runs, wrote {}\n".format(len(samples), args.model))
+    for line in model.summary():
+        sys.stderr.write(line+"\n")
+    return 0
+
+def runPredict(args):
+    platforms = args.platform or ['illumina']
+    bases = args.bases or args.compressed_bytes * BASES_PER_BYTE['compressed'] + args.uncompressed_bytes * BASES_PER_BYTE['uncompressed']
+    if not bases:
+        sys.stderr.write("need --bases or input file sizes\n")
+        return 1
+    sample = {'recipe': resolveRecipe(args.recipe, platforms), 'bases': bases,
+              'read_length': args.read_length or max(TYPICAL_READ_LENGTH.get(platform, 150) for platform in platforms),
+              'long_reads': any(platform in LONG_READ_PLATFORMS for platform in platforms),
+              'short_reads': any(platform not in LONG_READ_PLATFORMS for platform in platforms),
+              'trim': args.trim, 'normalize': args.normalize}
+    predictions = ResourceModel.load(args.model).predict(sample, quantile=args.quantile)
+    # only what the model can predict; the caller keeps its own estimate for the rest
+    request = {'recipe': sample['recipe'], 'bases': int(bases), 'predictions': predictions}
+    if 'cpu' in predictions:
+        request['cpu'] = min(args.max_cpu, max(1, int(math.ceil(predictions['cpu']['value']))))
+    if 'peak_memory_gb' in predictions:
+        request['memory'] = "{}G".format(max(args.min_memory_gb, int(math.ceil(predictions['peak_memory_gb']['value'] * args.headroom))))
+    if 'runtime_seconds' in predictions:
+        request['runtime'] = max(args.min_runtime, int(predictions['runtime_seconds']['value'] * args.headroom))
+    if 'scratch_gb' in predictions:
+        request['storage'] = int(predictions['scratch_gb']['value'] * args.headroom * 1e9)
+    json.dump(request, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 0
+
+def runSummary(args):
+    for line in ResourceModel.load(args.model).summary():
+        print(line)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fit = subparsers.add_parser('fit', help='fit models to earlier runs', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    fit.add_argument('run_details', nargs='*', help='run_details.json files or directories containing them')
+    fit.add_argument('--accounting', nargs='*', default=[], help='tables from analyze-assembly-data.pl, -data2.pl or -data3.pl')
+    fit.add_argument('--include_problems', action='store_true', help='also use runs that recorded problems')
+    fit.add_argument('--model', default='assembly_model.json', help='write the model here')
+    fit.set_defaults(func=runFit)
+
+    predict = subparsers.add_parser('predict', help='resources for a job', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    predict.add_argument('--model', required=True, help='model json from fit')
+    predict.add_argument('--recipe', default='auto')
+    predict.add_argument('--bases', type=float, default=0, help='total bases of the reads')
+    predict.add_argument('--compressed_bytes', type=float, default=0, help='size of gzipped read files, when bases are not known')
+    predict.add_argument('--uncompressed_bytes', type=float, default=0, help='size of uncompressed read files, when bases are not known')
+    predict.add_argument('--platform', nargs='*', help='platforms of the reads (illumina, iontorrent, nanopore, pacbio)')
+    predict.add_argument('--read_length', type=float, help='mean read length (default: typical for the platforms)')
+    predict.add_argument('--trim', action='store_true')
+    predict.add_argument('--normalize', action='store_true')
+    predict.add_argument('--quantile', type=float, default=0.9, help='predict this quantile of earlier runs')
+    predict.add_argument('--headroom', type=float, default=1.2, help='multiply memory, runtime and storage by this')
+    predict.add_argument('--max_cpu', type=int, default=12)
+    predict.add_argument('--min_memory_gb', type=int, default=8)
+    predict.add_argument('--min_runtime', type=int, default=3600, help='seconds')
+    predict.set_defaults(func=runPredict)
+
+    summary = subparsers.add_parser('summary', help='list fitted models')
+    summary.add_argument('--model', required=True)
+    summary.set_defaults(func=runSummary)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,7 +15,25 @@ except ImportError:
 from time import time, localtime, strftime
 import json
 import glob
+import copy
+import shlex
+import signal
+import threading
+import concurrent.futures
 from ReadLibrary import ReadLibrary
+from PileupPolisher import PileupPolisher
+from StageManifest import StageManifest
+from ArtifactCache import ArtifactCache
+from ResourceManager import ResourceManager, RemoteResourceManager
+from Telemetry import Telemetry
+from EventLog import EventLog
+from StageProfiler import StageProfiler
+from ToolRegistry import ToolRegistry
+from RunContext import RunContext
+from Executor import LocalExecutor, BatchExecutor, missingFiles
+from ToolRunner import ToolRunner
+from WalltimeBudget import WalltimeBudget
+from MemoryWatchdog import MemoryWatchdog
 
 """
 This script organizes a command line for an assembly program: 
@@ -33,129 +51,142 @@ TODO: properly handle different kinds of pacbio reads
 
 DEFAULT_GENOME_SIZE = "5m"
 MAX_BASES=5e9
-LOG = None # create a log file at start of main()
-START_TIME = None
-WORK_DIR = None
-SAVE_DIR = None
-DETAILS_DIR = None
-
-def runQuast(contigsFile, args, details):
-    LOG.write("runQuast: time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
-    quastDir = "quast_out"
+PILON_MIN_HEAP_GB = 2 # smallest heap given to any pilon jvm
+PILON_GB_PER_MBASE = 1.0 # pilon rule of thumb: about 1GB heap per megabase of target sequence
+PILON_GB_PER_BAM_GB = 2.0 # additional heap per GB of bam covering the targets
+PILON_THREADS_PER_SHARD = 4 # pilon scales poorly past a few threads
+PILON_WINDOW_FRACTION = 0.5 # re-polish whole assembly if changed windows would cover more than this fraction
+RACON_THREADS_PER_PARTITION = 4
+RACON_MIN_MEMORY_GB = 1
+RACON_GB_PER_READ_GB = 3.0 # racon holds the reads, overlaps and window alignments of its partition
+# after an assembler runs out of memory, each retry applies the next of these that still changes something
+MEMORY_RETRY_STRATEGIES = ('threads', 'kmers', 'reads')
+LOW_MEMORY_KMERS = "21,33,55" # fewer and shorter k-mers than the assemblers choose for typical read lengths
+
+def runQuast(context, contigsFile, args, details, fast=False):
+    """ fast: skip quast's slower analyses (--fast), when the walltime budget does not fit a full run """
+    context.log.write("runQuast: time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
+    quastDir = context.path("quast_out")
+    lease = context.resources.lease('quast', threads=args.threads)
     quastCommand = ["quast.py",
-                    "-o", quastDir,
-                    "-t", str(args.threads),
-                    "--min-contig", str(args.min_contig_length),
-                    contigsFile]
-    LOG.write("running quast: "+" ".join(quastCommand)+"\n")
-    with open(os.devnull, 'w') as FNULL: # send stdout to dev/null
-        return_code = subprocess.call(quastCommand, shell=False, stdout=FNULL, stderr=FNULL)
-    LOG.write("return code = %d\n"%return_code)
+                    "-o", quastDir] + lease.flags() + [
+                    "--min-contig", str(args.min_contig_length)]
+    if fast:
+        quastCommand.append("--fast")
+    quastCommand.append(contigsFile)
+    context.log.write("running quast: "+" ".join(quastCommand)+"\n")
+    return_code = context.runner.call(quastCommand)
+    lease.release()
+    context.log.write("return code = %d\n"%return_code)
     if return_code == 0:
-        shutil.move(os.path.join(quastDir, "report.html"), os.path.join(DETAILS_DIR, args.prefix+"quast_report.html"))
-        shutil.move(os.path.join(quastDir, "report.txt"), os.path.join(DETAILS_DIR, args.prefix+"quast_report.txt"))
+        shutil.move(os.path.join(quastDir, "report.html"), os.path.join(context.details_dir, args.prefix+"quast_report.html"))
+        shutil.move(os.path.join(quastDir, "report.txt"), os.path.join(context.details_dir, args.prefix+"quast_report.txt"))
         details["quast_txt"] = "details/"+args.prefix+"quast_report.txt"
         details["quast_html"] = "details/"+args.prefix+"quast_report.html"
-        quastCommand = ["quast.py", "--version"]
-        proc = subprocess.Popen(quastCommand, shell=False, stdout=subprocess.PIPE)
-        version_text = proc.stdout.read().decode()
-        proc.wait()
-        details["version"]["quast"] = version_text
+        details["version"]["quast"] = context.tools.version("quast.py")
 
-def filterContigsByLengthAndCoverage(inputContigs, read_list, args, details):   #, min_contig_length=300, min_contig_coverage=5, threads=1, prefix=""):
+def writeFilteredContigs(inputContigs, outputContigs, suboptimalContigs, shortReadDepth, longReadDepth, min_length, min_coverage, prefix=""):
+    """
+    Renumber contigs from inputContigs as <prefix>contig_N, writing those at or above min_length and min_coverage
+    (by short or long read depth: dicts of contig id to (coverage, normalized coverage)) to outputContigs, the rest to suboptimalContigs.
+    Return (num_good_contigs, num_bad_contigs, total_seq_length, weighted_short_read_coverage, weighted_long_read_coverage, num_circular_contigs).
+    """
+    num_good_contigs = num_bad_contigs = 0
+    total_seq_length = 0
+    weighted_short_read_coverage = 0
+    weighted_long_read_coverage = 0
+    num_circular_contigs = 0
+    with open(inputContigs) as IN, open(outputContigs, 'w') as OUT, open(suboptimalContigs, "w") as SUBOPT:
+        seqId=None
+        seq = ""
+        contigIndex = 1
+        line = "1"
+        while line:
+            line = IN.readline()
+            m = re.match(r">(\S+)", line)
+            if m or not line: 
+                if seq:
+                    contigId = ">"+prefix+"contig_%d"%contigIndex
+                    contigInfo = " length %5d"%len(seq)
+                    contigIndex += 1
+                    short_read_coverage = 0
+                    long_read_coverage = 0
+                    passes_thresholds = False
+                    if shortReadDepth and seqId in shortReadDepth:
+                        short_read_coverage, normalizedDepth = shortReadDepth[seqId]
+                        contigInfo += " coverage %.01f normalized_cov %.2f"%(short_read_coverage, normalizedDepth)
+                        passes_thresholds = short_read_coverage >= min_coverage
+                    if longReadDepth and seqId in longReadDepth:
+                        long_read_coverage, normalizedDepth = longReadDepth[seqId]
+                        contigInfo += " longread_coverage %.01f normalized_longread_cov %.2f"%(long_read_coverage, normalizedDepth)
+                        passes_thresholds |= long_read_coverage >= min_coverage
+                    if len(seq) < min_length:
+                        passes_thresholds = False
+                        num_bad_contigs += 1
+                    if passes_thresholds:
+                        OUT.write(contigId+contigInfo+"\n")
+                        for i in range(0, len(seq), 60):
+                            OUT.write(seq[i:i+60]+"\n")
+                        num_good_contigs += 1
+                        if short_read_coverage:
+                            weighted_short_read_coverage += short_read_coverage * len(seq)
+                        if long_read_coverage:
+                            weighted_long_read_coverage += long_read_coverage * len(seq)
+                        total_seq_length += len(seq)
+                        if "circular=true" in line:
+                            num_circular_contigs += 1
+                    else:
+                        SUBOPT.write(contigId+contigInfo+"\n")
+                        for i in range(0, len(seq), 60):
+                            SUBOPT.write(seq[i:i+60]+"\n")
+                        num_bad_contigs += 1
+                    seq = ""
+                if m:
+                    seqId = m.group(1)
+            elif line:
+                seq += line.rstrip()
+    return num_good_contigs, num_bad_contigs, total_seq_length, weighted_short_read_coverage, weighted_long_read_coverage, num_circular_contigs
+
+def filterContigsByLengthAndCoverage(context, inputContigs, read_list, args, details):   #, min_contig_length=300, min_contig_coverage=5, threads=1, prefix=""):
     """ 
     Write only sequences at or above min_length and min coverage to output file.
     """
-    LOG.write("filterContigsByLengthAndCoverage: Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
+    context.log.write("filterContigsByLengthAndCoverage: Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
     report = {}
     shortReadDepth = None
     longReadDepth = None
     bamFiles = []
     for read_set in read_list:
         if read_set.length_class == 'short':
-            bam = runBowtie(inputContigs, read_set, args, outformat='bam')
+            bam = runBowtie(context, inputContigs, read_set, args, outformat='bam')
             if bam:
                 bamFiles.append(bam)
     if bamFiles:
-        if 'bowtie2' not in details['version']:
-            command = ["bowtie2", '--version']
-            proc = subprocess.run(command, shell=False, text=True, capture_output=True)
-            m = re.search("version\s+(\S+)", proc.stderr)
-            if m:
-                details['version']['bowtie2'] = m.group(1)
-                    
-        (average_depth, shortReadDepth) = calcReadDepth(bamFiles)
+        if context.tools.version("bowtie2"):
+            details['version']['bowtie2'] = context.tools.version("bowtie2")
+
+        (average_depth, shortReadDepth) = calcReadDepth(context, bamFiles)
         report['average depth (short reads)'] = "{:.2f}".format(average_depth)
     bamFiles = []
     for read_set in read_list:
         if read_set.length_class == 'long':
-            bam = runMinimap(inputContigs, read_set, args, details, outformat='bam')
+            bam = runMinimap(context, inputContigs, read_set, args, details, outformat='bam')
             if bam:
                 bamFiles.append(bam)
     if bamFiles:
-        (average_depth, longReadDepth) = calcReadDepth(bamFiles)
+        (average_depth, longReadDepth) = calcReadDepth(context, bamFiles)
         report['average depth (long reads)'] = "{:.2f}".format(average_depth)
     report['min_contig_length_threshold'] = "%d"%args.min_contig_length
     report["min_contig_coverage_threshold"] = "%.1f"%args.min_contig_coverage
-    num_good_contigs = num_bad_contigs = 0
     suboptimalContigsFile = "contigs_below_length_coverage_threshold.fasta"
-    total_seq_length = 0
-    weighted_short_read_coverage = 0
-    weighted_long_read_coverage = 0
-    outputContigs = re.sub(r"\..*", "_depth_cov_filtered.fasta", inputContigs)
-    LOG.write("writing filtered contigs to %s\n"%outputContigs)
-    with open(inputContigs) as IN:
-        with open(outputContigs, 'w') as OUT:
-            SUBOPT = open(os.path.join(DETAILS_DIR, suboptimalContigsFile), "w")
-            seqId=None
-            seq = ""
-            contigIndex = 1
-            num_circular_contigs = 0
-            line = "1"
-            while line:
-                line = IN.readline()
-                m = re.match(r">(\S+)", line)
-                if m or not line: 
-                    if seq:
-                        contigId = ">"+args.prefix+"contig_%d"%contigIndex
-                        contigInfo = " length %5d"%len(seq)
-                        contigIndex += 1
-                        short_read_coverage = 0
-                        long_read_coverage = 0
-                        passes_thresholds = False
-                        if shortReadDepth and seqId in shortReadDepth:
-                            short_read_coverage, normalizedDepth = shortReadDepth[seqId]
-                            contigInfo += " coverage %.01f normalized_cov %.2f"%(short_read_coverage, normalizedDepth)
-                            passes_thresholds = short_read_coverage >= args.min_contig_coverage
-                        if longReadDepth and seqId in longReadDepth:
-                            long_read_coverage, normalizedDepth = longReadDepth[seqId]
-                            contigInfo += " longread_coverage %.01f normalized_longread_cov %.2f"%(long_read_coverage, normalizedDepth)
-                            passes_thresholds |= long_read_coverage >= args.min_contig_coverage
-                        if len(seq) < args.min_contig_length:
-                            passes_thresholds = False
-                            num_bad_contigs += 1
-                        if passes_thresholds:
-                            OUT.write(contigId+contigInfo+"\n")
-                            for i in range(0, len(seq), 60):
-                                OUT.write(seq[i:i+60]+"\n")
-                            num_good_contigs += 1
-                            if short_read_coverage:
-                                weighted_short_read_coverage += short_read_coverage * len(seq)
-                            if long_read_coverage:
-                                weighted_long_read_coverage += long_read_coverage * len(seq)
-                            total_seq_length += len(seq)
-                            if "circular=true" in line:
-                                num_circular_contigs += 1
-                        else:
-                            SUBOPT.write(contigId+contigInfo+"\n")
-                            for i in range(0, len(seq), 60):
-                                SUBOPT.write(seq[i:i+60]+"\n")
-                            num_bad_contigs += 1
-                        seq = ""
-                    if m:
-                        seqId = m.group(1)
-                elif line:
-                    seq += line.rstrip()
+    outputContigs = os.path.join(os.path.dirname(inputContigs), re.sub(r"\..*", "_depth_cov_filtered.fasta", os.path.basename(inputContigs)))
+    context.log.write("writing filtered contigs to %s\n"%outputContigs)
+    filterStartTime = time()
+    (num_good_contigs, num_bad_contigs, total_seq_length, weighted_short_read_coverage, weighted_long_read_coverage, num_circular_contigs) = writeFilteredContigs(
+            inputContigs, outputContigs, os.path.join(context.details_dir, suboptimalContigsFile), shortReadDepth, longReadDepth,
+            args.min_contig_length, args.min_contig_coverage, args.prefix)
+    context.events.counters('filter_contigs', time() - filterStartTime, records=num_good_contigs + num_bad_contigs,
+            bytes_in=os.path.getsize(inputContigs), bytes_out=os.path.getsize(outputContigs), contigs_kept=num_good_contigs)
     if total_seq_length:
         if weighted_short_read_coverage:
             report['average short read coverage'] = "%.3f"%(weighted_short_read_coverage / total_seq_length)
@@ -171,93 +202,162 @@ def filterContigsByLengthAndCoverage(inputContigs, read_list, args, details):
     if num_good_contigs:
         report['good contigs file'] = outputContigs
     else:
-        LOG.write("failed to generate outputContigs\n")
+        context.log.write("failed to generate outputContigs\n")
     comment = "filterContigsByLengthAndCoverage, input %s, output %s"%(inputContigs, outputContigs)
-    LOG.write(comment+"\n")
+    context.log.write(comment+"\n")
     return report
 
-def runBandage(gfaFile, details):
+def runBandage(context, gfaFile, details):
     imageFormat = ".svg"
     retval = None
     if os.path.exists(gfaFile):
         plotFile = gfaFile.replace(".gfa", ".plot"+imageFormat)
         command = ["Bandage", "image", gfaFile, plotFile]
-        LOG.write(" ".join(command)+"\n")
+        context.log.write(" ".join(command)+"\n")
         try:
-            with open(os.devnull, 'w') as FNULL:
-                return_code = subprocess.call(command, shell=False, stderr=FNULL)
-            LOG.write("return code = %d\n"%return_code)
+            with context.resources.lease('Bandage', threads=1):
+                return_code = context.runner.call(command)
+            context.log.write("return code = %d\n"%return_code)
             if return_code == 0:
                 retval = plotFile
-                proc = subprocess.Popen(["Bandage", "--version"], shell=False, stdout=subprocess.PIPE)
-                version_text = proc.stdout.read().decode().strip()
-                proc.wait()
-                details['version']['Bandage'] = version_text
+                details['version']['Bandage'] = context.tools.version("Bandage")
                 details["Bandage"] = {
                     "plot" : plotFile,
                     "command line": command
                     }
             else:
-                LOG.write("Error creating Bandage plot\n")
+                context.log.write("Error creating Bandage plot\n")
         except OSError as ose:
             comment = "Problem running Bandage: "+str(ose)
-            LOG.write(comment+"\n")
+            context.log.write(comment+"\n")
             details['problem'].append(comment)
     return retval
 
-def runUnicycler(details, read_list, threads=1, min_contig_length=0, prefix="", spades_exec=None):
-    LOG.write("runUnicycler: Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
-    proc = subprocess.Popen(["unicycler", "--version"], shell=False, stdout=subprocess.PIPE)
-    version_text = proc.stdout.read().decode()
-    if version_text:
-        m = re.search(r"Unicycler\s+\S+", version_text, flags=re.IGNORECASE)
-        if m:
-            version_text = m.group(0) # entire match
-    proc.wait()
+def isNormalized(read_set):
+    return any("BBNorm" in str(version.transformation) for version in read_set.versions + [read_set])
+
+def reduceReads(context, read_list):
+    """ normalize short-read sets not yet normalized, down-sample the others to half; return what was done, or None """
+    actions = []
+    for read_set in read_list:
+        if read_set.length_class != 'short':
+            continue
+        num_bases = read_set.num_bases
+        name = os.path.basename(read_set.files[0])
+        if read_set.platform == 'illumina' and read_set.format == 'fastq' and not isNormalized(read_set):
+            try:
+                read_set.normalize_read_depth()
+            except OSError as ose:
+                context.log.write("cannot normalize {}: {}\n".format(read_set.files[0], ose))
+            if read_set.num_bases < num_bases:
+                actions.append("normalized {} to {} bases".format(name, read_set.num_bases))
+                continue
+        read_set.down_sample_reads(num_bases // 2)
+        if read_set.num_bases < num_bases:
+            actions.append("down-sampled {} to {} bases".format(name, read_set.num_bases))
+    return "; ".join(actions) or None
+
+def degradeAssembly(context, settings, strategies, read_list):
+    """ apply to settings (threads, kmers) or read_list the next of strategies that changes something; return what it did, or None when none is left """
+    while strategies:
+        strategy = strategies.pop(0)
+        if strategy == 'threads' and settings['threads'] > 1:
+            settings['threads'] = max(1, settings['threads'] // 2)
+            return "threads reduced to {}".format(settings['threads'])
+        if strategy == 'kmers' and not settings['kmers']:
+            settings['kmers'] = LOW_MEMORY_KMERS
+            return "k-mers limited to {}".format(LOW_MEMORY_KMERS)
+        if strategy == 'reads':
+            action = reduceReads(context, read_list)
+            if action:
+                return action
+    return None
+
+def runAssemblerAttempt(context, details, command, lease, output_file, strategy=None, log_files=(), stderr=None):
+    """
+    Run one attempt of an assembler under a MemoryWatchdog of its lease's memory, and record it in details['assembly']['attempts'].
+    Return 'ok' if it wrote output_file, 'memory' if it ran out of memory, otherwise 'failed'.
+    """
+    watchdog = MemoryWatchdog(lease.memory_gb, log=context.log)
+    result = context.runner.run(command, stderr=stderr, watchdog=watchdog)
+    context.log.write("return code = %d\n"%result.returncode)
+    if os.path.exists(output_file) and os.path.getsize(output_file):
+        outcome = 'ok'
+    else:
+        outcome = watchdog.classify(result, log_files)
+    attempts = details['assembly'].setdefault('attempts', [])
+    attempts.append({'attempt': len(attempts)+1, 'strategy': strategy, 'threads': lease.threads, 'command_line': " ".join(command),
+                     'return_code': result.returncode, 'outcome': outcome, 'seconds': round(result.seconds, 1), 'memory': watchdog.report()})
+    return outcome
+
+def runUnicycler(context, details, read_list, threads=1, min_contig_length=0, prefix="", spades_exec=None):
+    context.log.write("runUnicycler: Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
+    version_text = context.tools.version("unicycler")
     details["assembly"]['assembler'] = 'unicycler'
     details["assembly"]['version'] = version_text
     details["version"]["unicycler"] = version_text
 
-    command = ["unicycler", "-t", str(threads), "-o", '.']
-    if min_contig_length:
-        command.extend(("--min_fasta_length", str(min_contig_length)))
-    command.extend(("--keep", "2")) # keep files needed for re-run if necessary
-    command.append("--no_pilon")  # we will run our own, if requested
-    if spades_exec:
-        command.extend(("--spades_path", spades_exec));
+    settings = {'threads': threads, 'memory_gb': None, 'kmers': None, 'bold': False}
+    def unicyclerCommand(lease):
+        command = ["unicycler"] + lease.flags() + ["-o", context.work_dir]
+        if min_contig_length:
+            command.extend(("--min_fasta_length", str(min_contig_length)))
+        command.extend(("--keep", "2")) # keep files needed for re-run if necessary
+        command.append("--no_pilon")  # we will run our own, if requested
+        if spades_exec:
+            command.extend(("--spades_path", spades_exec));
+        if settings['kmers']:
+            command.extend(("--kmers", settings['kmers']))
+        if settings['bold']:
+            command.extend(("--mode", "bold", "--min_component_size", "300", "--min_dead_end_size", "300", "--depth_filter", "0.1"))
+
+        # apparently unicycler can only accept one read set in each class (I tried multiple ways to submit 2 paired-end sets, failed)
+        for read_set in read_list:
+            if read_set.length_class == 'short':
+                if len(read_set.files) > 1:
+                    command.extend(("--short1", read_set.files[0], "--short2", read_set.files[1]))
+                else:
+                    command.extend(("--unpaired", read_set.files[0]))
 
-    # apparently unicycler can only accept one read set in each class (I tried multiple ways to submit 2 paired-end sets, failed)
-    for read_set in read_list:
-        if read_set.length_class == 'short':
-            if len(read_set.files) > 1:
-                command.extend(("--short1", read_set.files[0], "--short2", read_set.files[1]))
             else:
-                command.extend(("--unpaired", read_set.files[0]))
-
-        else:
-            command.extend(("--long", read_set.files[0]))
+                command.extend(("--long", read_set.files[0]))
+        return command
 
-    LOG.write(" ".join(command)+"\n")
-    LOG.flush()
     unicyclerStartTime = time()
-    details["assembly"]['command_line'] = " ".join(command)
-    with open(os.devnull, 'w') as FNULL: # send stdout to dev/null, it is too big and unicycle.log is better
-        return_code = subprocess.call(command, shell=False, stdout=FNULL)
-    LOG.write("return code = %d\n"%return_code)
-
-    if not (os.path.exists("assembly.fasta") and os.path.getsize("assembly.fasta")):
-        comment = "First run of Unicycler resulted in no assembly, try again with more lenient parameters."
-        LOG.write(comment+"\n")
+    assemblyFile = context.path("assembly.fasta")
+    strategies = list(MEMORY_RETRY_STRATEGIES)
+    strategy = None
+    while True:
+        # the lease is taken for each attempt, so reads can be normalized between them and threads reduced
+        # retries keep the first attempt's memory, so fewer threads do not also lower the watchdog's limit
+        lease = context.resources.lease('unicycler', threads=settings['threads'], memory_gb=settings['memory_gb'])
+        settings['threads'] = lease.threads
+        settings['memory_gb'] = lease.memory_gb
+        command = unicyclerCommand(lease)
+        context.log.write(" ".join(command)+"\n")
+        context.log.flush()
+        details["assembly"]['command_line'] = " ".join(command)
+        # stdout is discarded, it is too big and unicycler.log is better
+        outcome = runAssemblerAttempt(context, details, command, lease, assemblyFile, strategy, log_files=[context.path("unicycler.log")], stderr=context.log)
+        lease.release()
+        if outcome == 'ok':
+            break
         if 'problem' not in details['assembly']:
             details["assembly"]["problem"] = []
+        if outcome == 'memory':
+            strategy = degradeAssembly(context, settings, strategies, read_list)
+            if not strategy:
+                details["assembly"]["problem"].append("Unicycler ran out of memory, no further way to reduce its memory")
+                break
+            comment = "Unicycler ran out of memory, try again with "+strategy
+        elif not settings['bold']:
+            settings['bold'] = True
+            strategy = "bold mode"
+            comment = "First run of Unicycler resulted in no assembly, try again with more lenient parameters."
+        else:
+            break
+        context.log.write(comment+"\n")
         details["assembly"]["problem"].append(comment)
-        command.extend(("--mode", "bold", "--min_component_size", "300", "--min_dead_end_size", "300", "--depth_filter", "0.1"))
-        comment = "re-run unicycler with command = "+" ".join(command)
-        LOG.write(comment+"\n")
-        details["assembly"]["problem"].append(comment)
-        with open(os.devnull, 'w') as FNULL: # send stdout to dev/null, it is too big and unicycle.log is better
-            return_code = subprocess.call(command, shell=False, stdout=FNULL)
-        LOG.write("return code = %d\n"%return_code)
 
     unicyclerEndTime = time()
     elapsedTime = unicyclerEndTime - unicyclerStartTime
@@ -272,16 +372,16 @@ def runUnicycler(details, read_list, threads=1, min_contig_length=0, prefix="",
     details["assembly"]['assembly_time'] = elapsedHumanReadable
     details["assembly"]['assembly_seconds'] = elapsedTime
 
-    LOG.write("Duration of Unicycler run was %s\n"%(elapsedHumanReadable))
+    context.log.write("Duration of Unicycler run was %s\n"%(elapsedHumanReadable))
 
     unicyclerLogFile = "unicycler.log"
-    if os.path.exists("unicycler.log"):
+    if os.path.exists(context.path("unicycler.log")):
         unicyclerLogFile = prefix+"unicycler.log"
-        shutil.move("unicycler.log", os.path.join(DETAILS_DIR, unicyclerLogFile))
+        shutil.move(context.path("unicycler.log"), os.path.join(context.details_dir, unicyclerLogFile))
 
-    if not os.path.exists("assembly.fasta"):
+    if not os.path.exists(assemblyFile):
         comment = "Unicycler failed to generate assembly file. Check "+unicyclerLogFile
-        LOG.write(comment+"\n")
+        context.log.write(comment+"\n")
         details["assembly"]["outcome"] = comment
         if 'problem' not in details['assembly']:
             details['assembly']['problem'] = []
@@ -289,99 +389,191 @@ def runUnicycler(details, read_list, threads=1, min_contig_length=0, prefix="",
         return None
 
     assemblyGraphFile = prefix+"assembly_graph.gfa"
-    shutil.move("assembly.gfa", os.path.join(DETAILS_DIR, assemblyGraphFile))
+    shutil.move(context.path("assembly.gfa"), os.path.join(context.details_dir, assemblyGraphFile))
 
-    contigsFile = "contigs.fasta"
-    shutil.move("assembly.fasta", contigsFile) #rename to canonical name
+    contigsFile = context.path("contigs.fasta")
+    shutil.move(assemblyFile, contigsFile) #rename to canonical name
     details["assembly"]["contigs.fasta file size"] = os.path.getsize(contigsFile)
     return contigsFile
 
-def runSpades(details, read_list, prefix="", recipe=None, threads=4, memory=250):
-    LOG.write("runSpades Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime())))
-    command = ["spades.py", "--version"]
-    proc = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    version_text = proc.stdout.read().decode().strip()
-    if not version_text: # as of v3.14.1 this output came to stderr instead of stdout
-        version_text = proc.stderr.read().decode().strip()
-    proc.wait()
+def spadesProgress(spades_dir, since=0):
+    """ checkpoints SPAdes left in spades_dir since time since: {'ec': mtime of the corrected reads or None, 'k': {k: mtime of its finished contigs}} """
+    progress = {'ec': None, 'k': {}}
+    corrected = os.path.join(spades_dir, "corrected", "corrected.yaml")
+    if os.path.exists(corrected) and os.path.getmtime(corrected) >= since:
+        progress['ec'] = os.path.getmtime(corrected)
+    for kdir in glob.glob(os.path.join(spades_dir, "K*")):
+        m = re.match(r"K(\d+)$", os.path.basename(kdir))
+        if not m:
+            continue
+        for name in ("final_contigs.fasta", "simplified_contigs.fasta"):
+            path = os.path.join(kdir, name)
+            if os.path.exists(path) and os.path.getmtime(path) >= since:
+                progress['k'][int(m.group(1))] = os.path.getmtime(path)
+                break
+    return progress
+
+def spadesRestartPoint(spades_dir, kmers, attempts):
+    """
+    Furthest checkpoint a SPAdes rerun with kmers (comma-separated, or None for its own choice) can restart from,
+    given the (start, end) times of the attempts since it last started from scratch.
+    Return (checkpoint for --restart-from, time it was written, seconds of the attempts' work it reuses), or None.
+    """
+    if not attempts:
+        return None
+    progress = spadesProgress(spades_dir, attempts[0][0])
+    finished = sorted(progress['k'])
+    if kmers:
+        target = [int(k) for k in kmers.split(",")]
+        if finished and finished == target[:len(finished)] and len(finished) < len(target):
+            checkpoint, written = "k{}".format(target[len(finished)]), progress['k'][finished[-1]]
+        elif finished and finished == target:
+            checkpoint, written = "last", max(progress['k'].values())
+        elif progress['ec']:
+            checkpoint, written = "as", progress['ec'] # the corrected reads, assembled with the new k-mers
+        else:
+            return None
+    else:
+        if not (progress['ec'] or finished):
+            return None
+        checkpoint, written = "last", max([progress['ec'] or 0] + list(progress['k'].values()))
+    # each attempt contributed the time from its start to the last checkpoint it wrote
+    checkpoint_times = [progress['ec'] or 0] + list(progress['k'].values())
+    reused = 0
+    for start, end in attempts:
+        done = [t for t in checkpoint_times if start <= t <= min(end, written)]
+        if done:
+            reused += max(done) - start
+    return checkpoint, written, reused
+
+def runSpades(context, details, read_list, prefix="", recipe=None, threads=4, memory=250):
+    context.log.write("runSpades Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime())))
+    version_text = context.tools.version("spades.py") # as of v3.14.1 this comes on stderr instead of stdout
     details["assembly"]['assembler'] = 'SPAdes'
     details["assembly"]['version'] = version_text
     details["version"]["spades.py"] = version_text
 
-    command = ["spades.py", "--threads", str(threads), "-o", "."]
-    if recipe == 'single-cell':
-        command.append("--sc")
-    if memory:
-        command.extend(["-m", str(memory)])
-    if recipe == "meta-spades":
-        command.append("--meta")
-    if recipe == "rna-spades":
-        command.append("--rna")
-        #
-        # Validate arguments for metagenomic spades. It can only run with
-        # a single paired-end library.
-        #
-        #if len(single_end_reads) > 0 or len(paired_end_reads[0]) > 1:
-        #    sys.stderr.write("SPAdes in metagenomics mode can only process a single paired-end read file\n")
-        #    sys.exit(1);
-    if recipe == "plasmid-spades":
-        command.append("--plasmid")
-   
-    any_fasta = False
-    any_illumina = False
-    any_iontorrent = False
-    paired_end_counter = 1
-    single_end_counter = 1
-    for read_set in read_list:
-        if read_set.format == "fasta":
-            any_fasta = True
-        if read_set.length_class == "short":
-            if len(read_set.files) > 1:
-                if paired_end_counter > 9:
-                    LOG.write("Spades cannot take more than 9 paired-end libraries.")
-                    continue 
-                command.extend(("--pe{}-1".format(paired_end_counter), read_set.files[0], "--pe{}-2".format(paired_end_counter), read_set.files[1]))
-                paired_end_counter += 1
-            else:
-                if single_end_counter > 9:
-                    LOG.write("Spades cannot take more than 9 single-end libraries.")
-                    continue 
-                command.extend(("--s{}".format(single_end_counter), read_set.files[0]))
-                single_end_counter += 1
-
-        else: # length_class is long
-            if read_set.platform == 'pacbio':
-                command.extend(["--pacbio", read_set.files[0]])
-            if read_set.platform == 'nanopore':
-                command.extend(["--nanopore", read_set.files[0]])
-            
-    if any_fasta: # lacking quality scores means we need to rurn off read correction
-        command.append("--only-assembler") 
-    if any_iontorrent:
-        command.append("--iontorrent") # tell SPAdes that this is the read type
-    LOG.write("SPAdes command =\n"+" ".join(command)+"\n")
-    #LOG.write("    PATH:  "+os.environ["PATH"]+"\n\n")
-    LOG.flush()
-    spadesStartTime = time()
-
-    details['assembly']['command_line'] = " ".join(command)
-    return_code = subprocess.call(command, shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    LOG.write("return code = %d\n"%return_code)
+    settings = {'threads': threads, 'memory_gb': memory or None, 'kmers': None, 'only_assembler': False}
+    def spadesCommand(lease):
+        command = ["spades.py"] + lease.flags() + ["-o", context.work_dir]
+        if recipe == 'single-cell':
+            command.append("--sc")
+        if recipe == "meta-spades":
+            command.append("--meta")
+        if recipe == "rna-spades":
+            command.append("--rna")
+            #
+            # Validate arguments for metagenomic spades. It can only run with
+            # a single paired-end library.
+            #
+            #if len(single_end_reads) > 0 or len(paired_end_reads[0]) > 1:
+            #    sys.stderr.write("SPAdes in metagenomics mode can only process a single paired-end read file\n")
+            #    sys.exit(1);
+        if recipe == "plasmid-spades":
+            command.append("--plasmid")
+        if settings['kmers']:
+            command.extend(("-k", settings['kmers']))
+       
+        any_fasta = False
+        any_illumina = False
+        any_iontorrent = False
+        paired_end_counter = 1
+        single_end_counter = 1
+        for read_set in read_list:
+            if read_set.format == "fasta":
+                any_fasta = True
+            if read_set.length_class == "short":
+                if len(read_set.files) > 1:
+                    if paired_end_counter > 9:
+                        context.log.write("Spades cannot take more than 9 paired-end libraries.")
+                        continue 
+                    command.extend(("--pe{}-1".format(paired_end_counter), read_set.files[0], "--pe{}-2".format(paired_end_counter), read_set.files[1]))
+                    paired_end_counter += 1
+                else:
+                    if single_end_counter > 9:
+                        context.log.write("Spades cannot take more than 9 single-end libraries.")
+                        continue 
+                    command.extend(("--s{}".format(single_end_counter), read_set.files[0]))
+                    single_end_counter += 1
+
+            else: # length_class is long
+                if read_set.platform == 'pacbio':
+                    command.extend(["--pacbio", read_set.files[0]])
+                if read_set.platform == 'nanopore':
+                    command.extend(["--nanopore", read_set.files[0]])
+                
+        if any_fasta: # lacking quality scores means we need to rurn off read correction
+            settings['only_assembler'] = True
+        if settings['only_assembler']:
+            command.append("--only-assembler") 
+        if any_iontorrent:
+            command.append("--iontorrent") # tell SPAdes that this is the read type
+        return command
 
-    contigsFile = "contigs.fasta"
-    if return_code and not os.path.exists(contigsFile):
-        comment = "spades failed to generate assembly, return code = %d"%return_code
-        LOG.write(comment+"\n")
+    spadesStartTime = time()
+    contigsFile = context.path("contigs.fasta")
+    strategies = list(MEMORY_RETRY_STRATEGIES)
+    strategy = None
+    restart = None # (checkpoint, when it was written, seconds reused) to resume from instead of starting over
+    restarts_tried = set()
+    chain = [] # (start, end) of the attempts whose checkpoints are in the work directory, since the last start from scratch
+    while True:
+        # the lease is taken for each attempt, so reads can be normalized between them and threads reduced
+        # retries keep the first attempt's memory, so fewer threads do not also lower the watchdog's limit
+        lease = context.resources.lease('spades', threads=settings['threads'], memory_gb=settings['memory_gb'])
+        settings['threads'] = lease.threads
+        settings['memory_gb'] = lease.memory_gb
+        if restart:
+            # read options cannot change on a restart; spades takes them from its earlier run
+            command = ["spades.py", "-o", context.work_dir, "--restart-from", restart[0]] + lease.flags()
+            if settings['kmers']:
+                command.extend(("-k", settings['kmers']))
+        else:
+            command = spadesCommand(lease)
+            chain = []
+        context.log.write("SPAdes command =\n"+" ".join(command)+"\n")
+        #context.log.write("    PATH:  "+os.environ["PATH"]+"\n\n")
+        context.log.flush()
+        details['assembly']['command_line'] = " ".join(command)
+        attempt_start = time()
+        outcome = runAssemblerAttempt(context, details, command, lease, contigsFile, strategy, log_files=[context.path("spades.log")])
+        chain.append((attempt_start, time()))
+        lease.release()
+        if restart:
+            details['assembly']['attempts'][-1].update(restart_from=restart[0], reused_seconds=round(restart[2], 1))
+            details['assembly']['checkpoint_seconds_saved'] = round(details['assembly'].get('checkpoint_seconds_saved', 0) + restart[2], 1)
+        if outcome == 'ok':
+            break
         if 'problem' not in details['assembly']:
             details['assembly']['problem'] = []
+        if outcome == 'memory':
+            reads_before = readFiles(read_list)
+            strategy = degradeAssembly(context, settings, strategies, read_list)
+            if not strategy:
+                details['assembly']['problem'].append("spades ran out of memory, no further way to reduce its memory")
+                break
+            comment = "spades ran out of memory, try again with "+strategy
+            # checkpoints of other reads are of no use
+            restart = spadesRestartPoint(context.work_dir, settings['kmers'], chain) if readFiles(read_list) == reads_before else None
+        else:
+            details['assembly']['problem'].append("spades failed to generate assembly, return code = %d"%details['assembly']['attempts'][-1]['return_code'])
+            restart = spadesRestartPoint(context.work_dir, settings['kmers'], chain)
+            if restart and restart[:2] not in restarts_tried:
+                strategy = ""
+                comment = "try again"
+            elif not settings['only_assembler']:
+                restart = None
+                settings['only_assembler'] = True
+                strategy = "--only-assembler"
+                comment = "try again adding '--only-assembler' option to spades"
+            else:
+                break
+        if restart:
+            restarts_tried.add(restart[:2])
+            strategy = (strategy + ", " if strategy else "") + "from checkpoint " + restart[0]
+            comment += ", restarting from checkpoint {} to reuse {:.0f} seconds of work".format(restart[0], restart[2])
+        context.log.write(comment+"\n")
         details['assembly']['problem'].append(comment)
-        comment = "try again adding '--only-assembler' option to spades"
-        LOG.write(comment+"\n")
-        details['assembly']['problem'].append(comment)
-        command.append("--only-assembler")
-        details['assembly']['command_line'] = " ".join(command)
-        return_code = subprocess.call(command, shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        LOG.write("return code = %d\n"%return_code)
 
     spadesEndTime = time()
     elapsedTime = spadesEndTime - spadesStartTime
@@ -393,214 +585,326 @@ def runSpades(details, read_list, prefix="", recipe=None, threads=4, memory=250)
     else:
         elapsedHumanReadable = "%.1f hours"%(elapsedTime/3600.0)
     details["assembly"]['assembly_time'] = elapsedHumanReadable
-    LOG.write("Duration of SPAdes run was %s\n"%(elapsedHumanReadable))
+    context.log.write("Duration of SPAdes run was %s\n"%(elapsedHumanReadable))
 
     spadesLogFile = "spades.log"
-    if os.path.exists("spades.log"):
-        shutil.move("spades.log", os.path.join(DETAILS_DIR, "spades.log"))
+    if os.path.exists(context.path("spades.log")):
+        shutil.move(context.path("spades.log"), os.path.join(context.details_dir, "spades.log"))
     if not os.path.exists(contigsFile):
         comment = "SPAdes failed to generate contigs file. Check "+spadesLogFile
-        LOG.write(comment+"\n")
+        context.log.write(comment+"\n")
         details["assembly"]["outcome"] = comment
         details["problem"].append(comment)
         return None
     details["assembly"]["contigs.fasta size:"] = os.path.getsize(contigsFile)
     assemblyGraphFile = prefix+"assembly_graph.gfa"
-    if os.path.exists("assembly_graph_with_scaffolds.gfa"):
-        LOG.write("found gfa file: assembly_graph_with_scaffolds.gfa\n")
-        shutil.move("assembly_graph_with_scaffolds.gfa", os.path.join(DETAILS_DIR, assemblyGraphFile))
+    if os.path.exists(context.path("assembly_graph_with_scaffolds.gfa")):
+        context.log.write("found gfa file: assembly_graph_with_scaffolds.gfa\n")
+        shutil.move(context.path("assembly_graph_with_scaffolds.gfa"), os.path.join(context.details_dir, assemblyGraphFile))
     else:
-        gfa_candidates = glob.glob("*gfa")
+        gfa_candidates = glob.glob(context.path("*gfa"))
         if gfa_candidates:
-            LOG.write("found gfa file: {}\n".format(gfa_candidates[-1]))
-            shutil.move(gfa_candidates[-1], os.path.join(DETAILS_DIR, assemblyGraphFile))
+            context.log.write("found gfa file: {}\n".format(gfa_candidates[-1]))
+            shutil.move(gfa_candidates[-1], os.path.join(context.details_dir, assemblyGraphFile))
     return contigsFile
 
-def runMinimap(contigFile, read_set, args, details, outformat='sam'):
-    LOG.write("runMinimap: Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
+def runMinimap(context, contigFile, read_set, args, details, outformat='sam'):
+    context.log.write("runMinimap: Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
     """
     Map long reads to contigs by minimap2 (read paf-file, readsFile; generate paf file).
     """
-    LOG.write("runMinimap(%s, %s, %s, %s)\n"%(contigFile, read_set.files[0], str(type(args)), outformat))
-    if 'minimap2' not in details['version']:
-        command = ["minimap2", "--version"]
-        proc = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE, text=True)
-        proc.wait()
-        version_text = proc.stdout.read()
-        details["version"]['minimap2'] = version_text.strip()
+    context.log.write("runMinimap(context, %s, %s, %s, %s)\n"%(contigFile, read_set.files[0], str(type(args)), outformat))
+    details["version"]['minimap2'] = context.tools.version("minimap2")
     # index contig sequences
     #contigIndex = contigFile.replace(".fasta", ".mmi")
     #command = ["minimap2", "-t", str(threads), "-d", contigIndex, contigFile] 
     #tempTime = time() 
-    #LOG.write("minimap2 index command:\n"+' '.join(command)+"\n")
+    #context.log.write("minimap2 index command:\n"+' '.join(command)+"\n")
     #with open(os.devnull, 'w') as FNULL: # send stdout to dev/null
     #    return_code = subprocess.call(command, shell=False, stdout=FNULL, stderr=FNULL)
-    #LOG.write("minimap2 index return code = %d, time = %d seconds\n"%(return_code, time() - tempTime))
+    #context.log.write("minimap2 index return code = %d, time = %d seconds\n"%(return_code, time() - tempTime))
     #if return_code != 0:
     #    return None
 
     # map long reads to contigs
     contigSam = contigFile.replace(".fasta", ".sam")
-    command = ["minimap2", "-t", str(args.threads)]
+    lease = context.resources.lease('minimap2', threads=args.threads)
+    command = ["minimap2"] + lease.flags()
     if read_set.platform == 'nanopore':
         command.extend(["-x", "map-ont"])
     elif read_set.platform == 'pacbio':
         command.extend(["-x", "map-pb"])
     command.extend(["-a", "-o", contigSam, contigFile, read_set.files[0]])
     tempTime = time()
-    LOG.write(' '.join(command)+"\n")
-    return_code = subprocess.call(command, shell=False, stderr=subprocess.DEVNULL)
+    context.log.write(' '.join(command)+"\n")
+    return_code = context.runner.call(command)
+    lease.release()
     if return_code != 0:
-        LOG.write("minimap2 map return code = %d, time = %d seconds\n"%(return_code, time() - tempTime))
+        context.log.write("minimap2 map return code = %d, time = %d seconds\n"%(return_code, time() - tempTime))
         return None
 
     if outformat == 'sam':
         file_size = os.path.getsize(contigSam)
-        LOG.write('runMinimap returning %s, size=%d\n'%(contigSam, file_size))
+        context.log.write('runMinimap returning %s, size=%d\n'%(contigSam, file_size))
         return contigSam
 
     else:
-        contigBam = convertSamToBam(contigSam, args)
+        contigBam = convertSamToBam(context, contigSam, args)
         file_size = os.path.getsize(contigBam)
-        LOG.write('runMinimap returning %s, size=%d\n'%(contigBam, file_size))
+        context.log.write('runMinimap returning %s, size=%d\n'%(contigBam, file_size))
         return contigBam
             
-def convertSamToBam(samFile, args):
+def convertSamToBam(context, samFile, args):
     #convert format to bam and index
-    LOG.write("convertSamToBam(%s, %s)\n"%(samFile, str(type(args))))
+    context.log.write("convertSamToBam(context, %s, %s)\n"%(samFile, str(type(args))))
     tempTime = time()
-    command = ["samtools"]
-    proc = subprocess.Popen(command, shell=False, stderr=subprocess.PIPE)
-    proc.wait()
-    version_text = proc.stderr.read().decode()
-    for line in version_text.splitlines():
-        if 'Version' in line:
-            samtools_version = line.strip()
-
-    sortThreads = max(int(args.threads/2), 1)
-    samFilePrefix = re.sub(".sam", "", samFile, re.IGNORECASE)
-    command = ["samtools", "view", "-bS", "-@", str(sortThreads), "-o", samFilePrefix+"_unsorted.bam", samFile]
-    LOG.write(" ".join(command)+"\n")
-    return_code = subprocess.call(command, shell=False, stderr=LOG)
+
+    samFilePrefix = re.sub(r"\.sam$", "", samFile, flags=re.IGNORECASE)
+    lease = context.resources.lease('samtools', threads=max(int(args.threads/2), 1))
+    command = ["samtools", "view", "-bS"] + lease.flags() + ["-o", samFilePrefix+"_unsorted.bam", samFile]
+    context.log.write(" ".join(command)+"\n")
+    return_code = context.runner.call(command, stderr=context.log)
+    lease.release()
     #os.remove(samFile) #save a little space
     if return_code != 0:
         comment = "samtools view returned %d"%return_code
-        LOG.write(comment+"\n")
+        context.log.write(comment+"\n")
         return None
 
-    LOG.flush()
+    context.log.flush()
 
     bamFileSorted = samFilePrefix+".bam" 
-    command = ["samtools", "sort", "-@", str(sortThreads), "-o", bamFileSorted, samFilePrefix+"_unsorted.bam"]
-    if "Version: 0.1.19" in samtools_version:
+    lease = context.resources.lease('samtools sort', threads=max(int(args.threads/2), 1))
+    command = ["samtools", "sort"] + lease.flags() + ["-o", bamFileSorted, samFilePrefix+"_unsorted.bam"]
+    if context.tools.capabilities("samtools")['old_sort']:
         # different invocation for this older version
-        command = ["samtools", "sort", "-@", str(sortThreads), samFilePrefix+"_unsorted.bam", samFilePrefix]
-    return_code = subprocess.check_call(command, shell=False, stderr=LOG)
+        command = ["samtools", "sort"] + lease.flags('samtools') + [samFilePrefix+"_unsorted.bam", samFilePrefix]
+    return_code = context.runner.call(command, name='samtools sort', stderr=context.log)
+    lease.release()
 
     if return_code != 0:
         comment = "samtools sort returned %d, convertSamToBam failed"%return_code
-        LOG.write(comment+"\n")
+        context.log.write(comment+"\n")
         return None
-    LOG.write("bamFileSorted = "+bamFileSorted+"\n")
+    context.log.write("bamFileSorted = "+bamFileSorted+"\n")
     os.remove(samFilePrefix+"_unsorted.bam")
     if not os.path.exists(bamFileSorted):
         comment = "{0} not found, sorting bamfile failed, convertSamToBam failed\n".format(bamFileSorted)
-        LOG.write(comment+"\n")
+        context.log.write(comment+"\n")
         return None
     if not os.path.getsize(bamFileSorted):
         comment = "{0} of size zero, sorting bamfile failed, convertSamToBam failed\n".format(bamFileSorted)
-        LOG.write(comment+"\n")
+        context.log.write(comment+"\n")
         return None
     if args.verbose:
-        LOG.write("samtools sort return code=%d, time=%d, size of %s is %d\n"%(return_code, time()-tempTime, bamFileSorted, os.path.getsize(bamFileSorted)))
+        context.log.write("samtools sort return code=%d, time=%d, size of %s is %d\n"%(return_code, time()-tempTime, bamFileSorted, os.path.getsize(bamFileSorted)))
 
     command = ["samtools", "index", bamFileSorted]
-    LOG.write("executing: "+" ".join(command)+"\n")
-    return_code = subprocess.call(command, shell=False, stderr=LOG)
-    #LOG.write("samtools index return code = %d\n"%return_code)
+    context.log.write("executing: "+" ".join(command)+"\n")
+    return_code = context.runner.call(command, stderr=context.log)
+    #context.log.write("samtools index return code = %d\n"%return_code)
     return bamFileSorted
 
-def runRacon(contigFile, read_set, args, details):
+def runRaconPartitions(context, contigFile, read_set, samFile, raconContigs, args):
+    """
+    Polish contigs in length-balanced partitions, each by its own racon process.
+    Alignments from a single minimap2 run are split by partition, with only the reads aligned to that partition,
+    so each racon holds a predictable fraction of the data. Partitions run concurrently within the job memory.
+    Polished partitions are written to raconContigs in original contig order.
+    Return (return_code, partition_info).
+    """
+    contig_lengths = readContigLengths(contigFile)
+    num_partitions = args.racon_partitions
+    if not num_partitions:
+        num_partitions = max(1, int(args.threads / RACON_THREADS_PER_PARTITION))
+    partitionPrefix = raconContigs.replace(".fasta", "")
+    parts = []
+    partition_of = {}
+    for i, contig_bin in enumerate(partitionContigs(contig_lengths, num_partitions)):
+        part = {"name": "{}_part_{}".format(partitionPrefix, i+1), "contigs": contig_bin, "read_names": set(), "alignments": 0}
+        for contig in contig_bin:
+            partition_of[contig] = i
+        parts.append(part)
+
+    # split alignments by partition of the reference contig
+    SAMS = [open(part["name"]+".sam", 'w') for part in parts]
+    with open(samFile) as IN:
+        for line in IN:
+            if line.startswith("@"):
+                m = re.match(r"@SQ\tSN:(\S+)", line)
+                if m:
+                    if m.group(1) in partition_of:
+                        SAMS[partition_of[m.group(1)]].write(line)
+                else:
+                    for SAM in SAMS:
+                        SAM.write(line)
+                continue
+            fields = line.split("\t", 3)
+            if len(fields) > 2 and fields[2] in partition_of:
+                part = parts[partition_of[fields[2]]]
+                SAMS[partition_of[fields[2]]].write(line)
+                part["read_names"].add(fields[0])
+                part["alignments"] += 1
+    for SAM in SAMS:
+        SAM.close()
+
+    read_suffix = "_reads.fasta" if read_set.format == 'fasta' else "_reads.fastq"
+    READS = [open(part["name"]+read_suffix, 'w') for part in parts]
+    for read_name, record in iterReadRecords(read_set.files[0], read_set.format):
+        for i, part in enumerate(parts):
+            if read_name in part["read_names"]:
+                READS[i].write(record)
+    for READ in READS:
+        READ.close()
+    contig_seq = dict(readFastaSequences(contigFile))
+    for part in parts:
+        with open(part["name"]+".fasta", 'w') as OUT:
+            for contig in part["contigs"]:
+                OUT.write(">"+contig+"\n")
+                for i in range(0, len(contig_seq[contig]), 60):
+                    OUT.write(contig_seq[contig][i:i+60]+"\n")
+
+    if context.executor.shares_budget:
+        lease = context.resources.lease('racon', threads=args.threads)
+        threads = max(1, int(lease.threads / len(parts)))
+        memory_budget = lease.memory_gb
+    else: # each partition is queued with threads and memory of its own
+        lease = None
+        threads = RACON_THREADS_PER_PARTITION
+        memory_budget = None
+    jobs = []
+    for part in parts:
+        part["output"] = part["name"]+".fasta"
+        del part["read_names"]
+        if not part["alignments"]:
+            continue # nothing to polish with, keep contigs as they are
+        command = ["racon", "-t", str(threads), "-u"]
+        if read_set.avg_quality:
+            command.extend(['-q', "{:.2f}".format(read_set.avg_quality * 0.5)])
+        command.extend([part["name"]+read_suffix, part["name"]+".sam", part["name"]+".fasta"])
+        part["command"] = command
+        part["tool"] = "racon"
+        part["threads"] = threads
+        part["stdout"] = part["output"] = part["name"]+".racon.fasta"
+        part["memory_gb"] = max(RACON_MIN_MEMORY_GB, int(RACON_GB_PER_READ_GB * os.path.getsize(part["name"]+read_suffix) / 1e9 + 0.999))
+        part["inputs"] = [part["name"]+read_suffix, part["name"]+".sam", part["name"]+".fasta"]
+        part["outputs"] = [part["output"]]
+        jobs.append(part)
+    context.log.write("racon: {} partitions, {} threads each\n".format(len(parts), threads))
+    return_code = runJobsWithinMemory(context, jobs, memory_budget)
+    if lease:
+        lease.release()
+
+    partition_info = []
+    polished = {}
+    for part in parts:
+        partition_info.append({"contigs": len(part["contigs"]), "alignments": part["alignments"], "memory_gb": part.get("memory_gb", 0), "seconds": part.get("seconds", 0)})
+        if return_code == 0:
+            for seq_id, seq in readFastaSequences(part["output"]):
+                polished[seq_id] = seq
+        for temp_file in (part["name"]+".sam", part["name"]+read_suffix, part["name"]+".fasta", part["name"]+".racon.fasta"):
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    if return_code != 0:
+        return return_code, partition_info
+    with open(raconContigs, 'w') as OUT:
+        for contig, length in contig_lengths:
+            if contig not in polished:
+                context.log.write("racon partitions did not return contig {}\n".format(contig))
+                return 1, partition_info
+            OUT.write(">"+contig+"\n")
+            for i in range(0, len(polished[contig]), 60):
+                OUT.write(polished[contig][i:i+60]+"\n")
+    return 0, partition_info
+
+def runRacon(context, contigFile, read_set, args, details):
     """
     Polish (correct) sequence of assembled contigs by comparing to the original long-read sequences
     Run racon on reads, read-to-contig-sam, contigs. Generate polished contigs.
     Return name of polished contigs.
     """
     if args.verbose:
-        LOG.write('runRacon(%s, %s, %s)\n'%(contigFile, read_set.files[0], str(type(args))))
+        context.log.write('runRacon(context, %s, %s, %s)\n'%(contigFile, read_set.files[0], str(type(args))))
     report = {}
-    command = ["racon", "--version"]
-    proc = subprocess.Popen(command, shell=False, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    proc.wait()
-    version_text = proc.stderr.read().decode()
-    if not version_text:
-        version_text = proc.stdout.read().decode()
-    racon_version = version_text.strip()
-
-    readsToContigsSam = runMinimap(contigFile, read_set, args, details, outformat='sam')
+    racon_version = context.tools.version("racon")
+
+    readsToContigsSam = runMinimap(context, contigFile, read_set, args, details, outformat='sam')
     if not readsToContigsSam:
         comment = "runMinimap failed to generate sam file, exiting runRacon"
-        LOG.write(comment + "\n")
+        context.log.write(comment + "\n")
         return None
 
-    command = ["racon", "-t", str(args.threads), "-u"]
-    averageQuality = read_set.avg_quality
-    if averageQuality:
-        command.extend(['-q', "{:.2f}".format(averageQuality * 0.5)])
-    command.extend([ read_set.files[0], readsToContigsSam, contigFile])
-    LOG.write("racon command: \n"+' '.join(command)+"\n")
-    raconContigs = contigFile.replace(".fasta", ".racon.fasta")
-
+    # later rounds are numbered (x.racon.fasta, x.racon_2.fasta, ...) so each round's input is kept
+    m = re.match(r"(.*)\.racon(?:_(\d+))?\.fasta$", contigFile)
+    if m:
+        raconContigs = "{}.racon_{}.fasta".format(m.group(1), int(m.group(2) or 1) + 1)
+    else:
+        raconContigs = contigFile.replace(".fasta", ".racon.fasta")
     raconStartTime = time()
-    with open(raconContigs, 'w') as raconOut:
-        FNULL = open(os.devnull, 'w') # send stdout to dev/null
-        return_code = subprocess.call(command, shell=False, stderr=FNULL, stdout=raconOut)
-    LOG.write("racon return code = %d, time = %d seconds\n"%(return_code, time()-raconStartTime))
+    partition_info = []
+    if args.racon_partitions != 1 and len(readContigLengths(contigFile)) > 1:
+        return_code, partition_info = runRaconPartitions(context, contigFile, read_set, readsToContigsSam, raconContigs, args)
+    else:
+        lease = context.resources.lease('racon', threads=args.threads)
+        command = ["racon"] + lease.flags() + ["-u"]
+        averageQuality = read_set.avg_quality
+        if averageQuality:
+            command.extend(['-q', "{:.2f}".format(averageQuality * 0.5)])
+        command.extend([ read_set.files[0], readsToContigsSam, contigFile])
+        context.log.write("racon command: \n"+' '.join(command)+"\n")
+        with open(raconContigs, 'w') as raconOut:
+            return_code = context.runner.call(command, stdout=raconOut)
+        lease.release()
+    context.log.write("racon return code = %d, time = %d seconds\n"%(return_code, time()-raconStartTime))
     if return_code != 0:
         return None
     os.remove(readsToContigsSam)
     raconContigSize = os.path.getsize(raconContigs)
-    LOG.write("size of raconContigs: %d\n"%raconContigSize)
+    context.log.write("size of raconContigs: %d\n"%raconContigSize)
     if raconContigSize < 10:
         return None
     report = {"input_contigs":contigFile, "reads": read_set.files[0], "program": "racon", "version": racon_version, "output": raconContigs, "seconds": time()-raconStartTime}
+    if len(partition_info) > 1:
+        report["partitions"] = partition_info
     comment = "racon, input %s, output %s"%(contigFile, raconContigs)
-    LOG.write(comment+"\n")
-    os.remove(contigFile) #delete old one
-    if re.search("racon.racon.fasta", raconContigs):
-        shorterFileName = re.sub("racon.racon.fasta", "racon.fasta", raconContigs)
-        report['original_name'] = raconContigs
-        shutil.move(raconContigs, shorterFileName)
-        raconContigs = shorterFileName
-        report['output'] = shorterFileName
-        LOG.write("renaming {} to {}\n".format(raconContigs, shorterFileName))
+    context.log.write(comment+"\n")
     return report
 
-def runBowtie(contigFile, read_set, args, outformat='bam'):
+def runBowtie(context, contigFile, read_set, args, outformat='bam', read_group=None, build_index=True):
     """
     index contigsFile, then run bowtie2, then convert sam file to pos-sorted bam and index
+    read_group tags every alignment (RG:Z:) so libraries can be told apart after merging
+    build_index=False reuses the index made by a previous call on the same contigsFile
     """
-    LOG.write("runBowtie(%s, %s, %s, %s) %s\n"%(contigFile, read_set.files[0], str(type(args)), outformat, strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
-    if os.path.exists("bowtie_index_dir"):
-        # delete dir and all files there
-        shutil.rmtree('bowtie_index_dir')
-    os.mkdir("bowtie_index_dir")
-    if os.path.exists("bowtie_index_dir"):
-        LOG.write("bowtie_index_dir created")
-    command = ["bowtie2-build", "--threads", str(args.threads), contigFile, 'bowtie_index_dir/'+contigFile]
-    LOG.write("executing: "+" ".join(command)+"\n")
-    return_code = subprocess.call(command, shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    LOG.write("bowtie2-build return code = %d\n"%return_code)
-    if return_code != 0:
-        LOG.write("bowtie2-build failed\n")
-        return None, None
-
-    fastqBase = read_set.files[0]
+    context.log.write("runBowtie(context, %s, %s, %s, %s) %s\n"%(contigFile, read_set.files[0], str(type(args)), outformat, strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
+    indexDir = context.path("bowtie_index_dir")
+    indexPrefix = os.path.join(indexDir, os.path.basename(contigFile))
+    if build_index:
+        if os.path.exists(indexDir):
+            # delete dir and all files there
+            shutil.rmtree(indexDir)
+        os.mkdir(indexDir)
+        if os.path.exists(indexDir):
+            context.log.write("bowtie_index_dir created")
+        lease = context.resources.lease('bowtie2-build', threads=args.threads)
+        command = ["bowtie2-build"] + lease.flags() + [contigFile, indexPrefix]
+        context.log.write("executing: "+" ".join(command)+"\n")
+        return_code = context.runner.call(command)
+        lease.release()
+        context.log.write("bowtie2-build return code = %d\n"%return_code)
+        if return_code != 0:
+            context.log.write("bowtie2-build failed\n")
+            return None
+
+    fastqBase = os.path.basename(read_set.files[0])
     fastqBase = re.sub(r"\..*", "", fastqBase)
+    if read_group:
+        fastqBase = read_group+"_"+fastqBase
     samFile = contigFile+"_"+fastqBase+".sam"
 
-    command = ["bowtie2", "-p", str(args.threads)]
-    command.extend(["-x", 'bowtie_index_dir/'+contigFile])
+    lease = context.resources.lease('bowtie2', threads=args.threads)
+    command = ["bowtie2"] + lease.flags()
+    command.extend(["-x", indexPrefix])
     if len(read_set.files) > 1:
         sys.stderr.write("we have a pair of read files\n")
         command.extend(('-1', read_set.files[0], '-2', read_set.files[1]))
@@ -609,42 +913,594 @@ def runBowtie(contigFile, read_set, args, outformat='bam'):
         command.extend(('-U', read_set.files[0]))
     if read_set.format == 'fasta':
         command.append('-f')
+    if read_group:
+        command.extend(('--rg-id', read_group, '--rg', 'SM:'+read_group))
     command.extend(('-S', samFile))
-    LOG.write(" ".join(command)+"\n")
-    return_code = subprocess.call(command, shell=False) #, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    LOG.write("bowtie2 return code = %d\n"%return_code)
+    context.log.write(" ".join(command)+"\n")
+    return_code = context.runner.call(command, stderr=context.log)
+    lease.release()
+    context.log.write("bowtie2 return code = %d\n"%return_code)
     #shutil.rmtree('bowtie_index_dir')
     if return_code != 0:
         return None
     if outformat == 'sam':
         return samFile
     else:
-        contigsBam = convertSamToBam(samFile, args)
-        LOG.write('runBowtie returning %s\n'%contigsBam)
+        contigsBam = convertSamToBam(context, samFile, args)
+        context.log.write('runBowtie returning %s\n'%contigsBam)
         return contigsBam
 
-def runPilon(contigFile, read_set, args, details):
-    """ 
+def runBowtieLibraries(context, contigFile, read_sets, args):
+    """
+    Map several short-read libraries to contigFile with one bowtie2 index.
+    Library i (a ReadLibrary, or None to skip it) is tagged as read group lib<i+1>.
+    Return list of (pilon option, bam): paired libraries merged into one --frags bam, unpaired into one --unpaired bam.
+    """
+    bams = {'--frags': [], '--unpaired': []}
+    build_index = True
+    for i, read_set in enumerate(read_sets):
+        if not read_set:
+            continue
+        bam = runBowtie(context, contigFile, read_set, args, outformat='bam', read_group="lib{}".format(i+1), build_index=build_index)
+        build_index = False
+        if not (bam and os.path.exists(bam)):
+            context.log.write("runBowtie failed on {}\n".format(read_set.files[0]))
+            return None
+        bams['--frags' if len(read_set.files) > 1 else '--unpaired'].append(bam)
+    bamFiles = []
+    merges = [option for option in ('--frags', '--unpaired') if len(bams[option]) > 1]
+    for option in ('--frags', '--unpaired'):
+        if len(bams[option]) == 1:
+            bamFiles.append((option, bams[option][0]))
+        elif bams[option]:
+            bamFiles.append((option, contigFile.replace(".fasta", "")+option.replace("--", "_")+".bam"))
+    if merges:
+        # paired and unpaired merges are independent, so they run at once, splitting the threads of one lease
+        with context.resources.lease('samtools', threads=args.threads) as lease:
+            threads = max(1, int(lease.threads / len(merges)))
+            runs = []
+            for option in merges:
+                command = ["samtools", "merge", "-f", "-@", str(threads), dict(bamFiles)[option]] + bams[option]
+                context.log.write(" ".join(command)+"\n")
+                runs.append({'command': command, 'name': 'samtools merge', 'stderr': context.log})
+            results = context.runner.runMany(runs)
+        for result in results:
+            if result.returncode != 0:
+                context.log.write("samtools merge returned {}\n".format(result.returncode))
+                return None
+        context.runner.runMany([{'command': ["samtools", "index", dict(bamFiles)[option]], 'stderr': context.log} for option in merges])
+        for option in merges:
+            for bam in bams[option]:
+                for temp_file in (bam, bam+".bai"):
+                    if os.path.exists(temp_file):
+                        os.remove(temp_file)
+    return bamFiles
+
+def readContigLengths(contigFile):
+    """ Return list of (contig_id, length) in file order. """
+    contig_lengths = []
+    with open(contigFile) as IN:
+        for line in IN:
+            if line.startswith(">"):
+                contig_lengths.append([line[1:].split()[0], 0])
+            elif contig_lengths:
+                contig_lengths[-1][1] += len(line.rstrip())
+    return [tuple(x) for x in contig_lengths]
+
+def partitionContigs(contig_lengths, num_bins):
+    """
+    Split contigs into at most num_bins groups of similar total length (longest first into the lightest bin).
+    Return list of bins, each a list of contig ids in original file order.
+    """
+    num_bins = max(1, min(num_bins, len(contig_lengths)))
+    bins = [[] for i in range(num_bins)]
+    bin_length = [0]*num_bins
+    order = {contig: i for i, (contig, length) in enumerate(contig_lengths)}
+    for contig, length in sorted(contig_lengths, key=lambda x: -x[1]):
+        lightest = bin_length.index(min(bin_length))
+        bins[lightest].append(contig)
+        bin_length[lightest] += length
+    for contig_bin in bins:
+        contig_bin.sort(key=lambda contig: order[contig])
+    return [contig_bin for contig_bin in bins if contig_bin]
+
+def estimatePilonHeap(sequence_length, bam_bytes, memory_budget):
+    """
+    Heap in GB for a pilon jvm processing sequence_length bases covered by bam_bytes of alignments.
+    Never exceeds memory_budget (GB).
+    """
+    heap = PILON_MIN_HEAP_GB + PILON_GB_PER_MBASE * sequence_length / 1e6 + PILON_GB_PER_BAM_GB * bam_bytes / 1e9
+    heap = int(heap + 0.999)
+    return max(1, min(heap, int(memory_budget)))
+
+def runConcurrentStages(context, stages):
+    """
+    Run stages, each a dict with name, function, threads and optionally after (names of stages it depends on).
+    Each stage starts in its own thread as soon as the stages it depends on have finished, calling function(threads).
+    Sets start, end (seconds since job start) and result on each stage. An exception in a stage is raised once the others finish.
+    """
+    finished = set()
+    pending = list(stages)
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(stages))) as pool:
+        while pending or running:
+            for stage in list(pending):
+                if all(name in finished for name in stage.get('after', [])):
+                    pending.remove(stage)
+                    context.log.write("starting stage {} with {} threads\n".format(stage['name'], stage['threads']))
+                    stage['start'] = time() - context.start_time
+                    running[pool.submit(stage['function'], stage['threads'])] = stage
+            if not running:
+                raise Exception("stages {} depend on stages that do not exist".format([stage['name'] for stage in pending]))
+            done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                stage['end'] = time() - context.start_time
+                stage['result'] = future.result()
+                context.log.write("finished stage {} in {:.1f} seconds\n".format(stage['name'], stage['end'] - stage['start']))
+                finished.add(stage['name'])
+    return stages
+
+def threadArgs(args, threads):
+    """ copy of args with its thread count replaced, for a stage given a share of --threads """
+    stage_args = copy.copy(args)
+    stage_args.threads = threads
+    return stage_args
+
+def runJobsWithinMemory(context, jobs, memory_budget):
+    """
+    Run jobs on context.executor, largest first. On this node, the sum of their memory is kept within memory_budget (GB)
+    and a job larger than the budget runs by itself; a batch queue gets them all at once.
+    Each job is a dict with 'name', 'command' and 'memory_gb', optionally 'threads', 'stdout' (file name),
+    'inputs' and 'outputs' (files that must exist before and after it runs) and 'tool', whose time limit applies to it.
+    Sets 'return_code' and 'seconds' in each job. Return the last nonzero return code, or 0.
+    """
+    executor = context.executor
+    pending = sorted(jobs, key=lambda x: -x["memory_gb"])
+    running = []
+    memory_in_use = 0
+    return_code = 0
+    while pending or running:
+        while pending and (not running or not executor.shares_budget or memory_in_use + pending[0]["memory_gb"] <= memory_budget):
+            job = pending.pop(0)
+            missing = missingFiles(job.get("inputs"))
+            if missing:
+                context.log.write("{} cannot start, missing input {}\n".format(job["name"], missing[0]))
+                job["return_code"] = return_code = 1
+                job["seconds"] = 0
+                continue
+            context.log.write(" ".join(job["command"])+"\n")
+            job["time_limit"] = context.runner.limits.get(job.get("tool"))
+            job["start"] = time()
+            job["handle"] = executor.submit(job)
+            running.append(job)
+            memory_in_use += job["memory_gb"]
+        if running:
+            # wake for the first job to end, or for the first time limit to pass
+            time_limits = [job["start"] + job["time_limit"] - time() for job in running if job["time_limit"]]
+            executor.wait([job["handle"] for job in running], max(0, min(time_limits)) if time_limits else None)
+        for job in list(running):
+            job_return_code = executor.poll(job["handle"])
+            if job_return_code is None and job["time_limit"] and time() - job["start"] > job["time_limit"]:
+                context.log.write("{} exceeded its time limit of {:.0f} seconds, terminating it\n".format(job["name"], job["time_limit"]))
+                job_return_code = executor.cancel(job["handle"])
+                job["timed_out"] = True
+            if job_return_code is None:
+                continue
+            job["seconds"] = time() - job["start"]
+            del job["handle"]
+            missing = missingFiles(job.get("outputs"))
+            if job_return_code == 0 and missing:
+                context.log.write("{} did not write {}\n".format(job["name"], missing[0]))
+                job_return_code = 1
+            job["return_code"] = job_return_code
+            context.log.write("{} return code = {}, duration = {:.1f}\n".format(job["name"], job_return_code, job["seconds"]))
+            running.remove(job)
+            memory_in_use -= job["memory_gb"]
+            if job_return_code != 0:
+                return_code = job_return_code
+    context.log.flush()
+    return return_code
+
+def runPilonShards(context, contigFile, bamFiles, pilonContigs, args, details):
+    """
+    Run pilon as concurrent jvms, each restricted to a group of contigs by --targets.
+    bamFiles is a list of (pilon option, bam), e.g. ('--frags', 'x.bam').
+    Shards are launched largest first while their summed heaps fit within the memory leased for pilon,
+    or all at once when context.executor is a batch queue.
+    Shard outputs are merged to pilonContigs.fasta and pilonContigs.changes, as a single run would write.
+    Return (return_code, shard_info).
+    """
+    contig_lengths = readContigLengths(contigFile)
+    if not contig_lengths:
+        context.log.write("pilon shards: no contigs in {}\n".format(contigFile))
+        return 1, []
+    total_length = sum(length for contig, length in contig_lengths)
+    contig_length = dict(contig_lengths)
+    if context.executor.shares_budget:
+        lease = context.resources.lease('pilon', threads=args.threads)
+        threads, memory_budget = lease.threads, lease.memory_gb
+    else: # shards are queued with threads and memory of their own, each up to what this job may use
+        lease = None
+        threads, memory_budget = args.threads, args.memory
+    bam_size = sum(os.path.getsize(bamFile) for option, bamFile in bamFiles)
+    num_shards = args.pilon_shards
+    if not num_shards: # auto: enough shards to keep all threads busy at a few threads each
+        num_shards = max(1, int(threads / PILON_THREADS_PER_SHARD))
+    shards = []
+    for i, contig_bin in enumerate(partitionContigs(contig_lengths, num_shards)):
+        shard_length = sum(contig_length[contig] for contig in contig_bin)
+        shard_bam_bytes = bam_size * shard_length / max(total_length, 1)
+        shard = {"name": "{}_shard_{}".format(pilonContigs, i+1),
+                 "contigs": contig_bin,
+                 "length": shard_length,
+                 "heap_gb": estimatePilonHeap(shard_length, shard_bam_bytes, memory_budget)}
+        with open(shard["name"]+".targets", 'w') as F:
+            F.write("\n".join(contig_bin)+"\n")
+        shards.append(shard)
+    shard_threads = max(1, int(threads / len(shards)))
+    context.log.write("pilon: {} shards, {} threads each, memory budget {:.1f}GB\n".format(len(shards), shard_threads, memory_budget))
+
+    for shard in shards:
+        command = ['java', '-Xmx{}G'.format(shard["heap_gb"]), '-jar', args.pilon_jar, '--genome', contigFile]
+        for option, bamFile in bamFiles:
+            command.extend((option, bamFile))
+        command.extend(('--targets', shard["name"]+".targets"))
+        command.extend(('--outdir', os.path.dirname(shard["name"]), '--output', os.path.basename(shard["name"]), '--changes', '--threads', str(shard_threads)))
+        shard["command"] = command
+        shard["tool"] = "pilon"
+        shard["threads"] = shard_threads
+        shard["memory_gb"] = shard["heap_gb"]
+        shard["inputs"] = [contigFile, shard["name"]+".targets"] + [bamFile for option, bamFile in bamFiles]
+        shard["outputs"] = [shard["name"]+".fasta"]
+    return_code = runJobsWithinMemory(context, shards, memory_budget)
+    if lease:
+        lease.release()
+
+    shard_info = []
+    for shard in shards:
+        shard_info.append({"contigs": len(shard["contigs"]), "length": shard["length"], "heap_gb": shard["heap_gb"], "seconds": shard.get("seconds", 0)})
+        os.remove(shard["name"]+".targets")
+    if return_code != 0:
+        return return_code, shard_info
+
+    # merge shard outputs, restoring original contig order
+    polished = {}
+    for shard in shards:
+        targets = set(shard["contigs"])
+        seqId = None
+        with open(shard["name"]+".fasta") as IN:
+            for line in IN:
+                if line.startswith(">"):
+                    seqId = line[1:].split()[0]
+                    contig = re.sub("_pilon$", "", seqId)
+                    if contig not in targets:
+                        seqId = None # pilon wrote an untargeted contig, skip it
+                        continue
+                    polished[contig] = [line]
+                elif seqId:
+                    polished[contig].append(line)
+        os.remove(shard["name"]+".fasta")
+    missing = [contig for contig, length in contig_lengths if contig not in polished]
+    if missing:
+        context.log.write("pilon shards did not return {} contigs, e.g. {}\n".format(len(missing), missing[0]))
+        return 1, shard_info
+    with open(pilonContigs+".fasta", 'w') as OUT:
+        for contig, length in contig_lengths:
+            OUT.write("".join(polished[contig]))
+    with open(pilonContigs+".changes", 'w') as OUT:
+        for shard in shards:
+            if os.path.exists(shard["name"]+".changes"):
+                with open(shard["name"]+".changes") as IN:
+                    OUT.write(IN.read())
+                os.remove(shard["name"]+".changes")
+    return 0, shard_info
+
+def readFastaSequences(fastaFile):
+    """ Return list of (seq_id, sequence) in file order. """
+    sequences = []
+    with open(fastaFile) as IN:
+        for line in IN:
+            if line.startswith(">"):
+                sequences.append([line[1:].split()[0], []])
+            elif sequences:
+                sequences[-1][1].append(line.rstrip())
+    return [(seq_id, "".join(parts)) for seq_id, parts in sequences]
+
+def parsePilonChanges(changesFile):
+    """
+    Return list of (old_id, old_start, old_end, new_id, new_start, new_end, old_seq, new_seq) from a pilon .changes file.
+    Insertions have a single old coordinate, deletions a single new coordinate.
+    """
+    changes = []
+    with open(changesFile) as IN:
+        for line in IN:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            old = re.match(r"(\S+):(\d+)(?:-(\d+))?$", fields[0])
+            new = re.match(r"(\S+):(\d+)(?:-(\d+))?$", fields[1])
+            if not (old and new):
+                continue
+            changes.append((old.group(1), int(old.group(2)), int(old.group(3) or old.group(2)),
+                            new.group(1), int(new.group(2)), int(new.group(3) or new.group(2)), fields[2], fields[3]))
+    return changes
+
+def mergeWindows(positions, flank, length):
+    """ Widen (start, end) positions by flank and merge into sorted, non-overlapping 1-based windows within 1..length """
+    windows = []
+    for start, end in sorted(positions):
+        start = max(1, start - flank)
+        end = min(length, end + flank)
+        if windows and start <= windows[-1][1] + 1:
+            windows[-1][1] = max(windows[-1][1], end)
+        else:
+            windows.append([start, end])
+    return [tuple(window) for window in windows]
+
+def iterReadRecords(read_file, read_format='fastq'):
+    """
+    Yield (read_name, record_text) from a fastq (4-line records) or fasta (possibly multi-line) file.
+    Read names lose any /1 or /2 suffix, as aligners report them.
+    """
+    opener = gzip.open if read_file.endswith("gz") else open
+    with opener(read_file, 'rt') as IN:
+        record = []
+        if read_format == 'fasta':
+            for line in IN:
+                if line.startswith(">") and record:
+                    yield re.sub("/[12]$", "", record[0][1:].split()[0]), "".join(record)
+                    record = []
+                record.append(line)
+            if record:
+                yield re.sub("/[12]$", "", record[0][1:].split()[0]), "".join(record)
+        else:
+            for line in IN:
+                record.append(line)
+                if len(record) == 4:
+                    yield re.sub("/[12]$", "", record[0][1:].split()[0]), "".join(record)
+                    record = []
+
+def extractReadsByName(read_set, read_names, out_prefix):
+    """
+    Write reads (both mates if paired) whose names are in read_names to new files named from out_prefix.
+    Return list of new file names.
+    """
+    out_files = []
+    for i, read_file in enumerate(read_set.files):
+        out_file = "{}_{}.{}".format(out_prefix, i+1, 'fa' if read_set.format == 'fasta' else 'fq')
+        with open(out_file, 'w') as OUT:
+            for read_name, record in iterReadRecords(read_file, read_set.format):
+                if read_name in read_names:
+                    OUT.write(record)
+        out_files.append(out_file)
+    return out_files
+
+def combineReadLibraries(context, read_sets, out_prefix):
+    """
+    Concatenate single-file read libraries of one platform into one file for a batched polishing run.
+    Read names get a lib<N>_ prefix so names repeated across libraries stay distinct.
+    Output is fastq unless any input is fasta. Return new ReadLibrary.
+    """
+    read_format = 'fasta' if any(read_set.format == 'fasta' for read_set in read_sets) else 'fastq'
+    out_file = out_prefix + ('.fa' if read_format == 'fasta' else '.fq')
+    with open(out_file, 'w') as OUT:
+        for i, read_set in enumerate(read_sets):
+            prefix = "lib{}_".format(i+1)
+            for read_name, record in iterReadRecords(read_set.files[0], read_set.format):
+                if read_format == 'fasta' and read_set.format != 'fasta':
+                    lines = record.split("\n")
+                    record = ">"+lines[0][1:]+"\n"+lines[1]+"\n"
+                OUT.write(record[0]+prefix+record[1:])
+    combined = ReadLibrary(out_file, platform=read_sets[0].platform, context=context)
+    combined.format = read_format
+    # racon takes a quality threshold from the poorest library; none is usable once fasta is involved
+    qualities = [read_set.avg_quality for read_set in read_sets]
+    combined.avg_quality = 0 if read_format == 'fasta' or not all(qualities) else min(qualities)
+    return combined
+
+def recordPilonState(state, bamFiles, read_regions, changed):
+    """
+    Remember what the next incremental pilon round needs: the bams of this round,
+    the regions of those bams holding reads near each change, and the changed positions in the output contigs.
+    """
+    if state.get('bams') and state['bams'] != bamFiles:
+        removePilonState(state)
+    state['bams'] = bamFiles
+    state['read_regions'] = read_regions
+    state['changed'] = changed
+
+def removePilonState(state):
+    """ Delete the bams kept for incremental pilon rounds. """
+    for option, bamFile in state.pop('bams', []):
+        for temp_file in (bamFile, bamFile+".bai"):
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    state.pop('read_regions', None)
+    state.pop('changed', None)
+
+def changeLength(text):
+    """ length of a sequence in a pilon .changes line, where '.' is none """
+    return 0 if text == "." else len(text)
+
+def splicePolishedWindow(original, polished, changes, left_edge, right_edge):
+    """
+    The window sequence to splice back: polished, with changes starting within left_edge bases of its start
+    or ending within right_edge bases of its end reverted to original (they may be artifacts of reads cut off by the window).
+    Return (changes kept, sequence, bases by which the new coordinates of kept changes are past their position in sequence).
+    """
+    if not (polished and changes):
+        return [], original, 0
+    length = len(original)
+    left = [change for change in changes if change[1] <= left_edge]
+    right = [change for change in changes if change not in left and change[2] > length - right_edge]
+    kept = [change for change in changes if change not in left and change not in right]
+    left_cut = max([change[2] for change in left] or [0]) # original bases kept at the start
+    right_cut = min([change[1] - 1 for change in right] or [length]) # original bases from here on are kept
+    left_shift = sum(changeLength(change[7]) - changeLength(change[6]) for change in left)
+    right_shift = sum(changeLength(change[7]) - changeLength(change[6]) for change in right)
+    if not kept or left_cut > right_cut:
+        return [], original, 0
+    middle = polished[left_cut + left_shift:len(polished) - (length - right_cut) - right_shift]
+    return kept, original[:left_cut] + middle + original[right_cut:], left_shift
+
+def runPilonWindows(context, contigFile, read_sets, args, details, state, pilonContigs):
+    """
+    Re-polish only windows around the changes of the previous pilon round.
+    Reads aligned near those changes in the previous round's bam are mapped to the window sequences,
+    pilon polishes the windows, and the corrected windows are spliced back into the contigs.
+    Writes pilonContigs.fasta and pilonContigs.changes (in contig coordinates) as a full pilon run would.
+    Return (return_code, num_changes, shard_info), or None if a full round should be run instead.
+    """
+    flank = args.pilon_window
+    contigs = readFastaSequences(contigFile)
+    contig_seq = dict(contigs)
+    positions = {}
+    for contig, start, end in state['changed']:
+        positions.setdefault(contig, []).append((start, end))
+    windows = {}
+    window_length = 0
+    for contig in positions:
+        if contig not in contig_seq:
+            context.log.write("incremental pilon: changed contig {} not in {}\n".format(contig, contigFile))
+            return None
+        windows[contig] = mergeWindows(positions[contig], flank, len(contig_seq[contig]))
+        window_length += sum(end - start + 1 for start, end in windows[contig])
+    total_length = sum(len(seq) for contig, seq in contigs)
+    context.log.write("incremental pilon: {} changes in {} windows covering {} of {} bases\n".format(len(state['changed']), sum(len(w) for w in windows.values()), window_length, total_length))
+    if window_length > total_length * PILON_WINDOW_FRACTION:
+        return None
+
+    # collect names of reads aligned around the changes in the previous round
+    regionsBed = pilonContigs+"_read_regions.bed"
+    with open(regionsBed, 'w') as BED:
+        for ref, start, end in state['read_regions']:
+            BED.write("{}\t{}\t{}\n".format(ref, max(0, start - 1 - flank), end + flank))
+    read_names = [set() for read_set in read_sets] # by library, from the read group lib<N>
+    runs = []
+    nearFiles = []
+    for i, (option, bamFile) in enumerate(state['bams']):
+        nearFile = "{}_near_changes_{}.sam".format(pilonContigs, i+1)
+        command = ["samtools", "view", "-L", regionsBed, "-o", nearFile, bamFile]
+        context.log.write(" ".join(command)+"\n")
+        runs.append({'command': command, 'name': 'samtools view'})
+        nearFiles.append(nearFile)
+    return_code = 0
+    for nearFile, result in zip(nearFiles, context.runner.runMany(runs)):
+        return_code = return_code or result.returncode
+        if os.path.exists(nearFile):
+            with open(nearFile) as IN:
+                for line in IN:
+                    m = re.search(r"\tRG:Z:lib(\d+)", line)
+                    library = int(m.group(1)) - 1 if m else 0
+                    read_names[library].add(line.split("\t", 1)[0])
+            os.remove(nearFile)
+    os.remove(regionsBed)
+    num_reads = sum(len(names) for names in read_names)
+    if return_code != 0 or not num_reads:
+        context.log.write("incremental pilon: samtools view return code {}, {} reads, run full round\n".format(return_code, num_reads))
+        return None
+    window_read_sets = []
+    readFiles = []
+    for i, read_set in enumerate(read_sets):
+        if not read_names[i]:
+            window_read_sets.append(None)
+            continue
+        libraryFiles = extractReadsByName(read_set, read_names[i], "{}_lib{}_window_reads".format(pilonContigs, i+1))
+        window_reads = ReadLibrary(libraryFiles if len(libraryFiles) > 1 else libraryFiles[0], platform=read_set.platform, context=context)
+        window_reads.format = read_set.format
+        window_read_sets.append(window_reads)
+        readFiles.extend(libraryFiles)
+    context.log.write("incremental pilon: {} reads near changes\n".format(num_reads))
+
+    windowsFile = pilonContigs+"_window_seqs.fasta"
+    window_id = {}
+    with open(windowsFile, 'w') as OUT:
+        for contig in windows:
+            for start, end in windows[contig]:
+                seq_id = "{}__{}_{}".format(contig, start, end)
+                window_id[seq_id] = (contig, start, end)
+                OUT.write(">"+seq_id+"\n")
+                seq = contig_seq[contig][start-1:end]
+                for i in range(0, len(seq), 60):
+                    OUT.write(seq[i:i+60]+"\n")
+
+    windowBams = runBowtieLibraries(context, windowsFile, window_read_sets, args)
+    for readFile in readFiles:
+        os.remove(readFile)
+    if not windowBams:
+        context.log.write("incremental pilon: runBowtie failed on windows\n")
+        os.remove(windowsFile)
+        return None
+    windowPilon = pilonContigs+"_windows"
+    return_code, shard_info = runPilonShards(context, windowsFile, windowBams, windowPilon, args, details)
+    if return_code != 0:
+        os.remove(windowsFile)
+        removePilonState({'bams': windowBams})
+        return return_code, 0, shard_info
+
+    polished = {}
+    for seq_id, seq in readFastaSequences(windowPilon+".fasta"):
+        polished[re.sub("_pilon$", "", seq_id)] = seq
+    window_changes = {}
+    for change in parsePilonChanges(windowPilon+".changes"):
+        window_changes.setdefault(change[0], []).append(change)
+    os.remove(windowPilon+".fasta")
+    os.remove(windowPilon+".changes")
+    os.remove(windowsFile)
+
+    # splice polished windows back into contigs, translating change coordinates
+    edge = int(flank / 4)
+    contig_changes = []
+    read_regions = []
+    with open(pilonContigs+".fasta", 'w') as OUT:
+        for contig, seq in contigs:
+            pieces = []
+            prev_end = 0
+            delta = 0
+            for start, end in windows.get(contig, []):
+                seq_id = "{}__{}_{}".format(contig, start, end)
+                pieces.append(seq[prev_end:start-1])
+                kept, window_seq, shift = splicePolishedWindow(seq[start-1:end], polished.get(seq_id), window_changes.get(seq_id, []),
+                                                               edge if start > 1 else 0, edge if end < len(seq) else 0)
+                pieces.append(window_seq)
+                for (old_id, old_start, old_end, new_id, new_start, new_end, old_seq, new_seq) in kept:
+                    contig_changes.append("{}:{}-{} {}_pilon:{}-{} {} {}".format(contig, start + old_start - 1, start + old_end - 1,
+                        contig, start + delta + new_start - shift - 1, start + delta + new_end - shift - 1, old_seq, new_seq))
+                    read_regions.append((seq_id, old_start, old_end))
+                delta += len(window_seq) - (end - start + 1)
+                prev_end = end
+            pieces.append(seq[prev_end:])
+            new_seq = "".join(pieces)
+            OUT.write(">"+contig+"_pilon\n")
+            for i in range(0, len(new_seq), 60):
+                OUT.write(new_seq[i:i+60]+"\n")
+    with open(pilonContigs+".changes", 'w') as OUT:
+        for line in contig_changes:
+            OUT.write(line+"\n")
+    changes = parsePilonChanges(pilonContigs+".changes")
+    recordPilonState(state, windowBams, read_regions, [(change[3], change[4], change[5]) for change in changes])
+    return 0, len(contig_changes), shard_info
+
+def runPilon(context, contigFile, read_sets, args, details, state=None):
+    """
     polish contigs with short reads (illumina or iontorrent)
+    read_sets is one ReadLibrary or a list of them, which are all given to a single pilon run
     first map reads to contigs with bowtie
+    pilon runs as one or more contig shards (see runPilonShards)
+    if state holds the changes of a previous round (and args.pilon_window is set),
+    only windows around those changes are re-polished (see runPilonWindows)
     """
-    LOG.write("runPilon starting Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
-    LOG.write("runPilon(%s, %s, %s, %s)\n"%(contigFile, read_set.files[0], str(type(args)), len(details)))
+    context.log.write("runPilon starting Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
+    if isinstance(read_sets, ReadLibrary):
+        read_sets = [read_sets]
+    context.log.write("runPilon(context, %s, %s, %s, %s)\n"%(contigFile, ",".join(read_set.files[0] for read_set in read_sets), str(type(args)), len(details)))
     if not (args.pilon_jar and os.path.exists(args.pilon_jar)):
         comment = "jarfile %s not found for runPilon, giving up"%(args.pilon_jar)
-        LOG.write(comment+"\n")
+        context.log.write(comment+"\n")
         return None
 
-    bamFile = runBowtie(contigFile, read_set, args, outformat='bam')
-    if not (bamFile and os.path.exists(bamFile)):
-        sys.stderr.write("Problem: runBowtie failed to return expected bamfile {}\n".format(bamFile))
-        return None
     pilon_start_time = time()
-    command = ['java', '-Xmx32G', '-jar', args.pilon_jar, '--genome', contigFile]
-    if len(read_set.files) > 1:
-        command.extend(('--frags', bamFile))
-    else:
-        command.extend(('--unpaired', bamFile))
     pilonPrefix = contigFile.replace(".fasta", "")
     m = re.match(".*pilon_(\d+)", pilonPrefix)
     if m :
@@ -653,65 +1509,175 @@ def runPilon(contigFile, read_set, args, details):
     else:
         pilonPrefix += "_pilon_1"
     pilonContigs = pilonPrefix  # + ".fasta" this gets added by pilon
-    command.extend(('--outdir', '.', '--output', pilonContigs, '--changes'))
-    command.extend(('--threads', str(args.threads)))
-    LOG.write(" ".join(command)+"\n")
-    LOG.write("bamfile = {}, size={}\n".format(bamFile, os.path.getsize(bamFile)))
-    return_code = subprocess.call(command, shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    LOG.write("pilon return code = %d\n"%return_code)
+
+    window_result = None
+    if state and state.get('changed') and args.pilon_window:
+        window_result = runPilonWindows(context, contigFile, read_sets, args, details, state, pilonContigs)
+    if window_result:
+        return_code, pilon_changes, shard_info = window_result
+        context.log.write("incremental pilon return code = %d\n"%return_code)
+        if return_code != 0:
+            return None
+    else:
+        if state:
+            removePilonState(state)
+        bamFiles = runBowtieLibraries(context, contigFile, read_sets, args)
+        if not bamFiles:
+            sys.stderr.write("Problem: runBowtie failed to return expected bamfiles\n")
+            return None
+        for option, bamFile in bamFiles:
+            context.log.write("bamfile = {}, size={}\n".format(bamFile, os.path.getsize(bamFile)))
+        return_code, shard_info = runPilonShards(context, contigFile, bamFiles, pilonContigs, args, details)
+        context.log.write("pilon return code = %d\n"%return_code)
+        if return_code == 0 and state is not None and args.pilon_window:
+            changes = parsePilonChanges(pilonContigs+".changes")
+            recordPilonState(state, bamFiles, [change[:3] for change in changes], [change[3:6] for change in changes])
+        else:
+            removePilonState({'bams': bamFiles})
+        if return_code != 0:
+            return None
+        pilon_changes = 0
+        with open(pilonContigs+".changes") as CHANGES:
+            pilon_changes = len(CHANGES.read().splitlines())
     pilon_time = time() - pilon_start_time
-    LOG.write("pilon duration = %d\n"%(pilon_time))
-    LOG.flush()
-    os.remove(bamFile)
-    if os.path.exists(bamFile+".bai"):
-        os.remove(bamFile+".bai")
-    if return_code != 0:
-        return None
-    pilon_changes = 0
-    with open(pilonContigs+".changes") as CHANGES:
-        pilon_changes = len(CHANGES.read().splitlines())
+    context.log.write("pilon duration = %d\n"%(pilon_time))
+    context.log.flush()
     #os.remove(pilonContigs+".changes")
-    command = ["java", "-jar", args.pilon_jar, "--version"]
-    proc = subprocess.run(command, shell=False, capture_output=True, text=True)
-    pilon_version = proc.stdout
+    pilon_version = context.tools.version("pilon", args.pilon_jar)
 
     report = {"input_contigs":contigFile, 
-            "reads": ":".join(read_set.files), 
+            "reads": ",".join(":".join(read_set.files) for read_set in read_sets), 
             "program": "pilon", 
             "version": pilon_version, 
             "output": pilonContigs+".fasta", 
             "num_changes": pilon_changes, 
             "seconds" : pilon_time}
+    if len(shard_info) > 1:
+        report["shards"] = shard_info
+    if window_result:
+        report["incremental"] = True
 
     comment = "pilon, input %s, output %s, num_changes = %d"%(contigFile, pilonContigs, pilon_changes)
-    LOG.write(comment+"\n")
+    context.log.write(comment+"\n")
     details["post-assembly transformation"].append(comment)
     #new_contigFile = pilonContigs+'.fasta'
-    os.remove(contigFile) # clean up old one
     #os.remove(bamFile)
     return report 
 
-def calcReadDepth(bamfiles):
-    """ Return dict of contig_ids to tuple of (coverage, normalized_coverage) """
-    LOG.write("calcReadDepth(%s)\n"%" ".join(bamfiles))
-    readDepth = {}
+def runPileupPolisher(context, contigFile, read_sets, args, details):
+    """
+    polish contigs with short reads by majority consensus of a samtools pileup (no JVM), the alternative to runPilon
+    output naming, .changes file and report follow runPilon so the two are interchangeable
+    """
+    context.log.write("runPileupPolisher starting Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
+    if isinstance(read_sets, ReadLibrary):
+        read_sets = [read_sets]
+    polish_start_time = time()
+    pilonPrefix = contigFile.replace(".fasta", "")
+    m = re.match(r".*pilon_(\d+)", pilonPrefix)
+    if m :
+        level = int(m.group(1))
+        pilonPrefix = re.sub("pilon_"+m.group(1), "pilon_{}".format(level+1), pilonPrefix)
+    else:
+        pilonPrefix += "_pilon_1"
+    bamFiles = runBowtieLibraries(context, contigFile, read_sets, args)
+    if not bamFiles:
+        sys.stderr.write("Problem: runBowtie failed to return expected bamfiles\n")
+        return None
+    polisher = PileupPolisher(contigFile, [bamFile for option, bamFile in bamFiles], log=context.log)
+    num_changes = polisher.polish(pilonPrefix)
+    removePilonState({'bams': bamFiles})
+    if num_changes is None:
+        return None
+    polish_time = time() - polish_start_time
+    report = {"input_contigs":contigFile, 
+            "reads": ",".join(":".join(read_set.files) for read_set in read_sets), 
+            "program": "pileup", 
+            "version": PileupPolisher.program_version, 
+            "output": pilonPrefix+".fasta", 
+            "num_changes": num_changes, 
+            "seconds" : polish_time}
+    comment = "pileup polish, input %s, output %s, num_changes = %d"%(contigFile, pilonPrefix, num_changes)
+    context.log.write(comment+"\n")
+    details["post-assembly transformation"].append(comment)
+    return report 
+
+def runFilterStage(context, manifest, upstream, contigs, read_list, args, details):
+    """ contig filtering by length and coverage as a manifest stage; return (filtered contigs, stage fingerprint) """
+    filter_params = {'min_contig_length': args.min_contig_length, 'min_contig_coverage': args.min_contig_coverage}
+    stage = manifest.skip("filter", filter_params, [contigs], upstream=upstream)
+    if stage:
+        restoreStage(context, stage, details, keys=['contig_filtering'])
+    else:
+        details['contig_filtering'] = filterContigsByLengthAndCoverage(context, contigs, read_list, args, details)
+    filtered = details['contig_filtering'].get('good contigs file', contigs)
+    if not stage:
+        stage = manifest.complete("filter", filter_params, [contigs], outputs=[filtered], versions=dict(details['version']),
+                state=stageState(details, read_list, keys=['contig_filtering']))
+    return filtered, stage['fingerprint']
+
+def runQuastStage(context, manifest, upstream, contigs, read_list, args, details, mode='full'):
+    """
+    quast on the final contigs, which are then copied to the save directory, as a manifest stage
+    mode: 'full', 'fast' (quast --fast) or None to only save the contigs, as the walltime budget allows
+    """
+    if not (contigs and os.path.getsize(contigs)):
+        return
+    savedContigs = os.path.join(context.save_dir, args.prefix+"contigs.fasta")
+    quast_params = None if mode == 'full' else {'mode': mode}
+    stage = manifest.skip("quast", quast_params, [contigs], upstream=upstream)
+    if stage:
+        restoreStage(context, stage, details, keys=['quast_txt', 'quast_html'])
+        return
+    if mode:
+        runQuast(context, contigs, args, details, fast=(mode == 'fast'))
+    # copy rather than move, so a resumed run can still find the filtered contigs
+    shutil.copy(contigs, savedContigs)
+    manifest.complete("quast", quast_params, [contigs], outputs=[savedContigs], versions=dict(details['version']),
+            state=stageState(details, read_list, keys=['quast_txt', 'quast_html']))
+
+def runBandageStage(context, manifest, upstream, gfaFile, read_list, details):
+    """ Bandage image of the assembly graph as a manifest stage """
+    stage = manifest.skip("bandage", None, [gfaFile], upstream=upstream)
+    if stage:
+        restoreStage(context, stage, details, keys=['Bandage'])
+        return
+    runBandage(context, gfaFile, details)
+    manifest.complete("bandage", None, [gfaFile], outputs=glob.glob(gfaFile.replace(".gfa", ".plot.*")), versions=dict(details['version']),
+            state=stageState(details, read_list, keys=['Bandage']))
+
+def calcReadDepth(context, bamfiles):
+    """ Return (mean depth, dict of contig_ids to tuple of (coverage, normalized_coverage)) from samtools depth of bamfiles """
+    context.log.write("calcReadDepth(context, %s)\n"%" ".join(bamfiles))
     command = ["samtools", "depth"]
     if type(bamfiles) is str:
         command.append(bamfiles)
     else:
         command.extend(bamfiles)
-    LOG.write("command = "+" ".join(command)+"\n")
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
-    depthData = proc.communicate()[0].decode()
-    if 0:
-        LOG.write("length of depthData string = %d\n"%len(depthData))
+    context.log.write("command = "+" ".join(command)+"\n")
+    depthStartTime = time()
+    depthData = context.runner.run(command, name='samtools depth', stdout=subprocess.PIPE).stdout
+    parseStartTime = time()
+    depthLines = depthData.splitlines()
+    (totalMeanDepth, readDepth) = parseReadDepth(depthLines)
+    context.log.write("len(readDepth) = %d\n"%len(readDepth))
+    context.events.counters('calcReadDepth', time() - parseStartTime, records=len(depthLines), bytes_in=len(depthData),
+            samtools_seconds=round(parseStartTime - depthStartTime, 3), contigs=len(readDepth))
+    return (totalMeanDepth, readDepth)
+
+def parseReadDepth(depthLines):
+    """
+    Parse lines of samtools depth output (contig, position, depth in each bam).
+    Return (mean depth, dict of contig_ids to [coverage, coverage normalized to the mean of contigs near the overall mean]).
+    """
+    readDepth = {}
     depthSum = 0
     totalDepthSum = 0
     totalLength = 0
     length = 0
     contigLength = {}
     prevContig=None
-    for line in iter(depthData.splitlines()):
+    for line in depthLines:
         fields = line.rstrip().split("\t")
         if len(fields) < 3:
             raise Exception("Number of fields is less than 3:\n"+line)
@@ -739,7 +1705,6 @@ def calcReadDepth(bamfiles):
 
     #LOG.write("total length for depth data = %d\n"%totalLength)
     #LOG.write("total depth = %.1f\n"%totalDepthSum)
-    LOG.write("len(readDepth) = %d\n"%len(readDepth))
     totalMeanDepth = 0
     if totalLength > 0:
         totalMeanDepth = totalDepthSum/totalLength
@@ -768,8 +1733,8 @@ def calcReadDepth(bamfiles):
         readDepth[c][1] = normalizedDepth
     return (totalMeanDepth, readDepth)
 
-def runCanu(details, read_list, canu_exec="canu", threads=1, genome_size="5m", memory=250, prefix=""):
-    LOG.write("runCanu: Tiime = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
+def runCanu(context, details, read_list, canu_exec="canu", threads=1, genome_size="5m", memory=250, prefix=""):
+    context.log.write("runCanu: Tiime = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
     canuStartTime = time()
     comment = """
 usage: canu [-version] [-citation] \
@@ -785,15 +1750,14 @@ usage: canu [-version] [-citation] \
     """
     # canu -d /localscratch/allan/canu_assembly -p p6_25X gnuplotTested=true genomeSize=5m useGrid=false -pacbio-raw pacbio_p6_25X.fastq
     # first get canu version
-    p = subprocess.Popen([canu_exec, "--version"], shell=False, stdout=subprocess.PIPE)
-    canu_version = p.stdout.readline().decode().rstrip()
+    canu_version = context.tools.version(canu_exec)
     details['version']['canu'] = canu_version
     details['assembly']['version'] = canu_version
     details['assembly']['assembler'] = 'canu'
-    p.wait()
 
-    command = [canu_exec, "-d", '.', "-p", "canu", "useGrid=false", "genomeSize=%s"%genome_size]
-    command.extend(["maxMemory=" + str(memory), "maxThreads=" + str(threads)])
+    command = [canu_exec, "-d", context.work_dir, "-p", "canu", "useGrid=false", "genomeSize=%s"%genome_size]
+    lease = context.resources.lease('canu', threads=threads, memory_gb=memory)
+    command.extend(lease.flags())
     if "1.7" in canu_version:
         # special handling for this version
         command.append("gnuplotTested=true")
@@ -813,17 +1777,19 @@ usage: canu [-version] [-citation] \
         command.append("-nanopore-raw")
         command.extend(nanopore_reads)
     if not len(pacbio_reads) + len(nanopore_reads):
-        LOG.write("no long read files available for canu.\n")
+        context.log.write("no long read files available for canu.\n")
         details["problem"].append("no long read files available for canu")
+        lease.release()
         return None
-    LOG.write("canu command =\n"+" ".join(command)+"\n")
-    LOG.flush()
+    context.log.write("canu command =\n"+" ".join(command)+"\n")
+    context.log.flush()
 
     canuStartTime = time()
     #with open(os.devnull, 'w') as FNULL: # send stdout to dev/null, it is too big
-    with open(os.path.join(DETAILS_DIR, prefix+"canu_stdout.txt"), 'w') as CANU_STDOUT: 
-        return_code = subprocess.call(command, shell=False, stdout=CANU_STDOUT, stderr=CANU_STDOUT)
-    LOG.write("return code = %d\n"%return_code)
+    with open(os.path.join(context.details_dir, prefix+"canu_stdout.txt"), 'w') as CANU_STDOUT: 
+        return_code = context.runner.call(command, stdout=CANU_STDOUT, stderr=CANU_STDOUT)
+    lease.release()
+    context.log.write("return code = %d\n"%return_code)
     canuEndTime = time()
     elapsedTime = canuEndTime - canuStartTime
     elapsedHumanReadable = ""
@@ -837,32 +1803,32 @@ usage: canu [-version] [-citation] \
     details["assembly"]['elapsed_time'] = elapsedHumanReadable
     details["assembly"]['command_line'] = " ".join(command)
 
-    LOG.write("Duration of canu run was %s\n"%(elapsedHumanReadable))
-    if os.path.exists("canu.report"):
-        LOG.write("details_dir = %s\n"%DETAILS_DIR)
-        LOG.write("canu_report file name = %s\n"%(prefix+"canu_report.txt"))
-        canuReportFile = os.path.join(DETAILS_DIR, (prefix+"canu_report.txt"))
-        LOG.write("moving canu.report to %s\n"%canuReportFile)
-        shutil.move("canu.report", canuReportFile)
+    context.log.write("Duration of canu run was %s\n"%(elapsedHumanReadable))
+    if os.path.exists(context.path("canu.report")):
+        context.log.write("details_dir = %s\n"%context.details_dir)
+        context.log.write("canu_report file name = %s\n"%(prefix+"canu_report.txt"))
+        canuReportFile = os.path.join(context.details_dir, (prefix+"canu_report.txt"))
+        context.log.write("moving canu.report to %s\n"%canuReportFile)
+        shutil.move(context.path("canu.report"), canuReportFile)
     
-    if not os.path.exists("canu.contigs.fasta"):
+    if not os.path.exists(context.path("canu.contigs.fasta")):
         comment = "Canu failed to generate contigs file. Check "+prefix+"canu_report.txt"
-        LOG.write(comment+"\n")
+        context.log.write(comment+"\n")
         details["assembly"]["outcome"] = comment
         details["problem"].append(comment)
         return None
     # rename to canonical contigs.fasta
-    contigsFile = "contigs.fasta"
-    shutil.move("canu.contigs.fasta", contigsFile)
-    if os.path.exists("canu.contigs.gfa"):
-        shutil.move("canu.contigs.gfa", os.path.join(DETAILS_DIR, prefix+"assembly_graph.gfa"))
-    elif os.path.exists("canu.unitigs.gfa"):
-        shutil.move("canu.unitigs.gfa", os.path.join(DETAILS_DIR, prefix+"assembly_graph.gfa"))
+    contigsFile = context.path("contigs.fasta")
+    shutil.move(context.path("canu.contigs.fasta"), contigsFile)
+    if os.path.exists(context.path("canu.contigs.gfa")):
+        shutil.move(context.path("canu.contigs.gfa"), os.path.join(context.details_dir, prefix+"assembly_graph.gfa"))
+    elif os.path.exists(context.path("canu.unitigs.gfa")):
+        shutil.move(context.path("canu.unitigs.gfa"), os.path.join(context.details_dir, prefix+"assembly_graph.gfa"))
     details["assembly"]["contigs.fasta size:"] = os.path.getsize(contigsFile)
     return contigsFile
 
-def runFlye(details, read_list, flye_exec="flye", threads=1, genome_size="5m", prefix=""):
-    LOG.write("runFlye: Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
+def runFlye(context, details, read_list, flye_exec="flye", threads=1, genome_size="5m", prefix=""):
+    context.log.write("runFlye: Time = %s\n"%(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))))
     flyeStartTime = time()
     comment = """
 usage: flye (--pacbio-raw | --pacbio-corr | --pacbio-hifi | --nano-raw |
@@ -876,12 +1842,10 @@ usage: flye (--pacbio-raw | --pacbio-corr | --pacbio-hifi | --nano-raw |
     [--read-error float] [--extra-params]
     """
     # first get flye version
-    p = subprocess.Popen(['flye', "--version"], shell=False, stdout=subprocess.PIPE)
-    flye_version = p.stdout.readline().decode().rstrip()
+    flye_version = context.tools.version("flye")
     details['version']['flye'] = flye_version
     details['assembly']['version'] = flye_version
     details['assembly']['assembler'] = 'flye'
-    p.wait()
 
     pacbio_reads = []
     nanopore_reads = []
@@ -891,24 +1855,27 @@ usage: flye (--pacbio-raw | --pacbio-corr | --pacbio-hifi | --nano-raw |
             pacbio_reads.append(read_set.files[0])
         if read_set.platform == 'nanopore':
             nanopore_reads.append(read_set.files[0])
-    command = ['flye', "--out-dir", '.', "--genome-size", str(genome_size), '--threads', str(threads)]
+    lease = context.resources.lease('flye', threads=threads)
+    command = ['flye', "--out-dir", context.work_dir, "--genome-size", str(genome_size)] + lease.flags()
     if pacbio_reads:
         command.append("--pacbio-raw")
         command.extend(pacbio_reads)
     elif nanopore_reads:
         command.append("--nano-raw")
         command.extend(nanopore_reads)
-    LOG.write(" ".join(command)+"\n")
+    context.log.write(" ".join(command)+"\n")
     if not pacbio_reads + nanopore_reads:
-        LOG.write("no long read files available for flye.\n")
+        context.log.write("no long read files available for flye.\n")
         details["problem"].append("no long read files available for flye")
+        lease.release()
         return None
 
     flyeStartTime = time()
     #with open(os.devnull, 'w') as FNULL: # send stdout to dev/null, it is too big
-    with open(os.path.join(DETAILS_DIR, prefix+"flye_stdout.txt"), 'w') as FLYE_STDOUT: 
-        return_code = subprocess.call(command, shell=False, stdout=FLYE_STDOUT, stderr=FLYE_STDOUT)
-    LOG.write("return code = %d\n"%return_code)
+    with open(os.path.join(context.details_dir, prefix+"flye_stdout.txt"), 'w') as FLYE_STDOUT: 
+        return_code = context.runner.call(command, stdout=FLYE_STDOUT, stderr=FLYE_STDOUT)
+    lease.release()
+    context.log.write("return code = %d\n"%return_code)
     flyeEndTime = time()
     elapsedTime = flyeEndTime - flyeStartTime
     elapsedHumanReadable = ""
@@ -922,30 +1889,30 @@ usage: flye (--pacbio-raw | --pacbio-corr | --pacbio-hifi | --nano-raw |
     details["assembly"]['elapsed_time'] = elapsedHumanReadable
     details["assembly"]['command_line'] = " ".join(command)
 
-    LOG.write("Duration of flye run was %s\n"%(elapsedHumanReadable))
-    if os.path.exists("flye.report"):
-        LOG.write("details_dir = %s\n"%DETAILS_DIR)
-        LOG.write("flye_report file name = %s\n"%(prefix+"flye_report.txt"))
-        flyeReportFile = os.path.join(DETAILS_DIR, (prefix+"flye_report.txt"))
-        LOG.write("moving flye.report to %s\n"%flyeReportFile)
-        shutil.move("flye.report", flyeReportFile)
+    context.log.write("Duration of flye run was %s\n"%(elapsedHumanReadable))
+    if os.path.exists(context.path("flye.report")):
+        context.log.write("details_dir = %s\n"%context.details_dir)
+        context.log.write("flye_report file name = %s\n"%(prefix+"flye_report.txt"))
+        flyeReportFile = os.path.join(context.details_dir, (prefix+"flye_report.txt"))
+        context.log.write("moving flye.report to %s\n"%flyeReportFile)
+        shutil.move(context.path("flye.report"), flyeReportFile)
     
-    if not os.path.exists("assembly.fasta"):
+    if not os.path.exists(context.path("assembly.fasta")):
         comment = "Flye failed to generate assembly file. Check "+prefix+"flye_report.txt"
-        LOG.write(comment+"\n")
+        context.log.write(comment+"\n")
         details["assembly"]["outcome"] = comment
         details["problem"].append(comment)
         return None
     # rename to canonical contigs.fasta
-    contigsFile = "contigs.fasta"
-    shutil.move("assembly.fasta", contigsFile)
-    if os.path.exists("assembly_graph.gfa"):
-        shutil.move("assembly_graph.gfa", os.path.join(DETAILS_DIR, prefix+"assembly_graph.gfa"))
+    contigsFile = context.path("contigs.fasta")
+    shutil.move(context.path("assembly.fasta"), contigsFile)
+    if os.path.exists(context.path("assembly_graph.gfa")):
+        shutil.move(context.path("assembly_graph.gfa"), os.path.join(context.details_dir, prefix+"assembly_graph.gfa"))
     details["assembly"]["contigs.fasta size:"] = os.path.getsize(contigsFile)
     return contigsFile
 
-def write_html_report(htmlFile, read_list, details):
-    LOG.write("writing html report to %s\n"%htmlFile)
+def write_html_report(context, htmlFile, read_list, details):
+    context.log.write("writing html report to %s\n"%htmlFile)
     HTML = open(htmlFile, 'w')
     HTML.write("<!DOCTYPE html><html><head>\n")
     HTML.write("<link href=\"https://fonts.googleapis.com/css?family=Work+Sans:300,400,500,600,700,800,900\" rel=\"stylesheet\">\n")
@@ -1107,7 +2074,7 @@ def write_html_report(htmlFile, read_list, details):
         HTML.write("</tbody></table>\n")
         HTML.write("</section>\n")
 
-    LOG.write("details['polishing'] = {}\n".format(details['polishing']))
+    context.log.write("details['polishing'] = {}\n".format(details['polishing']))
     if 'polishing' in details and len(details['polishing']):
         HTML.write('<section>\n<h2>Polishing</h2>\n')
         HTML.write("""
@@ -1147,9 +2114,9 @@ def write_html_report(htmlFile, read_list, details):
         HTML.write("<section><h2>Quast Report</h2>\n")
         HTML.write("<a href='%s'>%s</a><br>\n"%(details["quast_html"], "Quast html report"))
         HTML.write("</table>\n")
-        if os.path.exists(os.path.join(SAVE_DIR, details["quast_txt"])):
+        if os.path.exists(os.path.join(context.save_dir, details["quast_txt"])):
             HTML.write("<pre>\n")
-            HTML.write(open(os.path.join(SAVE_DIR, details["quast_txt"])).read())
+            HTML.write(open(os.path.join(context.save_dir, details["quast_txt"])).read())
             HTML.write("\n</pre>\n")
         HTML.write("</section>\n")
     
@@ -1158,6 +2125,11 @@ def write_html_report(htmlFile, read_list, details):
         read_set.writeHtmlSection(HTML)
     HTML.write("</div>\n")
 
+    if details.get('telemetry'):
+        Telemetry.writeHtmlSection(HTML, details['telemetry'])
+    if details.get('profile'):
+        StageProfiler.writeHtmlSection(HTML, details['profile'])
+
     HTML.write("<section><h2>Tools Used:</h2>\n")
     HTML.write("""
         <table class="med-table kv-table">
@@ -1165,8 +2137,8 @@ def write_html_report(htmlFile, read_list, details):
             <tr> <th > Tool </th><th> Version</th></tr></thead>
             <tbody>
             """)
-    for tool in ReadLibrary.program_version:
-        details['version'][tool] = ReadLibrary.program_version[tool]
+    for tool in context.versions:
+        details['version'][tool] = context.versions[tool]
     for tool in sorted(details['version']):
         HTML.write("<tr><td>%s:</td><td>%s</td></tr>\n"%(tool, str(details['version'][tool])))
     HTML.write("</table>\n")
@@ -1176,9 +2148,134 @@ def write_html_report(htmlFile, read_list, details):
     HTML.close()
 
 
-def main():
-    main_return_code = 1 # set to zero when we have an assembly
-    START_TIME = time()
+def stageState(details, read_list, keys=None, **kwargs):
+    """
+    State to carry past a stage in the manifest: a copy of details, the read sets, and any kwargs.
+    Stages running concurrently save only the details keys they set (plus versions).
+    """
+    state = dict(kwargs)
+    if keys:
+        details = {key: details[key] for key in keys if key in details}
+        details['version'] = dict(details.get('version', {}))
+    state['details'] = json.loads(json.dumps(details, default=str))
+    state['read_list'] = [read_set.to_dict() for read_set in read_list]
+    return state
+
+def restoreStage(context, stage, details, keys=None):
+    """ Restore details (in place, or only keys and versions) from a skipped stage, return its read sets """
+    # copy, so later changes to details do not alter the manifest's record of this stage
+    saved = json.loads(json.dumps(stage['state']['details']))
+    if keys:
+        for key in keys:
+            if key in saved:
+                details[key] = saved[key]
+        details['version'].update(saved.get('version', {}))
+    else:
+        details.clear()
+        details.update(saved)
+    return [ReadLibrary.from_dict(read_set, context) for read_set in stage['state']['read_list']]
+
+def toolVersionText(context, command):
+    """ output of a tool's version command (stdout and stderr), '' if the tool cannot be run """
+    return context.tools.probe(command)['text']
+
+def assemblerVersionCommand(args):
+    if args.recipe == "unicycler":
+        return ["unicycler", "--version"]
+    if args.recipe == "canu":
+        return [args.canu_exec, "--version"]
+    if args.recipe == "flye":
+        return ["flye", "--version"]
+    return ["spades.py", "--version"]
+
+def runCachedReadProcess(context, cache, stage_name, params, tool_command, read_set, process, process_args=()):
+    """
+    Run process(read_set, *process_args), or restore the reads it produces from the artifact cache.
+    New read files from a successful run are published to the cache for later jobs.
+    """
+    key = cache.key(stage_name, params, read_set.files, toolVersionText(context, tool_command))
+    entry = cache.lookup(key)
+    if entry:
+        # the entry may come from another job; its files go to the same names in this job's work directory
+        state = dict(entry['meta']['read_set'])
+        state['files'] = [cache.restore(key, "read_file_{}".format(i+1), context.path(os.path.basename(read_file))) for i, read_file in enumerate(state['files'])]
+        if 'trim_report' in entry['files']:
+            state['trim_report'] = cache.restore(key, 'trim_report', context.path(os.path.basename(state['trim_report'])))
+        read_set.store_current_version()
+        read_set.__dict__.update(state)
+        context.log.write("{} of {} restored from artifact cache\n".format(stage_name, ":".join(read_set.files)))
+        return
+    input_files = list(read_set.files)
+    process(read_set, *process_args)
+    if read_set.files != input_files:
+        files = {"read_file_{}".format(i+1): read_file for i, read_file in enumerate(read_set.files)}
+        if getattr(read_set, 'trim_report', None) and os.path.exists(read_set.trim_report):
+            files['trim_report'] = read_set.trim_report
+        state = {key: value for key, value in read_set.to_dict().items() if key != 'versions'}
+        cache.publish(key, stage_name, files, {'read_set': state})
+
+def restoreCachedAssembly(context, cache, key, details, args):
+    """ Restore contigs, assembly graph and assembly details from the artifact cache. Return contigs file, or None on a miss. """
+    entry = cache.lookup(key)
+    if not entry:
+        return None
+    contigs = cache.restore(key, 'contigs', context.path(os.path.basename(entry['meta']['contigs'])))
+    if 'assembly_graph' in entry['files']:
+        cache.restore(key, 'assembly_graph', os.path.join(context.details_dir, args.prefix+"assembly_graph.gfa"))
+    details['assembly'] = entry['meta']['assembly']
+    details['assembly']['cache_key'] = key
+    details['version'].update(entry['meta']['version'])
+    return contigs
+
+def publishAssembly(context, cache, key, contigs, details, args):
+    files = {'contigs': contigs}
+    gfaFile = os.path.join(context.details_dir, args.prefix+"assembly_graph.gfa")
+    if os.path.exists(gfaFile):
+        files['assembly_graph'] = gfaFile
+    cache.publish(key, "assemble", files, {'contigs': contigs, 'assembly': details['assembly'], 'version': details['version']})
+
+def readFiles(read_list):
+    return [read_file for read_set in read_list for read_file in read_set.files]
+
+def directoryBytes(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            file_path = os.path.join(dirpath, name)
+            if not os.path.islink(file_path):
+                total += os.path.getsize(file_path)
+    return total
+
+def jobSummary(context, args, read_list):
+    """ what the job was asked to do, on how many bases, and what it took; RunAnalytics fits resource models to these """
+    inputs = []
+    for read_set in read_list:
+        original = read_set.versions[0] if read_set.versions else read_set # before trimming, normalizing or down-sampling
+        inputs.append({'platform': original.platform, 'num_reads': getattr(original, 'num_reads', 0), 'num_bases': getattr(original, 'num_bases', 0),
+                       'avg_length': getattr(original, 'avg_length', 0), 'file_bytes': sum(original.file_size)})
+    return {'recipe': args.recipe, 'trim': args.trim, 'normalize': args.normalize, 'racon_iterations': args.racon_iterations,
+            'pilon_iterations': args.pilon_iterations, 'threads': args.threads, 'memory_gb': args.memory, 'inputs': inputs,
+            'elapsed_seconds': round(context.elapsed(), 1), 'work_dir_bytes': directoryBytes(context.work_dir)}
+
+def runReadStage(context, manifest, name, params, read_list, details, process, selected, process_args=(), cache=None, tool_command=None):
+    """
+    Apply process(read_set, *process_args) to the selected read sets as a manifest stage,
+    or restore all read sets if the stage can be skipped. Return read_list.
+    With a cache (and the tool_command reporting the tool's version), each read set's output may come from the artifact cache.
+    """
+    inputs = readFiles(read_list)
+    stage = manifest.skip(name, params, inputs)
+    if stage:
+        return restoreStage(context, stage, details)
+    for read_set in selected:
+        if cache and tool_command:
+            runCachedReadProcess(context, cache, name, params, tool_command, read_set, process, process_args)
+        else:
+            process(read_set, *process_args)
+    manifest.complete(name, params, inputs, outputs=readFiles(read_list), versions=context.versions, state=stageState(details, read_list))
+    return read_list
+
+def argumentParser():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--outputDirectory', '-d', default='p3_assembly_work')
     illumina_or_iontorrent = parser.add_mutually_exclusive_group()
@@ -1196,8 +2293,28 @@ def main():
     #parser.add_argument('--only-assembler', action='store true', help='omit spades read error correction')
     
     parser.add_argument('--racon_iterations', type=int, default=0, help='number of times to run racon per long-read file', required=False)
+    parser.add_argument('--racon_partitions', type=int, default=0, help='number of contig groups to polish as concurrent racon jobs (0 means one per %d threads)'%RACON_THREADS_PER_PARTITION, required=False)
     parser.add_argument('--pilon_iterations', type=int, default=0, help='number of times to run pilon per short-read file', required=False)
     parser.add_argument('--pilon_hours', type=float, default=6.0, help='maximum hours to run pilon', required=False)
+    parser.add_argument('--polisher', choices=('pilon', 'pileup'), default='pilon', help='short-read polisher: pilon, or pileup (majority consensus from samtools mpileup, no JVM)', required=False)
+    parser.add_argument('--pilon_window', type=int, default=2000, help='after the first pilon round, re-polish only this many bases around each change (0 to re-polish everything)', required=False)
+    parser.add_argument('--batch_polish', action='store_true', help='map all short-read libraries together for each pilon round, and concatenate long-read libraries of a platform for racon', required=False)
+    parser.add_argument('--pilon_shards', type=int, default=0, help='number of contig groups to run as concurrent pilon jobs (0 means one per %d threads)'%PILON_THREADS_PER_SHARD, required=False)
+    parser.add_argument('--resume', action='store_true', help='keep the work directory of an earlier run and skip its completed stages whose inputs and parameters are unchanged', required=False)
+    parser.add_argument('--cache_dir', help='artifact cache shared between jobs: trimmed and normalized reads and assemblies are reused when inputs, parameters and tool versions match', required=False)
+    parser.add_argument('--cache_gb', type=float, default=100, help='size limit of --cache_dir; least recently used entries are evicted beyond it', required=False)
+    parser.add_argument('--event_log', help='write JSON-lines stage and throughput events here (default: details/<prefix>events.jsonl)', required=False)
+    parser.add_argument('--profile', action='store_true', help='profile the python code of each stage with cProfile; saves details/<prefix>profile_<stage>.prof', required=False)
+    parser.add_argument('--telemetry_interval', type=float, default=1.0, help='seconds between samples of child process RSS, CPU and I/O (0 to disable)', required=False)
+    parser.add_argument('--walltime_hours', type=float, default=0, help='walltime allocated to the job; polishing rounds, quast and Bandage are shortened or dropped when they would not leave time to filter the contigs and write the report (0 for no limit)', required=False)
+    parser.add_argument('--deadline', type=float, help='unix time by which the job must finish, as an alternative to --walltime_hours (e.g. the end time of the scheduler allocation)', required=False)
+    parser.add_argument('--time_limit', metavar='tool=minutes', nargs='*', default=[], help='wall-clock limit of each run of a tool (e.g. Bandage=10 spades=2880), after which its processes are terminated', required=False)
+    parser.add_argument('--executor', choices=('local', 'batch'), default='local', help='where pilon shards and racon partitions run: on this node, or submitted to a batch queue with --batch_submit and --batch_poll', required=False)
+    parser.add_argument('--batch_submit', help='command submitting a job spec (json file) to the batch queue and printing its id', required=False)
+    parser.add_argument('--batch_poll', help='command printing pending, running or the exit code of a batch job, given its id', required=False)
+    parser.add_argument('--batch_poll_interval', type=float, default=5, help='seconds between polls of each batch job', required=False)
+    parser.add_argument('--resource_broker', help='unix socket of a ResourceBroker (p3x-assembly-batch) sharing threads and memory with other jobs', required=False)
+    parser.add_argument('--tool_registry', help='json file of tool versions kept between runs, keyed by executable path and mtime (default: ~/.cache/p3x-assembly/tool_registry.json, "" for none)', required=False)
     parser.add_argument('--prefix', default='', help='prefix for output files', required=False)
     parser.add_argument('--genome_size', metavar='k, m, or g', default=DEFAULT_GENOME_SIZE, help='genome size for canu: e.g. 300k or 5m or 1.1g', required=False)
     parser.add_argument('--min_contig_length', type=int, default=300, help='save contigs of this length or longer', required=False)
@@ -1217,44 +2334,55 @@ def main():
     parser.add_argument('--params_json', help='JSON file with additional information.')
     parser.add_argument('--path_prefix', '--path-prefix', help="Add the given directories to the PATH", nargs='*', required=False)
     parser.add_argument('-v', '--verbose', action='store_true', help="Output more progress information.", required=False)
+    return parser
 
-    if len(sys.argv) == 1:
+def main(argv=None):
+    parser = argumentParser()
+    if len(sys.argv if argv is None else [None]+argv) == 1:
         parser.print_help()
         sys.exit(2)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    return runAssembly(args)
 
+def runAssembly(args, log=None, tools=None):
+    """
+    Run the job described by args (as parsed in main) in args.outputDirectory, logging to log (default stderr).
+    All the job's state is held in its RunContext, so several jobs can run in one process;
+    tools is a ToolRegistry they share (default: one opened from args.tool_registry).
+    """
+    main_return_code = 1 # set to zero when we have an assembly
+    start_time = time()
     if args.prefix:
         args.prefix = re.sub("[^\w\d\-_.]", "_", args.prefix)
         if not args.prefix.endswith("_"):
             args.prefix += "_"
-    WORK_DIR = args.outputDirectory
-    if os.path.exists(WORK_DIR):
-        shutil.rmtree(WORK_DIR)
-    os.mkdir(WORK_DIR)
-    WORK_DIR = os.path.abspath(WORK_DIR)
-    global SAVE_DIR
-    SAVE_DIR = os.path.abspath(os.path.join(WORK_DIR, "save"))
-    if os.path.exists(SAVE_DIR):
-        shutil.rmtree(SAVE_DIR)
-    os.mkdir(SAVE_DIR)
-    global DETAILS_DIR
-    DETAILS_DIR = os.path.abspath(os.path.join(SAVE_DIR, "details"))
-    os.mkdir(DETAILS_DIR)
-    #logfileName = os.path.join(DETAILS_DIR, args.prefix + "p3_assembly.log")
+    work_dir = os.path.abspath(args.outputDirectory)
+    if os.path.exists(work_dir) and not args.resume:
+        shutil.rmtree(work_dir)
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    save_dir = os.path.join(work_dir, "save")
+    if os.path.exists(save_dir) and not args.resume:
+        shutil.rmtree(save_dir)
+    if not os.path.exists(save_dir):
+        os.mkdir(save_dir)
+    details_dir = os.path.join(save_dir, "details")
+    if not os.path.exists(details_dir):
+        os.mkdir(details_dir)
+    #logfileName = os.path.join(details_dir, args.prefix + "p3_assembly.log")
  
     if args.path_prefix:
         os.environ["PATH"] = ":".join(args.path_prefix) + ":" + os.environ["PATH"]
 
-    global LOG 
     #sys.stderr.write("logging to "+logfileName+"\n")
-    #LOG = open(logfileName, 'w') 
-    LOG = sys.stderr
-    LOG.write("starting %s\n"%sys.argv[0])
-    LOG.write(strftime("%a, %d %b %Y %H:%M:%S", localtime(START_TIME))+"\n")
-    LOG.write("args= "+str(args)+"\n\n")
-    LOG.write("Work directory is "+WORK_DIR+"\n\n")
-    LOG.write("Final output will be saved to "+SAVE_DIR+"\n\n")
-    LOG.write("Detailed output will be saved to "+DETAILS_DIR+"\n\n")
+    #log = open(logfileName, 'w') 
+    log = log or sys.stderr
+    log.write("starting %s\n"%sys.argv[0])
+    log.write(strftime("%a, %d %b %Y %H:%M:%S", localtime(start_time))+"\n")
+    log.write("args= "+str(args)+"\n\n")
+    log.write("Work directory is "+work_dir+"\n\n")
+    log.write("Final output will be saved to "+save_dir+"\n\n")
+    log.write("Detailed output will be saved to "+details_dir+"\n\n")
     details = {'assembly': {} }
     details["post-assembly transformation"] = []
     details["assembly"] = {}
@@ -1264,18 +2392,67 @@ def main():
     details["problem"] = []
     details['max_bases']=args.max_bases
 
-    ReadLibrary.NUM_THREADS = args.threads
-    ReadLibrary.MEMORY = args.memory  # in GB
-    ReadLibrary.LOG = sys.stderr
+    # every external tool takes its threads and memory from this budget, so concurrent stages never oversubscribe the job
+    if args.resource_broker:
+        resources = RemoteResourceManager(args.resource_broker, threads=args.threads, memory_gb=args.memory, log=log)
+    else:
+        resources = ResourceManager(threads=args.threads, memory_gb=args.memory, log=log)
+    args.threads = resources.threads
+    args.memory = max(1, int(resources.allocated_memory_gb))
+    # version probes are answered from here, and from earlier runs when the executables are unchanged
+    tools = tools or ToolRegistry(args.tool_registry, log=log)
+    events = EventLog(args.event_log or os.path.join(details_dir, args.prefix+"events.jsonl"), append=args.resume, log=log)
+    if args.executor == 'batch':
+        if not (args.batch_submit and args.batch_poll):
+            raise Exception("--executor batch needs --batch_submit and --batch_poll")
+        executor = BatchExecutor(shlex.split(args.batch_submit), shlex.split(args.batch_poll), os.path.join(work_dir, "batch_jobs"),
+                                 cwd=work_dir, log=log, poll_interval=args.batch_poll_interval)
+    else:
+        executor = LocalExecutor(work_dir, log=log)
+    limits = {}
+    for limit in args.time_limit:
+        tool, minutes = limit.rsplit("=", 1)
+        limits[tool] = float(minutes) * 60
+    runner = ToolRunner(cwd=work_dir, log=log, limits=limits)
+    deadline = args.deadline or (start_time + args.walltime_hours * 60 * 60 if args.walltime_hours else None)
+    budget = WalltimeBudget(deadline, log=log)
+    if deadline:
+        log.write("walltime budget: results due by {}\n".format(strftime("%a, %d %b %Y %H:%M:%S", localtime(deadline))))
+    context = RunContext(work_dir, save_dir, details_dir, log=log, resources=resources, tools=tools, events=events,
+                         runner=runner, executor=executor, budget=budget, start_time=start_time)
+    if threading.current_thread() is threading.main_thread():
+        # tools run in process groups of their own, so they would not get a signal sent to this job's group
+        def stopTools(signum, frame):
+            context.runner.killAll()
+            context.executor.killAll()
+            sys.exit(128 + signum)
+        signal.signal(signal.SIGTERM, stopTools)
+
+    # completed stages are recorded here; with --resume, those whose fingerprints still match are skipped
+    manifest = StageManifest(context.path("stage_manifest.json"), resume=args.resume, log=log)
+    context.events.emit('start', argv=sys.argv, threads=args.threads, memory_gb=args.memory)
+    manifest.events = context.events
+    profiler = None
+    if args.profile:
+        profiler = StageProfiler(log=log)
+        manifest.profiler = profiler
+    telemetry = None
+    if args.telemetry_interval > 0:
+        telemetry = Telemetry(interval=args.telemetry_interval, origin=context.start_time, log=log)
+        telemetry.install()
+        manifest.telemetry = telemetry
+    cache = None
+    if args.cache_dir:
+        cache = ArtifactCache(args.cache_dir, max_gb=args.cache_gb, log=log)
 
     read_list = []
     if args.anonymous_reads:
         for item in args.anonymous_reads:
             if ':' in item:
                 read_pair = item.split(':')
-                readLib = ReadLibrary(read_pair, work_dir=WORK_DIR)
+                readLib = ReadLibrary(read_pair, work_dir=work_dir, context=context)
             else:
-                readLib = ReadLibrary(item, work_dir=WORK_DIR)
+                readLib = ReadLibrary(item, work_dir=work_dir, context=context)
             read_list.append(readLib)
 
     if args.illumina:
@@ -1283,60 +2460,57 @@ def main():
         for item in args.illumina:
             if ':' in item:
                 read_pair = item.split(':')
-                readLib = ReadLibrary(read_pair, platform=platform, work_dir=WORK_DIR)
+                readLib = ReadLibrary(read_pair, platform=platform, work_dir=work_dir, context=context)
             else:
                 interleaved = args.interleaved and item in args.interleaved
-                readLib = ReadLibrary(item, platform=platform, interleaved=interleaved, work_dir=WORK_DIR)
+                readLib = ReadLibrary(item, platform=platform, interleaved=interleaved, work_dir=work_dir, context=context)
             read_list.append(readLib)
 
     if args.iontorrent:
         platform = 'iontorrent'
         for item in args.iontorrent:
             interleaved = args.interleaved and item in args.interleaved
-            readLib = ReadLibrary(item, platform=platform, interleaved=interleaved, work_dir=WORK_DIR)
+            readLib = ReadLibrary(item, platform=platform, interleaved=interleaved, work_dir=work_dir, context=context)
             read_list.append(readLib)
 
     if args.pacbio:
         platform = 'pacbio'
         for item in args.pacbio:
-            readLib = ReadLibrary(item, platform=platform, work_dir=WORK_DIR)
+            readLib = ReadLibrary(item, platform=platform, work_dir=work_dir, context=context)
             read_list.append(readLib)
 
     if args.nanopore:
         platform = 'nanopore'
         for item in args.nanopore:
-            readLib = ReadLibrary(item, platform=platform, work_dir=WORK_DIR)
+            readLib = ReadLibrary(item, platform=platform, work_dir=work_dir, context=context)
             read_list.append(readLib)
 
     if args.fasta:
         for item in args.fasta:
             if ':' in item:
                 read_pair = item.split(':')
-                readLib = ReadLibrary(read_pair, work_dir=WORK_DIR)
+                readLib = ReadLibrary(read_pair, work_dir=work_dir, context=context)
             else:
-                readLib = ReadLibrary(item, work_dir=WORK_DIR)
+                readLib = ReadLibrary(item, work_dir=work_dir, context=context)
             read_list.append(readLib)
 
-    # move into working directory so that all files are local
-    os.chdir(WORK_DIR)
-
-    for read_set in read_list:
-        read_set.study_reads()
+    read_list = runReadStage(context, manifest, "study", None, read_list, details, ReadLibrary.study_reads, read_list)
 
     if args.trim:
-        for read_set in read_list:
-            if read_set.length_class == "short" and read_set.format == 'fastq': # TrimGalore only works on short fastq reads
-                read_set.trim_short_reads()
+        # TrimGalore only works on short fastq reads
+        selected = [read_set for read_set in read_list if read_set.length_class == "short" and read_set.format == 'fastq']
+        read_list = runReadStage(context, manifest, "trim", None, read_list, details, ReadLibrary.trim_short_reads, selected,
+                cache=cache, tool_command=["trim_galore", "--version"])
 
     if args.normalize:
-        for read_set in read_list:
-            if read_set.platform == "illumina": #BBNorm is not recommended for nanopore or pacbio
-                read_set.normalize_read_depth()
+        #BBNorm is not recommended for nanopore or pacbio
+        selected = [read_set for read_set in read_list if read_set.platform == "illumina"]
+        read_list = runReadStage(context, manifest, "normalize", None, read_list, details, ReadLibrary.normalize_read_depth, selected,
+                cache=cache, tool_command=["bbnorm.sh", "--version"])
 
     if args.max_bases:
-        for read_set in read_list:
-            if read_set.num_bases > args.max_bases:
-                read_set.down_sample_reads(args.max_bases)
+        selected = [read_set for read_set in read_list if read_set.num_bases > args.max_bases]
+        read_list = runReadStage(context, manifest, "sample", {'max_bases': args.max_bases}, read_list, details, ReadLibrary.down_sample_reads, selected, (args.max_bases,))
 
     any_short_fasta = False
     short_reads = []
@@ -1351,94 +2525,172 @@ def main():
 
     if args.recipe == "auto":
         #now must decide which assembler to use
-        LOG.write("translate auto into specific recipe\n")
-        LOG.write("number of short reads = {}\n".format(len(short_reads)))
-        LOG.write("number of long reads = {}\n".format(len(long_reads)))
+        context.log.write("translate auto into specific recipe\n")
+        context.log.write("number of short reads = {}\n".format(len(short_reads)))
+        context.log.write("number of long reads = {}\n".format(len(long_reads)))
         if len(short_reads):
             if any_short_fasta:
                 args.recipe = "spades"
-                LOG.write("auto recipe selecting spades due to presence of short fasta read data.\n")
+                context.log.write("auto recipe selecting spades due to presence of short fasta read data.\n")
             else:
                 args.recipe = "unicycler"
-                LOG.write("auto recipe selecting unicycler due to presence of short fastq read data.\n")
+                context.log.write("auto recipe selecting unicycler due to presence of short fastq read data.\n")
         elif len(long_reads):
             args.recipe = "flye"
-            LOG.write("auto recipe selecting flye due to presence of long and absence of short read data.\n")
+            context.log.write("auto recipe selecting flye due to presence of long and absence of short read data.\n")
         else:
             comment = "auto recipe failed to find short or long reads\n"
-            LOG.write(comment)
+            context.log.write(comment)
             raise Exception(comment)
 
+    if args.recipe == "meta-spades" and (args.pilon_iterations or args.racon_iterations):
+        args.pilon_iterations = 0
+        args.racon_iterations = 0
+        comment = "Because recipe is meta-spades, turning pilon and racon iterations off."
+        context.log.write(comment+"\n")
+        details['problem'].append(comment)
+
     contigs = ""
-    if args.recipe == "unicycler":
+    assembly_params = {'recipe': args.recipe, 'min_contig_length': args.min_contig_length, 'genome_size': args.genome_size,
+            'trusted_contigs': args.trusted_contigs, 'untrusted_contigs': args.untrusted_contigs, 'spades_for_unicycler': args.spades_for_unicycler}
+    stage = manifest.skip("assemble", assembly_params, readFiles(read_list))
+    assembly_cache_key = None
+    if cache and not stage and args.recipe != 'none':
+        assembly_bases = [read_set.num_bases for read_set in read_list]
+        assembly_cache_key = cache.key("assemble", assembly_params, readFiles(read_list), toolVersionText(context, assemblerVersionCommand(args)))
+        contigs = restoreCachedAssembly(context, cache, assembly_cache_key, details, args)
+    if stage:
+        read_list = restoreStage(context, stage, details)
+        contigs = stage['state']['contigs']
+    elif contigs:
+        context.log.write("assembly restored from artifact cache, key {}\n".format(assembly_cache_key))
+    elif args.recipe == "unicycler":
         spades_exec = None
         if (args.spades_for_unicycler):
             spades_exec = args.spades_for_unicycler
-        contigs = runUnicycler(details, read_list, threads=args.threads, min_contig_length=args.min_contig_length, prefix=args.prefix, spades_exec=spades_exec )
+        contigs = runUnicycler(context, details, read_list, threads=args.threads, min_contig_length=args.min_contig_length, prefix=args.prefix, spades_exec=spades_exec )
         if not contigs:
             comment = "unicycler failed to generate contigs"
-            LOG.write(comment+"\n")
+            context.log.write(comment+"\n")
             details['problem'].append(comment)
 
     elif args.recipe == "canu":
-        contigs = runCanu(details, read_list, canu_exec=args.canu_exec, threads=args.threads, genome_size=args.genome_size, memory=args.memory, prefix=args.prefix)
+        contigs = runCanu(context, details, read_list, canu_exec=args.canu_exec, threads=args.threads, genome_size=args.genome_size, memory=args.memory, prefix=args.prefix)
 
     elif args.recipe == "flye":
-        contigs = runFlye(details, read_list, threads=args.threads, genome_size=args.genome_size, prefix=args.prefix)
+        contigs = runFlye(context, details, read_list, threads=args.threads, genome_size=args.genome_size, prefix=args.prefix)
 
     elif "spades" in args.recipe or args.recipe == "single-cell":
-        if args.recipe == "meta-spades" and (args.pilon_iterations or args.racon_iterations):
-            args.pilon_iterations = 0
-            args.racon_iterations = 0
-            comment = "Because recipe is meta-spades, turning pilon and racon iterations off."
-            LOG.write(comment+"\n")
-            details['problem'].append(comment)
-        contigs = runSpades(details, read_list, prefix=args.prefix, recipe=args.recipe, threads=args.threads, memory=args.memory)
+        contigs = runSpades(context, details, read_list, prefix=args.prefix, recipe=args.recipe, threads=args.threads, memory=args.memory)
     elif args.recipe == 'none':
-        LOG.write("recipe specified as 'none', no assembly will be performed\n")
+        context.log.write("recipe specified as 'none', no assembly will be performed\n")
     else:
-        LOG.write("cannot interpret args.recipe: "+args.recipe)
+        context.log.write("cannot interpret args.recipe: "+args.recipe)
+    if not stage:
+        if assembly_cache_key and contigs and 'cache_key' not in details['assembly']:
+            if [read_set.num_bases for read_set in read_list] != assembly_bases:
+                # a memory retry assembled reduced reads, so key the assembly on those
+                assembly_cache_key = cache.key("assemble", assembly_params, readFiles(read_list), toolVersionText(context, assemblerVersionCommand(args)))
+            publishAssembly(context, cache, assembly_cache_key, contigs, details, args)
+        manifest.complete("assemble", assembly_params, readFiles(read_list), outputs=[contigs], versions=details['version'], state=stageState(details, read_list, contigs=contigs))
 
     if not contigs:
         if args.contigs:
-            LOG.write("contigs supplied as {}\n".format(args.contigs))
+            context.log.write("contigs supplied as {}\n".format(args.contigs))
     if contigs:
-        LOG.write("size of contigs file is %d\n"%os.path.getsize(contigs))
+        context.log.write("size of contigs file is %d\n"%os.path.getsize(contigs))
+        # whatever polishing and quality checks are dropped, the contigs must still be filtered and reported
+        read_gbp = sum(read_set.num_bases for read_set in read_list) / 1e9
+        context.budget.hold('filter', context.budget.predict('filter', gbp=read_gbp, threads=args.threads))
+        context.budget.hold('report', context.budget.predict('report'))
     if args.racon_iterations and contigs:
         # now run racon with each long-read file
-            for longReadSet in long_reads:
+            racon_read_sets = long_reads
+            if args.batch_polish and len(long_reads) > 1:
+                # one racon run per platform on the concatenated reads (minimap2 preset depends on platform)
+                racon_read_sets = []
+                for platform in sorted(set(read_set.platform for read_set in long_reads)):
+                    platform_sets = [read_set for read_set in long_reads if read_set.platform == platform]
+                    if len(platform_sets) > 1:
+                        platform_sets = [combineReadLibraries(context, platform_sets, context.path("batch_{}_reads".format(platform)))]
+                    racon_read_sets.extend(platform_sets)
+            for k, longReadSet in enumerate(racon_read_sets):
                 for i in range(0, args.racon_iterations):
-                    LOG.write("runRacon on {}, {}, platform={}, round={}\n".format(contigs, longReadSet.files[0], longReadSet.platform, i))
-                    raconReport = runRacon(contigs, longReadSet, args, details) 
-                    raconContigFile = ''
-                    if raconReport:
-                        if 'output' in raconReport:
-                            raconContigFile = raconReport['output']
-                        details['polishing'].append(raconReport)
-                        details['version']['racon'] = raconReport['version']
-                    LOG.write("racon output = {}, report={}\n".format(raconContigFile, raconReport))
+                    stage_name = "racon_{}_{}".format(k+1, i+1)
+                    stage_params = {'reads': longReadSet.files}
+                    stage = manifest.skip(stage_name, stage_params, [contigs])
+                    if stage:
+                        restoreStage(context, stage, details)
+                        raconContigFile = stage['state']['contigs']
+                    else:
+                        racon_seconds = context.budget.predict('racon', gbp=longReadSet.num_bases / 1e9, threads=args.threads)
+                        if not context.budget.allow("racon round {} on {}".format(i+1, os.path.basename(longReadSet.files[0])), racon_seconds, details):
+                            break
+                        for tool in ('minimap2', 'racon'):
+                            context.budget.limit(context.runner.limits, tool)
+                        context.log.write("runRacon on {}, {}, platform={}, round={}\n".format(contigs, longReadSet.files[0], longReadSet.platform, i))
+                        round_start = time()
+                        raconReport = runRacon(context, contigs, longReadSet, args, details) 
+                        for tool in ('minimap2', 'racon'):
+                            context.budget.restore(context.runner.limits, tool)
+                        context.budget.observe('racon', time() - round_start)
+                        raconContigFile = ''
+                        if raconReport:
+                            if 'output' in raconReport:
+                                raconContigFile = raconReport['output']
+                            details['polishing'].append(raconReport)
+                            details['version']['racon'] = raconReport['version']
+                        context.log.write("racon output = {}, report={}\n".format(raconContigFile, raconReport))
+                        manifest.complete(stage_name, stage_params, [contigs], outputs=[raconContigFile], versions=details['version'], state=stageState(details, read_list, contigs=raconContigFile))
                     if os.path.exists(raconContigFile):
                         contigs = raconContigFile
                         sys.stderr.write("contigs file is now {}\n".format(contigs))
                     else:
                         break # break out of iterating racon_iterations, go to next long-read file if any
         
-    if args.pilon_iterations and args.pilon_jar and contigs:
+    if args.pilon_iterations and (args.pilon_jar or args.polisher == 'pileup') and contigs:
         pilon_end_time = time() + args.pilon_hours * 60 * 60
-        # now run pilon with each short-read file
-        for read_set in short_reads:
-            fastqFile = read_set.files[0] # use only read_1 if paired
+        pilon_limit = context.runner.limits.get('pilon')
+        # now run pilon with each short-read file, or with all of them at once
+        pilon_read_groups = [short_reads] if args.batch_polish else [[read_set] for read_set in short_reads]
+        for k, read_set in enumerate(pilon_read_groups):
+            fastqFile = ",".join(library.files[0] for library in read_set) # use only read_1 if paired
+            pilon_state = {} # lets later rounds re-polish only around the previous round's changes
+            num_changes = None
             for iteration in range(0, args.pilon_iterations):
                 if time() > pilon_end_time:
-                    LOG.write("Time expended on pilon exceeds allocation of {} hours. Omitting further pilon runs.".format(args.pilon_hours))
+                    context.log.write("Time expended on pilon exceeds allocation of {} hours. Omitting further pilon runs.".format(args.pilon_hours))
                     break
-
-                LOG.write("runPilon(%s, %s, ...)\n"%(contigs, fastqFile))
-                pilonReport = runPilon(contigs, read_set, args, details)
+                # a pilon run is stopped when it would overrun what is left of --pilon_hours, or of the walltime budget
+                pilon_seconds = pilon_end_time - time()
+                if context.budget.deadline:
+                    pilon_seconds = min(pilon_seconds, context.budget.spendable())
+                context.runner.limits['pilon'] = max(1, min(pilon_limit or pilon_seconds, pilon_seconds))
+
+                stage_name = "pilon_{}_{}".format(k+1, iteration+1)
+                stage_params = {'reads': readFiles(read_set), 'polisher': args.polisher}
+                stage = manifest.skip(stage_name, stage_params, [contigs])
+                if stage:
+                    restoreStage(context, stage, details)
+                    pilonReport = stage['state']['report']
+                else:
+                    pilon_seconds = context.budget.predict('pilon', gbp=sum(library.num_bases for library in read_set) / 1e9, threads=args.threads)
+                    if not context.budget.allow("{} round {} on {}".format(args.polisher, iteration+1, os.path.basename(fastqFile.split(",")[0])), pilon_seconds, details):
+                        break
+                    context.log.write("runPilon(context, %s, %s, ...)\n"%(contigs, fastqFile))
+                    round_start = time()
+                    if args.polisher == 'pileup':
+                        pilonReport = runPileupPolisher(context, contigs, read_set, args, details)
+                    else:
+                        pilonReport = runPilon(context, contigs, read_set, args, details, pilon_state)
+                    context.budget.observe('pilon', time() - round_start)
+                    if pilonReport:
+                        details['polishing'].append(pilonReport)
+                        if 'version' in pilonReport:
+                            details['version'][pilonReport['program']] = pilonReport['version']
+                    manifest.complete(stage_name, stage_params, [contigs], outputs=[pilonReport['output'] if pilonReport else None],
+                            versions=details['version'], state=stageState(details, read_list, report=pilonReport))
                 if pilonReport:
-                    details['polishing'].append(pilonReport)
-                    if 'version' in pilonReport:
-                        details['version']['pilon'] = pilonReport['version']
                     pilonContigFile = pilonReport['output']
                     if pilonContigFile is not None and os.path.exists(pilonContigFile):
                         contigs = pilonContigFile
@@ -1446,44 +2698,106 @@ def main():
                     else:
                         sys.stderr.write("expected contigs file {} does not exist\n".format(contigs))
                         #break
-            # check number of changes in most recent round, quit if zero
-            if 'num_changes' in details['polishing'][-1] and details['polishing'][-1]['num_changes'] == 0:
+                    num_changes = pilonReport['num_changes']
+                    if num_changes == 0:
+                        context.log.write("pilon made no changes, stop iterating on {}\n".format(fastqFile))
+                        break
+            removePilonState(pilon_state)
+            # if this read set found nothing to change, later ones are not expected to either
+            if num_changes == 0:
                 break
+        if pilon_limit is None:
+            context.runner.limits.pop('pilon', None)
+        else:
+            context.runner.limits['pilon'] = pilon_limit
             
+    if contigs and os.path.getsize(contigs) and context.tools.version("samtools"):
+        details["version"]['samtools'] = context.tools.version("samtools")
+
+    # Bandage needs only the assembly graph, so it runs alongside filtering and quast
+    post_stages = []
+    fork_fingerprint = manifest.last_fingerprint
+    gfaFile = os.path.join(context.details_dir, args.prefix+"assembly_graph.gfa")
+    bandage_threads = 1 if os.path.exists(gfaFile) and os.path.getsize(gfaFile) else 0
+    # with a deadline, quast is shortened or dropped, then Bandage dropped, if they would cut into filtering and the report
+    quast_mode = 'full'
     if contigs and os.path.getsize(contigs):
-        command = ["samtools"]
-        proc = subprocess.Popen(command, shell=False, stderr=subprocess.PIPE)
-        proc.wait()
-        version_text = proc.stderr.read().decode()
-        for line in version_text.splitlines():
-            if 'Version' in line:
-                details["version"]['samtools'] = line.strip()
-        filterReport = filterContigsByLengthAndCoverage(contigs, read_list, args, details)
-        details['contig_filtering'] = filterReport
-        if 'good contigs file' in filterReport:
-            contigs = filterReport['good contigs file']
+        contig_mb = os.path.getsize(contigs) / 1e6
+        quast_seconds = context.budget.predict('quast', mb=contig_mb)
+        if not context.budget.fits(quast_seconds):
+            quast_seconds = context.budget.predict('quast_fast', mb=contig_mb)
+            if context.budget.fits(quast_seconds):
+                context.budget.allow("full quast", context.budget.predict('quast', mb=contig_mb), details, outcome="shortened to quast --fast")
+                quast_mode = 'fast'
+            else:
+                context.budget.allow("quast", quast_seconds, details)
+                quast_mode = None
+        if quast_mode:
+            context.budget.limit(context.runner.limits, 'quast')
+            context.budget.hold('quast', quast_seconds)
+    if bandage_threads:
+        if context.budget.allow("Bandage", context.budget.predict('Bandage', mb=os.path.getsize(gfaFile) / 1e6), details):
+            context.budget.limit(context.runner.limits, 'Bandage')
+        else:
+            bandage_threads = 0
+    if bandage_threads:
+        post_stages.append({'name': 'bandage', 'threads': bandage_threads,
+                'function': lambda threads: runBandageStage(context, manifest, fork_fingerprint, gfaFile, read_list, details)})
     if contigs and os.path.getsize(contigs):
-        runQuast(contigs, args, details)
-        shutil.move(contigs, os.path.join(SAVE_DIR, args.prefix+"contigs.fasta"))
-
-    gfaFile = os.path.join(DETAILS_DIR, args.prefix+"assembly_graph.gfa")
-    if os.path.exists(gfaFile) and os.path.getsize(gfaFile):
-        runBandage(gfaFile, details)
-
-    with open(os.path.join(DETAILS_DIR, args.prefix+"run_details.json"), "w") as fp:
-        try:
-            json.dump(details, fp, indent=2, sort_keys=True)
-        except UnicodeDecodeError as ude:
-            LOG.write("Problem writing details to json: "+str(ude)+"\n")
-
-
-    htmlFile = os.path.join(SAVE_DIR, args.prefix+"AssemblyReport.html")
-    write_html_report(htmlFile, read_list, details)
-    LOG.write("done with %s\n"%sys.argv[0])
-    LOG.write(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))+"\n")
-    LOG.write("Total time in hours = %d\t"%((time() - START_TIME)/3600))
-    LOG.write("Total time in seconds = %d\n"%((time() - START_TIME)))
-    LOG.close()
+        # quast needs the filtered contigs; together they share what Bandage leaves of --threads
+        filter_threads = max(1, args.threads - bandage_threads)
+        polished_contigs = contigs
+        filter_stage = {'name': 'filter', 'threads': filter_threads,
+                'function': lambda threads: runFilterStage(context, manifest, fork_fingerprint, polished_contigs, read_list, threadArgs(args, threads), details)}
+        quast_stage = {'name': 'quast', 'threads': filter_threads, 'after': ['filter'],
+                'function': lambda threads: runQuastStage(context, manifest, filter_stage['result'][1], filter_stage['result'][0], read_list, threadArgs(args, threads), details, quast_mode)}
+        post_stages.extend((filter_stage, quast_stage))
+    if profiler and post_stages:
+        profiler.beginConcurrent("+".join(stage['name'] for stage in post_stages))
+    runConcurrentStages(context, post_stages)
+    if profiler:
+        profiler.endConcurrent()
+    for stage in post_stages:
+        if stage['name'] == 'filter':
+            contigs = stage['result'][0]
+    details['post_assembly_stages'] = [{key: stage[key] for key in ('name', 'threads', 'start', 'end')} for stage in post_stages]
+    details['resources'] = context.resources.report(context.start_time)
+    details['tool_runs'] = context.runner.report()
+    if context.budget.deadline:
+        details['walltime_budget'] = context.budget.report()
+    details['tool_registry'] = context.tools.report()
+    details['job'] = jobSummary(context, args, read_list)
+    details['stages'] = manifest.timings()
+    if telemetry:
+        telemetry.stop()
+        details['telemetry'] = telemetry.report()
+    if profiler:
+        manifest.profiler = None
+        details['profile'] = profiler.finish(context.details_dir, args.prefix)
+    # the report follows the polished contigs, whichever of the concurrent stages finished last
+    manifest.last_fingerprint = fork_fingerprint
+
+    detailsFile = os.path.join(context.details_dir, args.prefix+"run_details.json")
+    htmlFile = os.path.join(context.save_dir, args.prefix+"AssemblyReport.html")
+    if not manifest.skip("report", None, [contigs]):
+        with open(detailsFile, "w") as fp:
+            try:
+                json.dump(details, fp, indent=2, sort_keys=True)
+            except UnicodeDecodeError as ude:
+                context.log.write("Problem writing details to json: "+str(ude)+"\n")
+
+        write_html_report(context, htmlFile, read_list, details)
+        manifest.complete("report", None, [contigs], outputs=[detailsFile, htmlFile])
+    context.log.write("done with %s\n"%sys.argv[0])
+    context.log.write(strftime("%a, %d %b %Y %H:%M:%S", localtime(time()))+"\n")
+    context.log.write("Total time in hours = %d\t"%((time() - context.start_time)/3600))
+    context.log.write("Total time in seconds = %d\n"%((time() - context.start_time)))
+    savedContigs = os.path.join(context.save_dir, args.prefix+"contigs.fasta")
+    if os.path.exists(savedContigs) and os.path.getsize(savedContigs):
+        main_return_code = 0
+    context.events.emit('end', 'main', return_code=main_return_code, seconds=round(time() - context.start_time, 1))
+    context.events.close()
+    context.log.flush()
     return main_return_code
 
 if __name__ == "__main__":
@@ -111,6 +111,41 @@ sub preflight
 	$est_ram = "48000M";
     }
 
+    #
+    # If a model fitted to earlier runs is installed (p3x-assembly-model fit), use its
+    # predictions in place of the estimates above.
+    #
+    my $model = $ENV{P3_ASSEMBLY_MODEL};
+    if ($model && -s $model)
+    {
+	my @cmd = ("p3x-assembly-model", "predict",
+		   "--model", $model,
+		   "--recipe", $params->{recipe} || "auto",
+		   "--compressed_bytes", $comp_size,
+		   "--uncompressed_bytes", $uncomp_size,
+		   "--platform", keys %plats);
+	push(@cmd, "--trim") if $params->{trim};
+	push(@cmd, "--normalize") if $params->{normalize};
+	my $out;
+	my $err;
+	if (run(\@cmd, ">", \$out, "2>", \$err))
+	{
+	    my $pred = eval { decode_json($out); };
+	    if ($pred)
+	    {
+		print STDERR "model prediction: $out\n";
+		$est_cpu = $pred->{cpu} if $pred->{cpu};
+		$est_ram = $pred->{memory} if $pred->{memory};
+		$est_time = $pred->{runtime} if $pred->{runtime};
+		$est_storage = $pred->{storage} if $pred->{storage};
+	    }
+	}
+	else
+	{
+	    warn "@cmd failed, keeping default estimates: $err\n";
+	}
+    }
+
     return {
 	cpu => $est_cpu,
 	memory => $est_ram,
@@ -261,26 +296,43 @@ sub assemble
     my @cmd = ("p3x-assembly",
 	       "--prefix", "$prefix",
 	       "--pilon_jar", $pilon,
+	       "--event_log", "$asm_out/p3x-assembly.events.jsonl",
 	       "--path-prefix", @path_additions,
 	       @params);
 
     print "Start assembler: @cmd\n";
     print Dumper(\@cmd, \@path_additions);
 
-    open(ASM_OUT, ">", "$asm_out/p3x-assembly.stdout") or die "Cannot write $asm_out/p3x-assembly.stdout: $!";
-    open(ASM_ERR, ">", "$asm_out/p3x-assembly.stderr") or die "Cannot write $asm_out/p3x-assembly.stderr: $!";
-    my $asm_ok = run(\@cmd,
-		     init => sub {
-			 chdir $asm_out or die "Cannot chdir $asm_out: $!";
-			 # we use --path-prefix now
-#			 $ENV{PATH} = join(":", @path_additions, $ENV{PATH});
-		     },
-		     ">", sub { my($dat) = @_; print $dat; print ASM_OUT $dat; },
-		     "2>", sub { my($dat) = @_; print STDERR $dat; print ASM_ERR $dat; },
-		     # ">", "$asm_out/p3x-assembly.stdout",
-		     # "2>", "$asm_out/p3x-assembly.stderr",
-		    );
-    my $asm_rc = $?;
+    #
+    # If an assembly daemon (p3x-assembly-daemon) serves a spool directory on this node,
+    # hand it the job and poll its status file; it keeps tool versions and caches warm between jobs.
+    #
+    my $spool = $ENV{P3_ASSEMBLY_SPOOL};
+    my $asm_ok;
+    my $asm_rc;
+    if ($spool && daemon_alive($spool))
+    {
+	my $status = run_in_daemon($spool, \@cmd, $asm_out);
+	$asm_ok = $status->{state} eq 'done' && $status->{return_code} == 0;
+	$asm_rc = $asm_ok ? 0 : "daemon job failed: $status->{error}";
+    }
+    else
+    {
+	open(ASM_OUT, ">", "$asm_out/p3x-assembly.stdout") or die "Cannot write $asm_out/p3x-assembly.stdout: $!";
+	open(ASM_ERR, ">", "$asm_out/p3x-assembly.stderr") or die "Cannot write $asm_out/p3x-assembly.stderr: $!";
+	$asm_ok = run(\@cmd,
+			 init => sub {
+			     chdir $asm_out or die "Cannot chdir $asm_out: $!";
+			     # we use --path-prefix now
+#			     $ENV{PATH} = join(":", @path_additions, $ENV{PATH});
+			 },
+			 ">", sub { my($dat) = @_; print $dat; print ASM_OUT $dat; },
+			 "2>", sub { my($dat) = @_; print STDERR $dat; print ASM_ERR $dat; },
+			 # ">", "$asm_out/p3x-assembly.stdout",
+			 # "2>", "$asm_out/p3x-assembly.stderr",
+			);
+	$asm_rc = $?;
+    }
 
     my $output_folder = $app->result_folder();
 
@@ -310,6 +362,10 @@ sub assemble
     {
 	$ws->save_file_to_file("$asm_out/p3x-assembly.stderr", {}, "$output_folder/p3x-assembly.stderr", 'txt', 1, 1);
     }
+    if (-s "$asm_out/p3x-assembly.events.jsonl")
+    {
+	$ws->save_file_to_file("$asm_out/p3x-assembly.events.jsonl", {}, "$output_folder/p3x-assembly.events.jsonl", 'txt', 1, 1);
+    }
 
     if (opendir(DIR, $save_path))
     {
@@ -343,3 +399,42 @@ sub assemble
 }
 
 
+#
+# A daemon is alive if its heartbeat in $spool/daemon.json is recent and it is not shutting down.
+#
+sub daemon_alive
+{
+    my($spool) = @_;
+    my $daemon = eval { decode_json(read_file("$spool/daemon.json")) };
+    return $daemon && !$daemon->{stopping} && time - $daemon->{heartbeat} < 120 && kill(0, $daemon->{pid});
+}
+
+#
+# Submit the p3x-assembly command to the daemon at $spool as a job running in $asm_out,
+# logging to $asm_out/p3x-assembly.stderr; wait for it to finish and return its status.
+#
+sub run_in_daemon
+{
+    my($spool, $cmd, $asm_out) = @_;
+
+    my(undef, @argv) = @$cmd;
+    my $job = "job-" . basename($asm_out) . "-$$-" . time;
+    my $manifest = { argv => \@argv, cwd => $asm_out, log => "$asm_out/p3x-assembly.stderr" };
+    write_file("$spool/incoming/$job.json.tmp", encode_json($manifest));
+    rename("$spool/incoming/$job.json.tmp", "$spool/incoming/$job.json") or die "Cannot submit $job to $spool: $!";
+    print "Submitted job $job to assembly daemon at $spool\n";
+
+    my $status_file = "$spool/status/$job.json";
+    while (1)
+    {
+	sleep(10);
+	my $status;
+	$status = eval { decode_json(read_file($status_file)) } if -s $status_file;
+	if ($status && ($status->{state} eq 'done' || $status->{state} eq 'failed'))
+	{
+	    print "Assembly daemon job $job $status->{state} after $status->{seconds} seconds\n";
+	    return $status;
+	}
+	daemon_alive($spool) or die "Assembly daemon at $spool stopped before job $job finished\n";
+    }
+}